@@ -40,23 +40,35 @@ the mimeapps.list file is no longer supported in that directory:
 '''
 
 import argparse
+import bisect
 import collections
+import contextlib
+import fcntl
 import fnmatch
+import functools
 import glob
 import itertools
+import json
 import logging
+import marshal
 import mimetypes
 import os
 import re
 import shlex
-import socket
 import stat
 import subprocess
 import sys
+import threading
+import time
 import urllib.parse
+# asyncio, concurrent.futures, cProfile, hashlib, http.client, pstats and
+# socket are only imported where they are used because they account for most
+# of the import time of this module.
 
 import xdg.BaseDirectory
 import xdg.DesktopEntry
+import xdg.IniFile
+import xdg.Locale
 import xdg.Mime
 
 
@@ -73,6 +85,32 @@ import xdg.Mime
 NAME = 'Mimeo'
 MIMEO_DEFAULT_ARGUMENTS_FILE = 'default_arguments.txt'
 MIMEO_ASSOCIATIONS_FILE = 'associations.txt'
+MIMEO_SNAPSHOT_FILE = 'snapshot'
+
+# Increment this whenever the format of any snapshot entry changes.
+SNAPSHOT_VERSION = 1
+
+# Snapshot entry kinds.
+SNAPSHOT_DEFAULT_ARGUMENTS = 'default_arguments'
+SNAPSHOT_MIMEO_ASSOCIATIONS = 'mimeo_associations'
+SNAPSHOT_ASSOCIATIONS = 'associations'
+SNAPSHOT_KNOWNFILE = 'knownfile'
+SNAPSHOT_NAME_DETECTOR = 'name_detector'
+SNAPSHOT_UNHANDLED_MIMETYPES = 'unhandled_mimetypes'
+SNAPSHOT_UNCLASSIFIED_ARGS = 'unclassified_args'
+SNAPSHOT_XDG_OPEN_CONFIGURATION = 'xdg_open_configuration'
+
+# The name under which Mimeo acts as xdg-open, and its exit codes.
+XDG_OPEN_NAME = 'xdg-open'
+XDG_OPEN_USAGE = '''Usage:
+  xdg-open {{ file | URL }}
+  xdg-open {{ --help | --version }}
+
+This is {} acting as xdg-open. Run "{} --help" for all options.'''.format(NAME, NAME.lower())
+XDG_OPEN_SYNTAX_ERROR = 1
+XDG_OPEN_FILE_NOT_FOUND = 2
+XDG_OPEN_TOOL_NOT_FOUND = 3
+XDG_OPEN_ACTION_FAILED = 4
 
 # Files and paths
 MIMEAPPS_LIST_FILE = 'mimeapps.list'
@@ -84,6 +122,14 @@ DESKTOP_EXTENSION = '.desktop'
 # Name of current desktop for desktop-specific configuration.
 XDG_CURRENT_DESKTOP = 'XDG_CURRENT_DESKTOP'
 
+# Defaults of the XDG Base Directory Specification, relative to $HOME for the
+# user directories.
+XDG_DEFAULT_CONFIG_HOME = '.config'
+XDG_DEFAULT_DATA_HOME = os.path.join('.local', 'share')
+XDG_DEFAULT_CACHE_HOME = '.cache'
+XDG_DEFAULT_CONFIG_DIRS = '/etc/xdg'
+XDG_DEFAULT_DATA_DIRS = '/usr/local/share:/usr/share'
+
 # File sections
 ADDED_ASSOCIATIONS_SECTION = 'Added Associations'
 REMOVED_ASSOCIATIONS_SECTION = 'Removed Associations'
@@ -115,6 +161,28 @@ EXE_FILE = 'file'
 # URL scheme
 SCHEME_FILE = 'file'
 
+# Extended attributes for caching MIME-types of files. XATTR_MIME_TYPE is
+# defined by the shared MIME-info database specification. XATTR_MIME_TYPE_MTIME
+# holds the modification time of the file when Mimeo stored the MIME-type.
+XATTR_MIME_TYPE = 'user.mime_type'
+XATTR_MIME_TYPE_MTIME = 'user.mimeo.mtime'
+
+# Default time limit for determining the MIME-type of a file by content, in
+# seconds.
+DEFAULT_SNIFF_TIMEOUT = 3.0
+
+# URL content-type probing
+URL_PROBE_SCHEMES = ('http', 'https')
+URL_PROBE_TIMEOUT = 3.0
+URL_PROBE_TTL = 300
+URL_PROBE_MAX_REDIRECTS = 5
+URL_PROBE_POOL_SIZE = 2
+# Maximum number of idle connections kept across all hosts.
+URL_PROBE_MAX_IDLE = 8
+URL_PROBE_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+# Status codes that indicate that HEAD is not supported.
+URL_PROBE_HEAD_UNSUPPORTED_STATUSES = (405, 501)
+
 # MIME-types
 MIMETYPE_SCHEME_FMT = 'x-scheme-handler/{}'
 
@@ -135,21 +203,347 @@ EXEC_ESCAPED = '"`$\\'
 MATCHER_PREFIX_GLOB = 'glob:'
 MATCHER_PREFIX_REGEX = 'regex:'
 
+# Strings that look like MIME-types. The top-level type is checked separately
+# to avoid loading all known MIME-types for relative paths such as "a/b".
+MIMETYPE_LITERAL_REGEX = re.compile(r'^([a-z0-9][a-z0-9!#$&^_.+-]*)/[a-z0-9!#$&^_.+-]+(;.*)?$', re.I)
+MIMETYPE_TOP_LEVEL_TYPES = frozenset((
+  'application',
+  'audio',
+  'chemical',
+  'font',
+  'image',
+  'inode',
+  'message',
+  'model',
+  'multipart',
+  'text',
+  'video',
+  'x-content',
+  'x-epoc',
+  'x-scheme-handler',
+))
+
 MIMETYPES_KNOWNFILES_REGEX = re.compile('^\s*([^#\s]\S+\/\S+)')
 
+# Shared MIME-info database files, relative to the XDG data directories.
+MIME_GLOBS2_FILE = os.path.join('mime', 'globs2')
+MIME_ALIASES_FILE = os.path.join('mime', 'aliases')
+MIME_MAGIC_FILE = os.path.join('mime', 'magic')
+MIME_SUBCLASSES_FILE = os.path.join('mime', 'subclasses')
+MIME_GLOBS_NOGLOBS = '__NOGLOBS__'
+MIME_GLOBS_CASE_SENSITIVE_FLAG = 'cs'
+# Named groups and their references in the output of fnmatch.translate.
+NAME_DETECTOR_GROUP_REGEX = re.compile(r'\(\?P([<=])(\w+)')
+
 TERM_COMMAND_PLACEHOLDER = '%s'
 
+# The maximum number of compiled Exec and terminal command templates to keep.
+EXEC_TEMPLATE_CACHE_SIZE = 256
+
+# The maximum number of sets of XDG directories (e.g. profiles) for which
+# compiled MIME-type databases are kept.
+XDG_DATABASE_CACHE_SIZE = 8
+
+# Kinds of compiled Exec words.
+EXEC_WORD_LITERAL = 0
+EXEC_WORD_ICON = 1
+EXEC_WORD_FILES = 2
+EXEC_WORD_URLS = 3
+EXEC_WORD_FILE = 4
+EXEC_WORD_URL = 5
+EXEC_WORD_PARTS = 6
+
+# Kinds of compiled terminal command words.
+TERM_WORD_LITERAL = 0
+TERM_WORD_CMD = 1
+TERM_WORD_PARTS = 2
+
 ASSOCIATION_MODIFICATION_METAVAR = ('<MIME-type matcher | filepath | desktop file>', '<desktop file>')
 
+# Profiling
+PROFILE_SORT_KEY = 'cumulative'
+PROFILE_DEFAULT_LIMIT = 25
+
+# Default memory budget of the caches of a Mimeo instance, in bytes.
+DEFAULT_CACHE_BUDGET = 64 * 1024 * 1024
+
+# Maximum number of worker threads of the executor shared by AsyncMimeo.
+ASYNC_MAX_WORKERS = 8
+
+# Output formats
+OUTPUT_JSON = 'json'
+OUTPUT_NDJSON = 'ndjson'
+
+# Record keys for JSON output.
+RECORD_ARG = 'arg'
+RECORD_ARGS = 'args'
+RECORD_COMMAND = 'command'
+RECORD_DESKTOP = 'desktop'
+RECORD_EXECUTABLE = 'executable'
+RECORD_ICON = 'icon'
+RECORD_MIMETYPE = 'mimetype'
+RECORD_PATH = 'path'
+RECORD_CHECK = 'check'
+RECORD_SEVERITY = 'severity'
+RECORD_SECTION = 'section'
+RECORD_REASON = 'reason'
+RECORD_SHADOWED = 'shadowed'
+
+# Checks of the association doctor and the severities of their findings.
+DOCTOR_INVALID_DESKTOP = 'invalid_desktop'
+DOCTOR_MISSING_DESKTOP = 'missing_desktop'
+DOCTOR_UNRESOLVABLE_EXEC = 'unresolvable_exec'
+DOCTOR_UNRESOLVABLE_TRYEXEC = 'unresolvable_tryexec'
+DOCTOR_STALE_MIMEINFO_CACHE = 'stale_mimeinfo_cache'
+DOCTOR_SHADOWED_DESKTOP = 'shadowed_desktop'
+SEVERITY_ERROR = 'error'
+SEVERITY_WARNING = 'warning'
+SEVERITY_INFO = 'info'
+
+# Desktop entries are parsed by a process pool when the doctor finds at least
+# this many. Each worker receives chunks of at least DOCTOR_MIN_CHUNK_SIZE.
+DOCTOR_PARALLEL_THRESHOLD = 512
+DOCTOR_MIN_CHUNK_SIZE = 32
+
+# Names of the timed resolution stages, in pipeline order.
+STAGE_CLASSIFY = 'classify'
+STAGE_CUSTOM_ASSOCIATIONS = 'custom_associations'
+STAGE_SNIFF_CONTENT = 'sniff_content'
+STAGE_SNIFF_NAME = 'sniff_name'
+STAGE_KNOWN_MIMETYPES = 'known_mimetypes'
+STAGE_ASSOCIATION_CASCADE = 'association_cascade'
+STAGE_DESKTOP_ENTRY = 'desktop_entry'
+STAGE_EXEC_INTERPOLATION = 'exec_interpolation'
+STAGE_EXTRACT = 'extract'
+STAGE_SPAWN = 'spawn'
+
+# Names of counters.
+COUNTER_NEGATIVE_CACHE_HITS = 'negative_cache_hits'
+COUNTER_COALESCED_LAUNCHES = 'coalesced_launches'
+COUNTER_SNIFF_DEADLINES = 'sniff_deadlines'
+COUNTER_XATTR_HITS = 'xattr_hits'
+COUNTER_EXTRACT_CACHE_HITS = 'extract_cache_hits'
+
+# Filesystem sniffing policies. Files on network filesystems are only
+# classified by name because reading them may be slow or trigger remote
+# fetches. Files on other FUSE filesystems are classified by name first.
+MOUNTINFO_PATH = '/proc/self/mountinfo'
+FS_POLICY_NAME_ONLY = 'name_only'
+FS_POLICY_NAME_FIRST = 'name_first'
+FS_TYPE_POLICIES = dict(itertools.chain(
+  (
+    (t, FS_POLICY_NAME_ONLY) for t in (
+      '9p',
+      'afs',
+      'ceph',
+      'cifs',
+      'coda',
+      'davfs',
+      'fuse.davfs2',
+      'fuse.gcsfuse',
+      'fuse.rclone',
+      'fuse.s3fs',
+      'fuse.sshfs',
+      'glusterfs',
+      'ncpfs',
+      'nfs',
+      'nfs4',
+      'smb3',
+      'smbfs',
+      'sshfs',
+    )
+  ),
+  (
+    (t, FS_POLICY_NAME_FIRST) for t in (
+      'fuse',
+      'fuseblk',
+    )
+  )
+))
+# Policy for FUSE filesystem types that are not listed above, e.g. "fuse.foo".
+FS_FUSE_PREFIX = 'fuse.'
+FS_FUSE_POLICY = FS_POLICY_NAME_FIRST
+
+# Archive members. Arguments such as "archive.zip#dir/file" refer to files in
+# archives, which are extracted on demand to a size-bounded cache.
+ARCHIVE_ZIP = 'zip'
+ARCHIVE_TAR = 'tar'
+ARCHIVE_SCHEMES = (ARCHIVE_ZIP, ARCHIVE_TAR)
+ARCHIVE_MEMBER_SEP = '#'
+EXTRACT_DIR = 'extract'
+DEFAULT_EXTRACT_CACHE_SIZE = 512 * 1024 * 1024
+
+# Data on STDIN is passed with this argument.
+STDIN_ARG = '-'
+STDIN_CHUNK_SIZE = 64 * 1024
+STDIN_SPOOL_NAME = 'stdin'
+# Replaces the unknown hash directory in the path of STDIN data that would be
+# saved to the extraction cache when commands are only printed.
+STDIN_SPOOL_PLACEHOLDER = '<sha1-of-stdin>'
+STDIN_FD_PATH_FMT = '/proc/self/fd/{:d}'
+STDIN_DEV_FD_FMT = '/dev/fd/{:d}'
+# Once all applications have exited, feeding their STDIN is abandoned after
+# this many seconds, e.g. if a daemon that they started keeps it open.
+STDIN_WAIT_GRACE = 1.0
+STDIN_WAIT_INTERVAL = 0.1
+
+# Launch coalescing.
+LAUNCHES_FILE = 'launches'
+DEFAULT_COALESCE_WINDOW = 0.5
+
+# Desktop entry index for --launcher and --search.
+DESKTOP_INDEX_FILE = 'desktop_index'
+DESKTOP_INDEX_VERSION = 1
+DESKTOP_INDEX_TOKEN_REGEX = re.compile(r'\w+')
+# Search weights of indexed desktop entry fields. Exact token matches count
+# twice as much as prefix matches.
+DESKTOP_INDEX_NAME_WEIGHT = 8
+DESKTOP_INDEX_GENERIC_NAME_WEIGHT = 4
+DESKTOP_INDEX_KEYWORDS_WEIGHT = 2
+DESKTOP_INDEX_EXEC_WEIGHT = 1
+
+# Icon theme lookup for --launcher and --desk2icon.
+ICON_INDEX_FILE = 'icon_index'
+ICON_INDEX_VERSION = 2
+ICON_HOME_DIR = '.icons'
+ICON_DATA_DIR = 'icons'
+ICON_PIXMAPS_DIR = '/usr/share/pixmaps'
+ICON_THEME_INDEX = 'index.theme'
+ICON_THEME_FALLBACK = 'hicolor'
+# In order of preference.
+ICON_EXTENSIONS = ('.png', '.svg', '.xpm')
+ICON_GTK_SETTINGS = ('gtk-3.0', 'settings.ini')
+ICON_GTK_THEME_KEY = 'gtk-icon-theme-name'
+DEFAULT_ICON_SIZE = 48
+
+# Rofi script mode.
+ROFI_RETV = 'ROFI_RETV'
+ROFI_INFO = 'ROFI_INFO'
+ROFI_ROW_FMT = '{}\0icon\x1f{}\x1finfo\x1f{}'
+
+
+
+################################# Environment ##################################
+
+class XDGEnvironment(collections.namedtuple(
+  'XDGEnvironment',
+  (
+    'home',
+    'config_home',
+    'config_dirs',
+    'data_home',
+    'data_dirs',
+    'cache_home',
+    'current_desktop',
+    'path',
+  )
+)):
+  '''
+  The XDG base directories and environment variables that determine how
+  arguments are resolved. config_dirs and data_dirs begin with config_home and
+  data_home, respectively, as in xdg.BaseDirectory. Instances can be passed to
+  Mimeo to resolve associations for other users or containers without
+  modifying the process environment.
+  '''
+  __slots__ = ()
+
+  def current_desktops(self):
+    '''
+    Get the names of the current desktop.
+    '''
+    return self.current_desktop.split(':') if self.current_desktop else []
+
+
+
+  def exec_path(self):
+    '''
+    Get the directories of the executable search path.
+    '''
+    return self.path.split(os.pathsep) if self.path else []
+
+
+
+def xdg_environment(environ=None):
+  '''
+  Create an XDGEnvironment from a mapping of environment variables, using the
+  defaults of the XDG Base Directory Specification for missing variables. If
+  environ is None then the current state of xdg.BaseDirectory and the process
+  environment are used.
+  '''
+  if environ is None:
+    return XDGEnvironment(
+      home=os.path.expanduser('~'),
+      config_home=xdg.BaseDirectory.xdg_config_home,
+      config_dirs=tuple(xdg.BaseDirectory.xdg_config_dirs),
+      data_home=xdg.BaseDirectory.xdg_data_home,
+      data_dirs=tuple(xdg.BaseDirectory.xdg_data_dirs),
+      cache_home=xdg.BaseDirectory.xdg_cache_home,
+      current_desktop=os.getenv(XDG_CURRENT_DESKTOP, ''),
+      path=os.getenv('PATH', os.defpath),
+    )
+  home = environ.get('HOME') or os.path.expanduser('~')
+  config_home = environ.get('XDG_CONFIG_HOME') or \
+    os.path.join(home, XDG_DEFAULT_CONFIG_HOME)
+  data_home = environ.get('XDG_DATA_HOME') or \
+    os.path.join(home, XDG_DEFAULT_DATA_HOME)
+  config_dirs = environ.get('XDG_CONFIG_DIRS') or XDG_DEFAULT_CONFIG_DIRS
+  data_dirs = environ.get('XDG_DATA_DIRS') or XDG_DEFAULT_DATA_DIRS
+  return XDGEnvironment(
+    home=home,
+    config_home=config_home,
+    config_dirs=(config_home,) + tuple(d for d in config_dirs.split(':') if d),
+    data_home=data_home,
+    data_dirs=(data_home,) + tuple(d for d in data_dirs.split(':') if d),
+    cache_home=environ.get('XDG_CACHE_HOME') or \
+      os.path.join(home, XDG_DEFAULT_CACHE_HOME),
+    current_desktop=environ.get(XDG_CURRENT_DESKTOP, ''),
+    path=environ.get('PATH', os.defpath),
+  )
+
+
+
+def load_data_paths(resource, env=None):
+  '''
+  Iterate over the existing paths to a resource in the data directories, most
+  important first. This is xdg.BaseDirectory.load_data_paths for an
+  XDGEnvironment.
+  '''
+  if env is None:
+    env = xdg_environment()
+  for d in env.data_dirs:
+    path = os.path.join(d, resource)
+    if os.path.exists(path):
+      yield path
+
+
+
+def mime_database_paths(env=None):
+  '''
+  Iterate over the paths to the shared MIME-info database files in the data
+  directories, whether they exist or not.
+  '''
+  if env is None:
+    env = xdg_environment()
+  for d in env.data_dirs:
+    for resource in (
+      MIME_GLOBS2_FILE,
+      MIME_ALIASES_FILE,
+      MIME_MAGIC_FILE,
+      MIME_SUBCLASSES_FILE
+    ):
+      yield os.path.join(d, resource)
+
 
 
 ############################### Config Functions ###############################
 
-def default_mimeo_associations_paths():
+def default_mimeo_associations_paths(env=None):
   '''
   Paths to check for custom Mimeo associations.
   '''
-  for dpath in xdg.BaseDirectory.xdg_config_dirs:
+  if env is None:
+    env = xdg_environment()
+  for dpath in env.config_dirs:
     yield os.path.join(
       dpath,
       NAME.lower(),
@@ -171,11 +565,22 @@ def default_arguments_path():
 
 
 
-def default_arguments():
+def default_snapshot_path():
   '''
-  Load default arguments from default_arguments_path().
+  The path to the snapshot of parsed configuration files.
+  '''
+  return os.path.join(
+    xdg.BaseDirectory.xdg_cache_home,
+    NAME.lower(),
+    MIMEO_SNAPSHOT_FILE
+  )
+
+
+
+def load_default_arguments(path):
+  '''
+  Load default arguments from a file.
   '''
-  path = default_arguments_path()
   logging.debug('loading arguments from {}'.format(path))
   try:
     with open(path, 'r') as f:
@@ -185,6 +590,23 @@ def default_arguments():
 
 
 
+def default_arguments(snapshot=None):
+  '''
+  Load default arguments from default_arguments_path(), possibly from the
+  snapshot.
+  '''
+  path = default_arguments_path()
+  if snapshot is None:
+    return load_default_arguments(path)
+  else:
+    return snapshot.get(
+      SNAPSHOT_DEFAULT_ARGUMENTS,
+      (path,),
+      lambda: load_default_arguments(path)
+    )
+
+
+
 ################################## Debugging ###################################
 
 def logging_debug_and_yield(msg, lst):
@@ -194,11 +616,166 @@ def logging_debug_and_yield(msg, lst):
   building an intermediate list or tuple.
   '''
   for item in lst:
-    logging.debug('{}: {}'.format(msg, item))
+    logging.debug('%s: %s', msg, item)
     yield item
 
 
 
+@contextlib.contextmanager
+def profiled(path=None, limit=PROFILE_DEFAULT_LIMIT):
+  '''
+  Profile the enclosed block with cProfile. If path is given, the raw pstats
+  data is dumped to it for later inspection (e.g. with "python -m pstats").
+  Otherwise the top entries sorted by cumulative time are printed to STDERR.
+  '''
+  import cProfile
+  import pstats
+  profile = cProfile.Profile()
+  profile.enable()
+  try:
+    yield profile
+  finally:
+    profile.disable()
+    if path:
+      logging.debug('saving profile to {}'.format(path))
+      profile.dump_stats(path)
+    else:
+      stats = pstats.Stats(profile, stream=sys.stderr)
+      stats.sort_stats(PROFILE_SORT_KEY).print_stats(limit)
+
+
+
+################################ Instrumentation ###############################
+
+class NullStage(object):
+  '''
+  Context manager that does nothing. It is returned for all stages when timing
+  is disabled so that the instrumented code only pays for a method call.
+  '''
+  def __enter__(self):
+    return self
+
+
+
+  def __exit__(self, typ, value, traceback):
+    return False
+
+
+
+NULL_STAGE = NullStage()
+
+
+
+class TimedStage(object):
+  '''
+  Context manager that adds the elapsed time of its block to a StageTimer.
+  '''
+  def __init__(self, timer, name):
+    self.timer = timer
+    self.name = name
+    self.start = None
+
+
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+
+
+  def __exit__(self, typ, value, traceback):
+    self.timer.add(self.name, time.perf_counter() - self.start)
+    return False
+
+
+
+class StageTimer(object):
+  '''
+  Accumulate the time spent in named resolution stages. Stages may be nested,
+  in which case the time of the inner stage is also included in the outer one.
+  Counters record events such as expired deadlines and are always updated.
+  Updates are locked because stages may be timed in several threads.
+  '''
+  def __init__(self):
+    self.enabled = False
+    self.start = None
+    self.seconds = collections.OrderedDict()
+    self.calls = collections.OrderedDict()
+    self.counters = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+
+
+  def enable(self):
+    self.enabled = True
+    self.start = time.perf_counter()
+
+
+
+  def stage(self, name):
+    '''
+    Return a context manager for timing the named stage.
+    '''
+    if self.enabled:
+      return TimedStage(self, name)
+    else:
+      return NULL_STAGE
+
+
+
+  def add(self, name, seconds):
+    with self.lock:
+      try:
+        self.seconds[name] += seconds
+        self.calls[name] += 1
+      except KeyError:
+        self.seconds[name] = seconds
+        self.calls[name] = 1
+
+
+
+  def count(self, name, n=1):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + n
+
+
+
+  def report(self):
+    '''
+    Return the collected timings as a JSON-serializable dict.
+    '''
+    report = collections.OrderedDict()
+    if self.start is not None:
+      report['total'] = time.perf_counter() - self.start
+    with self.lock:
+      report['stages'] = collections.OrderedDict(
+        (name, {'calls' : self.calls[name], 'seconds' : seconds})
+        for name, seconds in self.seconds.items()
+      )
+      report['counters'] = collections.OrderedDict(self.counters)
+    return report
+
+
+
+  def write(self, path=None):
+    '''
+    Write the report as a single JSON line. If path is given, the line is
+    appended to the file, otherwise it is printed to STDERR.
+    '''
+    line = json.dumps(self.report())
+    if path:
+      logging.debug('appending timings to {}'.format(path))
+      with open(path, 'a') as f:
+        f.write(line + '\n')
+    else:
+      print(line, file=sys.stderr)
+
+
+
+STAGE_TIMER = StageTimer()
+
+
+
 ############################## Generic Functions ###############################
 
 def quote_cmd(cmd):
@@ -209,9 +786,10 @@ def quote_cmd(cmd):
 
 
 
-def run_cmd(cmd, quiet=False):
+def run_cmd(cmd, quiet=False, stdin=None):
   '''
-  Start a command without waiting for it to finish.
+  Start a command without waiting for it to finish. stdin is passed through to
+  subprocess.Popen. The Popen object is returned.
   '''
   if quiet:
     kwargs = {
@@ -221,7 +799,8 @@ def run_cmd(cmd, quiet=False):
   else:
     kwargs = dict()
   logging.debug(quote_cmd(cmd))
-  subprocess.Popen(cmd, close_fds=True, **kwargs)
+  with STAGE_TIMER.stage(STAGE_SPAWN):
+    return subprocess.Popen(cmd, close_fds=True, stdin=stdin, **kwargs)
 
 
 def interpolate_term_cmd(term_cmd, app_cmd):
@@ -229,46 +808,23 @@ def interpolate_term_cmd(term_cmd, app_cmd):
   Interpolate a terminal command, given as a single string, with the given
   application command.
   '''
-  seen = False
-  app_cmd_word = ' '.join(shlex.quote(w) for w in app_cmd)
-  for word in shlex.split(term_cmd):
-    if word == TERM_COMMAND_PLACEHOLDER:
-      seen = True
-      yield from app_cmd
-    elif word == '\'{}\''.format(TERM_COMMAND_PLACEHOLDER):
-      seen = True
-      yield app_cmd_word
-    else:
-      iword = ''
-      escaped = False
-      for c in word:
-        if escaped:
-          if c == TERM_COMMAND_PLACEHOLDER[1]:
-            iword += app_cmd_word
-          else:
-            iword += c
-          escaped = False
-        elif c == TERM_COMMAND_PLACEHOLDER[0]:
-          escaped = True
-          continue
-        else:
-          iword += c
-      yield iword
+  yield from term_template(term_cmd).fill(app_cmd)
 
 
 
-def which(cmd):
+def which(cmd, env=None):
   '''
-  Emulate the system command "which".
+  Emulate the system command "which". The executable search path of the
+  XDGEnvironment is used if one is given.
   '''
   if not cmd:
     return None
   elif os.path.isabs(cmd):
     return cmd
   else:
-    for p in os.get_exec_path():
+    for p in (env.exec_path() if env else os.get_exec_path()):
       fpath = os.path.join(p, cmd)
-      logging.debug('which: {}'.format(fpath))
+      logging.debug('which: %s', fpath)
       if os.path.isfile(fpath) and os.access(fpath, os.X_OK):
         return fpath
     else:
@@ -311,12 +867,14 @@ def ensure_url(arg):
 
 
 
-def ensure_path(arg):
+def ensure_path(arg, parsed_url=None):
   '''
   Ensure that the argument is a path. If it is a URL, only the path part will
-  be returned.
+  be returned. The result of urllib.parse.urlparse may be passed to avoid
+  parsing the argument again.
   '''
-  parsed_url = urllib.parse.urlparse(arg)
+  if parsed_url is None:
+    parsed_url = urllib.parse.urlparse(arg)
   # Not a URL. Return the argument directly.
   if not (parsed_url.scheme or parsed_url.netloc):
     return arg
@@ -325,6 +883,7 @@ def ensure_path(arg):
   if parsed_url.scheme == SCHEME_FILE:
     # Keep this here to avoid getfqdn calls for non-"file" URLs, which have been
     # reported to be slow on some systems.
+    import socket
     localhost = socket.getfqdn(socket.gethostname())
     hostname = parsed_url.hostname if parsed_url.hostname else 'localhost'
     remotehost = socket.getfqdn(hostname)
@@ -335,6 +894,23 @@ def ensure_path(arg):
 
 
 
+def stat_signature(path, follow_symlinks=True):
+  '''
+  Return a tuple that changes when the file at the given path changes, or None
+  if the file does not exist.
+  '''
+  try:
+    st = os.stat(path, follow_symlinks=follow_symlinks)
+  except (FileNotFoundError, NotADirectoryError):
+    return None
+  except OSError as e:
+    logging.debug('stat_signature: [{}]'.format(e))
+    return None
+  else:
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+
 def ensure_desktop_names(args):
   '''
   Add the desktop extension if it is missing.
@@ -345,6 +921,36 @@ def ensure_desktop_names(args):
 
 
 
+def save_atomically(path, data):
+  '''
+  Write bytes to a file by replacing it so that concurrent readers never see a
+  partial file. Errors are logged.
+  '''
+  logging.debug('saving {}'.format(path))
+  tmp_path = '{}.{:d}.{:d}'.format(path, os.getpid(), threading.get_ident())
+  try:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(tmp_path, 'wb') as f:
+      f.write(data)
+    os.replace(tmp_path, path)
+  except OSError as e:
+    logging.warning('failed to save {}: {}'.format(path, e))
+
+
+
+def current_desktops(env=None):
+  '''
+  Get the names of the current desktop as defined in the XDG_CURRENT_DESKTOP
+  environment variable or the given XDGEnvironment.
+  '''
+  if env is None:
+    desktop = os.getenv(XDG_CURRENT_DESKTOP)
+    return desktop.split(':') if desktop else []
+  else:
+    return env.current_desktops()
+
+
+
 def swap_a_and_b(itr):
   '''
   Swap the items in a pair iterator.
@@ -370,16 +976,25 @@ def apply_func(itr, fa=None, fb=None):
 def collect_b_by_a(itr, unique_b=True, preserve_order=True):
   '''
   Iterate over a list of 2-tuples and accumulate the second item into a
-  dictionary with the first item as the key.
+  dictionary with the first item as the key. Uniqueness is checked with a set
+  of pairs unless the second item is unhashable.
   '''
   if preserve_order:
     b_by_a = collections.OrderedDict()
   else:
     b_by_a = dict()
+  seen = set()
   for a, b in itr:
+    if unique_b:
+      try:
+        if (a, b) in seen:
+          continue
+        seen.add((a, b))
+      except TypeError:
+        if b in b_by_a.get(a, ()):
+          continue
     try:
-      if not unique_b or b not in b_by_a[a]:
-        b_by_a[a].append(b)
+      b_by_a[a].append(b)
     except KeyError:
       b_by_a[a] = [b]
   return b_by_a
@@ -428,6 +1043,161 @@ def print_collection(a_by_b, order=None, sort_a=False, sort_b=False):
 
 
 
+def stream_collection(a_to_b, order=None, sort_b=False):
+  '''
+  Print pairs to STDOUT in the format of print_collection as they are
+  produced. Pairs with the same first item are expected to be consecutive.
+  Otherwise the first item is printed again. Duplicate pairs are skipped.
+
+  If the order is given then the pairs are expected to follow it and each
+  occurrence of an item in it is printed in its place with all of the second
+  items of the item, as with print_collection, including repeated items and
+  items without pairs. If sort_b is True then the second items are sorted per
+  first item, which delays each group until it is complete but never the whole
+  collection.
+
+  >>> stream_collection(
+  ...   [('a', 1), ('x', None), ('a', 1), ('a', 1)],
+  ...   order=['a', 'x', 'a', 'a']
+  ... )
+  a
+    1
+  x
+    None
+  a
+    1
+  a
+    1
+  '''
+  # Second items per first item. Without an order only the current group is
+  # kept.
+  groups = dict()
+  seen = set()
+  # Second items of the current group that are delayed for sorting.
+  group = list()
+  current = None
+  started = False
+  pending = collections.deque(order) if order else collections.deque()
+
+  def flush_group():
+    for b in sorted(group):
+      print('  {}'.format(b))
+    group.clear()
+    sys.stdout.flush()
+
+  def start_group(a):
+    print(a)
+    bs = groups.setdefault(a, [])
+    if sort_b:
+      group.extend(bs)
+    else:
+      for b in bs:
+        print('  {}'.format(b))
+
+  for a, b in a_to_b:
+    if not started or a != current:
+      flush_group()
+      if not order:
+        groups.clear()
+        seen.clear()
+      if a in pending:
+        for x in iter(pending.popleft, a):
+          start_group(x)
+          flush_group()
+      start_group(a)
+      current = a
+      started = True
+    try:
+      if (a, b) in seen:
+        continue
+      seen.add((a, b))
+    except TypeError:
+      if b in groups[a]:
+        continue
+    groups[a].append(b)
+    if sort_b:
+      group.append(b)
+    else:
+      print('  {}'.format(b))
+  flush_group()
+  for x in pending:
+    start_group(x)
+    flush_group()
+
+
+
+def pairs_to_records(a_to_b, keys, fa=None, fb=None, swap=False):
+  '''
+  Convert pairs to dicts with the given pair of keys. Duplicate pairs are
+  skipped. The records are returned as they are produced.
+  '''
+  if fa or fb:
+    a_to_b = apply_func(a_to_b, fa=fa, fb=fb)
+  if swap:
+    a_to_b = swap_a_and_b(a_to_b)
+    keys = keys[::-1]
+  key_a, key_b = keys
+  seen = set()
+  for a, b in a_to_b:
+    if (a, b) not in seen:
+      seen.add((a, b))
+      yield collections.OrderedDict(((key_a, a), (key_b, b)))
+
+
+
+def print_records(records, output_format):
+  '''
+  Print records to STDOUT as a JSON array or as newline-delimited JSON. Each
+  newline-delimited record is flushed as soon as it is printed so that the
+  output can be consumed in a pipeline.
+  '''
+  if output_format == OUTPUT_NDJSON:
+    for r in records:
+      print(json.dumps(r), flush=True)
+  else:
+    print(json.dumps(list(records)))
+
+
+
+def print_pairs(a_to_b, keys, output_format=None, fa=None, fb=None, swap=False, stream=False, **kwargs):
+  '''
+  Print pairs either as JSON records or as a collection. Additional keyword
+  arguments are passed through to print_collection. If stream is True then
+  the collection is printed with stream_collection, except when swapped
+  because the swapped pairs are not grouped. sort_a is ignored when streaming
+  and the first items are printed in the order in which they are produced.
+  '''
+  if output_format:
+    print_records(
+      pairs_to_records(a_to_b, keys, fa=fa, fb=fb, swap=swap),
+      output_format
+    )
+  elif stream and not swap:
+    if fa or fb:
+      a_to_b = apply_func(a_to_b, fa=fa, fb=fb)
+    stream_collection(
+      a_to_b,
+      order=kwargs.get('order'),
+      sort_b=kwargs.get('sort_b', False)
+    )
+  else:
+    b_by_a = modify_and_collect(a_to_b, fa=fa, fb=fb, swap=swap)
+    print_collection(b_by_a, **kwargs)
+
+
+
+def print_values(values, key, output_format=None):
+  '''
+  Print values either as JSON records or one per line.
+  '''
+  if output_format:
+    print_records(({key : v} for v in values), output_format)
+  else:
+    for v in values:
+      print(v)
+
+
+
 ########################### Mimeo Associations File ############################
 
 def parse_mimeo_associations(fpath):
@@ -469,6 +1239,135 @@ def args_to_custom_cmds(mimeo_assocs, args, at_least_one=False, first_only=False
 
 
 
+################################# Filesystems ##################################
+
+def unescape_mountinfo(field):
+  '''
+  Unescape the octal escapes of spaces, tabs, newlines and backslashes in
+  mountinfo fields.
+  '''
+  return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+
+class MountTable(object):
+  '''
+  Filesystem types of the mounts in /proc/self/mountinfo. Devices are matched
+  by their major and minor numbers. Paths on devices that do not match any
+  mount, e.g. btrfs subvolumes, are matched by their longest mount point
+  prefix.
+  '''
+  def __init__(self, path=MOUNTINFO_PATH):
+    # st_dev -> filesystem type
+    self.devices = dict()
+    # (mount point, filesystem type), longest first
+    self.mount_points = list()
+    try:
+      with open(path, 'r') as f:
+        logging.debug('loading {}'.format(path))
+        for line in f:
+          self.add_line(line)
+    except OSError as e:
+      logging.debug('failed to load {}: {}'.format(path, e))
+    self.mount_points.sort(key=lambda x: len(x[0]), reverse=True)
+
+
+
+  def add_line(self, line):
+    '''
+    Add a mount from a mountinfo line:
+
+      36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+
+    '''
+    try:
+      fields, super_fields = line.split(' - ', 1)
+      fields = fields.split()
+      major, minor = fields[2].split(':')
+      mount_point = unescape_mountinfo(fields[4])
+      fstype = super_fields.split()[0]
+      dev = os.makedev(int(major), int(minor))
+    except (ValueError, IndexError):
+      logging.debug('failed to parse mountinfo line: {}'.format(line))
+      return
+    # Later mounts hide earlier mounts on the same mount point.
+    self.devices[dev] = fstype
+    self.mount_points.append((mount_point, fstype))
+
+
+
+  def fstype(self, dev, path):
+    '''
+    Get the filesystem type of a path on the given device.
+    '''
+    try:
+      return self.devices[dev]
+    except KeyError:
+      pass
+    path = os.path.abspath(path)
+    for mount_point, fstype in self.mount_points:
+      if path == mount_point \
+      or path.startswith(mount_point.rstrip(os.sep) + os.sep):
+        return fstype
+    return None
+
+
+
+MOUNT_TABLE = None
+# st_dev -> policy
+FS_POLICIES = dict()
+FS_POLICIES_LOCK = threading.Lock()
+
+def fs_policy(dev, path):
+  '''
+  Get the sniffing policy for a path on the given device, or None if the
+  filesystem does not require one. The mount table is loaded on first use and
+  the policy is determined once per device.
+  '''
+  global MOUNT_TABLE
+  try:
+    return FS_POLICIES[dev]
+  except KeyError:
+    pass
+  with FS_POLICIES_LOCK:
+    try:
+      return FS_POLICIES[dev]
+    except KeyError:
+      pass
+    if MOUNT_TABLE is None:
+      MOUNT_TABLE = MountTable()
+    fstype = MOUNT_TABLE.fstype(dev, path)
+    if fstype is None:
+      policy = None
+    else:
+      policy = FS_TYPE_POLICIES.get(fstype)
+      if policy is None and fstype.startswith(FS_FUSE_PREFIX):
+        policy = FS_FUSE_POLICY
+    logging.debug('filesystem of {}: {} (policy: {})'.format(path, fstype, policy))
+    FS_POLICIES[dev] = policy
+  return policy
+
+
+
+def apply_fs_policy(dev, path, content_first, content_only, name_only, sniff_timeout=None):
+  '''
+  Override the content_first, content_only and name_only flags with the
+  sniffing policy of the filesystem and return them with the sniffing timeout.
+  The timeout only applies to filesystems with a policy so that sniffing on
+  local filesystems does not start a thread per file.
+  '''
+  policy = fs_policy(dev, path)
+  if policy == FS_POLICY_NAME_ONLY:
+    return False, False, True, None
+  elif policy == FS_POLICY_NAME_FIRST and not name_only:
+    return False, False, False, sniff_timeout
+  elif policy is None:
+    return content_first, content_only, name_only, None
+  else:
+    return content_first, content_only, name_only, sniff_timeout
+
+
+
 ################################## MIME-types ##################################
 
 def parse_mimetype(mimetype):
@@ -510,9 +1409,13 @@ def strip_mimetype(mimetype):
 
 
 @unique_items
-def mimetypes_from_path(arg, follow_symlinks=True, content_first=True, content_only=False, name_only=False):
+def mimetypes_from_path(arg, follow_symlinks=True, content_first=True, content_only=False, name_only=False, file_cmd=None, env=None, use_fs_policy=False, sniff_timeout=None, read_xattr=False, write_xattr=False):
   '''
-  Attempt to determine the MIME-type of the argument.
+  Attempt to determine the MIME-type of the argument. The name detector of the
+  data directories of env is used if it is given. If use_fs_policy is True then
+  the sniffing policy of the filesystem overrides the content and name flags
+  and sniff_timeout only applies to filesystems with a policy. See
+  file_mimetype for sniff_timeout, read_xattr and write_xattr.
   '''
   try:
     if follow_symlinks:
@@ -520,12 +1423,12 @@ def mimetypes_from_path(arg, follow_symlinks=True, content_first=True, content_o
     else:
       st = os.lstat(arg)
   except FileNotFoundError:
-    mimetype = file_mimetype_by_name(arg)
+    mimetype = file_mimetype_by_name(arg, env=env)
     if mimetype:
       yield mimetype
   except PermissionError as e:
     logging.error('mimetypes_from_path: [{}]'.format(e))
-    mimetype = file_mimetype_by_name(arg)
+    mimetype = file_mimetype_by_name(arg, env=env)
     if mimetype:
       yield mimetype
   else:
@@ -543,11 +1446,20 @@ def mimetypes_from_path(arg, follow_symlinks=True, content_first=True, content_o
     elif stat.S_ISLNK(mode):
       yield MIMETYPE_SYMLINK
     elif stat.S_ISREG(mode):
+      if use_fs_policy:
+        content_first, content_only, name_only, sniff_timeout = apply_fs_policy(
+          st.st_dev, arg, content_first, content_only, name_only, sniff_timeout
+        )
       for m in file_mimetype(
         arg,
         content_first=content_first,
         content_only=content_only,
         name_only=name_only,
+        file_cmd=file_cmd,
+        env=env,
+        sniff_timeout=sniff_timeout,
+        read_xattr=read_xattr,
+        write_xattr=write_xattr,
       ):
         yield m
     else:
@@ -556,60 +1468,761 @@ def mimetypes_from_path(arg, follow_symlinks=True, content_first=True, content_o
 
 
 @unique_items
-def file_mimetype(path, content_first=True, content_only=False, name_only=False):
+def file_mimetype(path, content_first=True, content_only=False, name_only=False, file_cmd=None, env=None, sniff_timeout=None, read_xattr=False, write_xattr=False):
   '''
-  Attempt to determine the MIME-type of a regular (existing) file.
+  Attempt to determine the MIME-type of a regular (existing) file. See
+  file_mimetype_by_content for file_cmd, sniff_timeout, read_xattr and
+  write_xattr and file_mimetype_by_name for env. If content sniffing exceeds
+  sniff_timeout then the MIME-type is determined by name, even if content_only
+  is True.
   '''
-  rpath = os.path.realpath(path)
+  if file_cmd or sniff_timeout or read_xattr or write_xattr:
+    by_content = functools.partial(
+      file_mimetype_by_content,
+      file_cmd=file_cmd,
+      timeout=sniff_timeout,
+      read_xattr=read_xattr,
+      write_xattr=write_xattr
+    )
+  else:
+    by_content = file_mimetype_by_content
+  if env is None:
+    by_name = file_mimetype_by_name
+  else:
+    by_name = functools.partial(file_mimetype_by_name, env=env)
   if content_only:
-    fs = (file_mimetype_by_content,)
+    fs = (by_content,)
   elif name_only:
-    fs = (file_mimetype_by_name,)
+    fs = (by_name,)
   elif content_first:
-    fs = (file_mimetype_by_content, file_mimetype_by_name)
+    fs = (by_content, by_name)
   else:
-    fs = (file_mimetype_by_name, file_mimetype_by_content)
+    fs = (by_name, by_content)
   for f in fs:
     try:
       mimetype = f(path)
     except FileNotFoundError:
       logging.warning('file not found: {}'.format(path))
+    except SniffDeadlineExpired:
+      logging.warning('determining the MIME-type of {} by content took longer than {:g} s'.format(path, sniff_timeout))
+      # The name is not checked otherwise.
+      if content_only:
+        mimetype = by_name(path)
+        if mimetype:
+          yield mimetype
     else:
       if mimetype:
         yield mimetype
 
 
 
-def file_mimetype_by_content(path):
+class SniffDeadlineExpired(Exception):
   '''
-  Attempt to determine the MIME-type of a regular (existing) file by content.
+  Content sniffing did not finish before its deadline.
   '''
-  mimetype = None
-  mt = xdg.Mime.get_type_by_contents(path)
-  if mt:
-    mimetype = '{}/{}'.format(mt.media, mt.subtype)
-  if not mimetype:
-    cmd = [EXE_FILE, '--mime-type', path]
-    cp = subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
-    mimetype = cp.stdout.rsplit(b': ', 1)[-1].strip().decode()
-  return mimetype
+  pass
+
+
+
+def call_with_deadline(timeout, func, *args, **kwargs):
+  '''
+  Call a function in a daemon thread and return its result or raise its
+  exception. If it does not finish within the timeout, SniffDeadlineExpired is
+  raised and the thread is abandoned. It will not prevent the process from
+  exiting if it never finishes, e.g. when a read from a hung network
+  filesystem blocks.
+  '''
+  result = list()
+
+  def target():
+    try:
+      result.append((True, func(*args, **kwargs)))
+    except BaseException as e:
+      result.append((False, e))
+
+  thread = threading.Thread(target=target, name='sniff', daemon=True)
+  thread.start()
+  thread.join(timeout)
+  if not result:
+    raise SniffDeadlineExpired()
+  succeeded, value = result[0]
+  if succeeded:
+    return value
+  else:
+    raise value
+
+
+
+def file_mimetype_by_content(path, file_cmd=None, timeout=None, read_xattr=False, write_xattr=False):
+  '''
+  Attempt to determine the MIME-type of a regular (existing) file by content.
 
+  file_cmd:
+    A function that accepts a path and returns its MIME-type. It is only called
+    when the shared MIME-info database fails to determine the MIME-type.
+    Default: file_cmd_mimetype
 
+  timeout:
+    If not None, sniffing runs in a separate thread and SniffDeadlineExpired
+    is raised if it does not finish within this number of seconds. The
+    default file_cmd is killed when the deadline expires.
 
-def file_mimetype_by_name(path):
+  read_xattr:
+    If True, the MIME-type stored in the XATTR_MIME_TYPE extended attribute is
+    used without reading the file. See xattr_mimetype.
+
+  write_xattr:
+    If True, the MIME-type determined by content is stored in extended
+    attributes. See set_xattr_mimetype.
+  '''
+  with STAGE_TIMER.stage(STAGE_SNIFF_CONTENT):
+    # Like the preceding stat, reading the attribute is not bounded by the
+    # deadline. It avoids loading the shared MIME-info database on hits.
+    if read_xattr:
+      mimetype = xattr_mimetype(path)
+      if mimetype:
+        STAGE_TIMER.count(COUNTER_XATTR_HITS)
+        return mimetype
+    if timeout is None:
+      return sniff_content(path, file_cmd=file_cmd, write_xattr=write_xattr)
+    # Load the database in this thread because pyxdg's lazy initialization is
+    # not thread-safe and abandoned threads may still be running.
+    xdg.Mime.update_cache()
+    try:
+      return call_with_deadline(
+        timeout,
+        sniff_content,
+        path,
+        file_cmd=file_cmd,
+        deadline=(time.monotonic() + timeout),
+        write_xattr=write_xattr
+      )
+    except (SniffDeadlineExpired, subprocess.TimeoutExpired):
+      STAGE_TIMER.count(COUNTER_SNIFF_DEADLINES)
+      raise SniffDeadlineExpired()
+
+
+
+def sniff_content(path, file_cmd=None, deadline=None, write_xattr=False):
   '''
-  Attempt to determine the MIME-type of a regular (existing) file by name.
+  Determine the MIME-type of a file by content with the shared MIME-info
+  database and then file_cmd. See file_mimetype_by_content. The default
+  file_cmd is given the time that remains until the deadline (from
+  time.monotonic), if any.
   '''
   mimetype = None
-  mt = xdg.Mime.get_type_by_name(path)
+  mt = xdg.Mime.get_type_by_contents(path)
   if mt:
     mimetype = '{}/{}'.format(mt.media, mt.subtype)
   if not mimetype:
-    mimetype = mimetypes.guess_type(path)[0]
+    if file_cmd is None:
+      if deadline is None:
+        mimetype = file_cmd_mimetype(path)
+      else:
+        mimetype = file_cmd_mimetype(
+          path,
+          timeout=max(deadline - time.monotonic(), 0)
+        )
+    else:
+      mimetype = file_cmd(path)
+  if write_xattr and mimetype:
+    set_xattr_mimetype(path, mimetype)
   return mimetype
 
 
 
+def xattr_mimetype(path):
+  '''
+  Get the MIME-type stored in the XATTR_MIME_TYPE extended attribute of a file.
+  If the file also has the XATTR_MIME_TYPE_MTIME attribute then the MIME-type
+  is only returned if the modification time of the file still matches it.
+  Attributes set by other programs without the companion attribute are
+  trusted as the specification intends. None is returned if the attributes
+  are missing or unsupported.
+  '''
+  if not hasattr(os, 'getxattr'):
+    return None
+  try:
+    mimetype = os.getxattr(path, XATTR_MIME_TYPE).decode().strip()
+  except (OSError, UnicodeDecodeError):
+    return None
+  try:
+    mtime = os.getxattr(path, XATTR_MIME_TYPE_MTIME)
+  except OSError:
+    return mimetype or None
+  try:
+    if int(mtime) != os.stat(path).st_mtime_ns:
+      logging.debug('ignoring outdated {} attribute of {}'.format(XATTR_MIME_TYPE, path))
+      return None
+  except ValueError:
+    return None
+  return mimetype or None
+
+
+
+def set_xattr_mimetype(path, mimetype):
+  '''
+  Store a MIME-type in the XATTR_MIME_TYPE extended attribute of a file along
+  with its modification time in XATTR_MIME_TYPE_MTIME. Setting attributes
+  does not change the modification time. Failures, e.g. due to unsupported
+  filesystems or missing permissions, are ignored.
+  '''
+  if not hasattr(os, 'setxattr'):
+    return
+  try:
+    mtime = os.stat(path).st_mtime_ns
+    # The companion attribute is first set to an invalid value so that the
+    # MIME-type is never trusted without it if a later call fails.
+    os.setxattr(path, XATTR_MIME_TYPE_MTIME, b'')
+    os.setxattr(path, XATTR_MIME_TYPE, mimetype.encode())
+    os.setxattr(path, XATTR_MIME_TYPE_MTIME, str(mtime).encode())
+  except OSError as e:
+    logging.debug('failed to set {} attribute of {}: {}'.format(XATTR_MIME_TYPE, path, e))
+
+
+
+def file_cmd_args(path):
+  '''
+  The command for determining the MIME-type of a file with EXE_FILE.
+  '''
+  return [EXE_FILE, '--mime-type', path]
+
+
+
+def parse_file_cmd_output(output):
+  '''
+  Parse the MIME-type from the output of the file_cmd_args command.
+  '''
+  return output.rsplit(b': ', 1)[-1].strip().decode()
+
+
+
+def file_cmd_mimetype(path, timeout=None):
+  '''
+  Determine the MIME-type of a file with EXE_FILE. subprocess.TimeoutExpired
+  is raised if it does not finish within the timeout.
+  '''
+  cp = subprocess.run(
+    file_cmd_args(path),
+    stdout=subprocess.PIPE,
+    check=True,
+    timeout=timeout
+  )
+  return parse_file_cmd_output(cp.stdout)
+
+
+
+def file_mimetype_by_name(path, env=None):
+  '''
+  Attempt to determine the MIME-type of a regular (existing) file by name. The
+  shared MIME-info database in the data directories of env is used if it is
+  given.
+  '''
+  with STAGE_TIMER.stage(STAGE_SNIFF_NAME):
+    mimetype = name_detector(env=env).match(path)
+    if not mimetype:
+      mimetype = guess_mimetype(path, env=env)
+    return mimetype
+
+
+
+def mimetypes_knownfiles(env=None):
+  '''
+  The files that are read by the mimetypes module for the home directory of
+  the given XDGEnvironment.
+  '''
+  if env is None:
+    env = xdg_environment()
+  return [os.path.join(env.home, '.mime.types')] + mimetypes.knownfiles
+
+
+
+# Known files -> (stat signatures, mimetypes.MimeTypes), from least to most
+# recently used.
+MIMETYPES_DBS = collections.OrderedDict()
+MIMETYPES_DBS_LOCK = threading.Lock()
+
+def mimetypes_db(env=None):
+  '''
+  Get a mimetypes.MimeTypes instance for the home directory of the given
+  XDGEnvironment instead of initializing the global state of the mimetypes
+  module. The files are only read on first use, which is rare because the
+  name detector is tried first.
+  '''
+  knownfiles = tuple(mimetypes_knownfiles(env=env))
+  with MIMETYPES_DBS_LOCK:
+    try:
+      db = MIMETYPES_DBS[knownfiles][1]
+    except KeyError:
+      pass
+    else:
+      MIMETYPES_DBS.move_to_end(knownfiles)
+      return db
+    signatures = tuple(stat_signature(p) for p in knownfiles)
+    db = mimetypes.MimeTypes(
+      filenames=tuple(p for p, sig in zip(knownfiles, signatures) if sig is not None)
+    )
+    MIMETYPES_DBS[knownfiles] = (signatures, db)
+    while len(MIMETYPES_DBS) > XDG_DATABASE_CACHE_SIZE:
+      MIMETYPES_DBS.popitem(last=False)
+  return db
+
+
+
+def refresh_mimetypes_db(env=None):
+  '''
+  Forget the mimetypes_db of the home directory if its files have changed
+  since it was created.
+  '''
+  knownfiles = tuple(mimetypes_knownfiles(env=env))
+  with MIMETYPES_DBS_LOCK:
+    try:
+      signatures, _ = MIMETYPES_DBS[knownfiles]
+    except KeyError:
+      return
+    if tuple(stat_signature(p) for p in knownfiles) != signatures:
+      del MIMETYPES_DBS[knownfiles]
+
+
+
+def guess_mimetype(path, env=None):
+  '''
+  Guess the MIME-type of a path with the mimetypes module.
+  '''
+  return mimetypes_db(env=env).guess_type(path)[0]
+
+
+
+def guess_extension(mimetype, env=None):
+  '''
+  Guess the file extension of a MIME-type with the mimetypes module.
+  '''
+  return mimetypes_db(env=env).guess_extension(mimetype)
+
+
+
+class NameDetector(object):
+  '''
+  Determine MIME-types from file names with the glob patterns of the shared
+  MIME-info database (globs2 files). The patterns are compiled once into
+  dictionaries of literal names and extensions, with separate case-sensitive
+  and case-insensitive variants, and a single regular expression for all
+  remaining patterns.
+
+  Matches are checked in the same order as pyxdg's GlobDB: literal names, then
+  extensions from longest to shortest, then the remaining patterns in order of
+  weight and length. For literals and extensions with several types, the type
+  with the highest weight wins.
+  '''
+  def __init__(self):
+    self.cased_literals = dict()
+    self.literals = dict()
+    self.cased_exts = dict()
+    self.exts = dict()
+    # The last components of extensions that contain a dot, e.g. "gz" for
+    # "tar.gz". Only names that end with one of these need to be checked for
+    # more than one extension.
+    self.cased_compound_exts = set()
+    self.compound_exts = set()
+    # Combined regular expression for the remaining patterns and the MIME-types
+    # of its alternatives, which are named "p<index>".
+    self.regex = None
+    self.regex_mimetypes = tuple()
+
+
+
+  @classmethod
+  def from_paths(cls, globs2_paths, aliases_paths=()):
+    '''
+    Compile a detector from globs2 and aliases files, given in order of
+    increasing importance.
+    '''
+    aliases = dict()
+    for path in aliases_paths:
+      try:
+        with open(path, 'r') as f:
+          for line in f:
+            try:
+              alias, canonical = line.split()
+            except ValueError:
+              continue
+            aliases[alias] = canonical
+      except FileNotFoundError:
+        pass
+
+    # MIME-type -> {(weight, pattern, cased), ...}
+    globs = dict()
+    for path in globs2_paths:
+      try:
+        with open(path, 'r') as f:
+          logging.debug('loading {}'.format(path))
+          for line in f:
+            if line[0] == '#':
+              continue
+            fields = line.rstrip('\n').split(':')
+            try:
+              weight, mimetype, pattern = fields[:3]
+              weight = int(weight)
+            except ValueError:
+              logging.warning('failed to parse line [{}]'.format(line.rstrip()))
+              continue
+            mimetype = aliases.get(mimetype, mimetype)
+            if pattern == MIME_GLOBS_NOGLOBS:
+              globs.pop(mimetype, None)
+              continue
+            cased = len(fields) > 3 \
+              and MIME_GLOBS_CASE_SENSITIVE_FLAG in fields[3].split(',')
+            globs.setdefault(mimetype, set()).add((weight, pattern, cased))
+      except FileNotFoundError:
+        pass
+
+    detector = cls()
+    weights = dict()
+    others = list()
+    for mimetype, patterns in globs.items():
+      for weight, pattern, cased in patterns:
+        if pattern.startswith('*.') and not any(c in pattern[2:] for c in '*?['):
+          key = pattern[2:]
+          table = detector.cased_exts if cased else detector.exts
+        elif not any(c in pattern for c in '*?['):
+          key = pattern
+          table = detector.cased_literals if cased else detector.literals
+        else:
+          others.append((weight, pattern, cased, mimetype))
+          continue
+        if not cased:
+          key = key.lower()
+        wkey = (id(table), key)
+        if weights.get(wkey, -1) < weight:
+          weights[wkey] = weight
+          table[key] = mimetype
+
+    for table, compound in (
+      (detector.cased_exts, detector.cased_compound_exts),
+      (detector.exts, detector.compound_exts),
+    ):
+      compound.update(k.rpartition('.')[2] for k in table if '.' in k)
+
+    if others:
+      others.sort(key=lambda x: (x[0], len(x[1])), reverse=True)
+      alternatives = list()
+      for i, (weight, pattern, cased, mimetype) in enumerate(others):
+        # Before Python 3.11, translate emits named groups of its own for
+        # patterns with several "*". They are renamed per alternative so that
+        # the names are unique.
+        regex = NAME_DETECTOR_GROUP_REGEX.sub(
+          lambda m: '(?P{}p{:d}_{}'.format(m.group(1), i, m.group(2)),
+          fnmatch.translate(pattern)
+        )
+        if not cased:
+          regex = '(?i:{})'.format(regex)
+        alternatives.append('(?P<p{:d}>{})'.format(i, regex))
+      detector.regex = re.compile('|'.join(alternatives))
+      detector.regex_mimetypes = tuple(x[3] for x in others)
+    return detector
+
+
+
+  def to_data(self):
+    '''
+    Return the compiled tables as a tuple that can be serialized with marshal.
+    '''
+    return (
+      self.cased_literals,
+      self.literals,
+      self.cased_exts,
+      self.exts,
+      tuple(self.cased_compound_exts),
+      tuple(self.compound_exts),
+      self.regex.pattern if self.regex else None,
+      self.regex_mimetypes,
+    )
+
+
+
+  @classmethod
+  def from_data(cls, data):
+    '''
+    Create a detector from the output of to_data.
+    '''
+    detector = cls()
+    (
+      detector.cased_literals,
+      detector.literals,
+      detector.cased_exts,
+      detector.exts,
+      cased_compound_exts,
+      compound_exts,
+      pattern,
+      detector.regex_mimetypes,
+    ) = data
+    detector.cased_compound_exts = set(cased_compound_exts)
+    detector.compound_exts = set(compound_exts)
+    if pattern is not None:
+      detector.regex = re.compile(pattern)
+    return detector
+
+
+
+  @staticmethod
+  def match_extension(name, exts, compound_exts):
+    '''
+    Match the longest extension of the name in the given table.
+    '''
+    _, dot, ext = name.rpartition('.')
+    if not dot:
+      return None
+    elif ext in compound_exts:
+      i = name.find('.')
+      while i >= 0:
+        i += 1
+        mimetype = exts.get(name[i:])
+        if mimetype:
+          return mimetype
+        i = name.find('.', i)
+      return None
+    else:
+      return exts.get(ext)
+
+
+
+  def match(self, path):
+    '''
+    Return the MIME-type of the path's file name, or None if no pattern matches.
+    The result is the same as that of pyxdg:
+
+    >>> detector = name_detector()
+    >>> names = (
+    ...   'a.txt', 'B.PNG', 'x.tar.gz', 'libc.so.6', 'libm.so.6.1', 'Makefile',
+    ...   'README', 'README.md', 'core', 'a.c', 'a.C', 'x~', 'CMakeLists.txt'
+    ... )
+    >>> [
+    ...   n for n in names
+    ...   if detector.match(n) != (lambda t: t and str(t))(xdg.Mime.get_type_by_name(n))
+    ... ]
+    []
+    '''
+    leaf = path.rpartition('/')[2]
+    mimetype = self.cased_literals.get(leaf)
+    if mimetype:
+      return mimetype
+    lleaf = leaf.lower()
+    mimetype = self.literals.get(lleaf)
+    if mimetype:
+      return mimetype
+
+    if self.cased_exts:
+      mimetype = self.match_extension(leaf, self.cased_exts, self.cased_compound_exts)
+      if mimetype:
+        return mimetype
+    mimetype = self.match_extension(lleaf, self.exts, self.compound_exts)
+    if mimetype:
+      return mimetype
+
+    if self.regex:
+      m = self.regex.match(leaf)
+      if m:
+        return self.regex_mimetypes[int(m.lastgroup[1:])]
+    return None
+
+
+
+# Data directories -> (source signature, NameDetector), from least to most
+# recently used.
+NAME_DETECTORS = collections.OrderedDict()
+NAME_DETECTORS_LOCK = threading.Lock()
+
+def name_detector_sources(env=None):
+  '''
+  Return the globs2 and aliases paths in the data directories, least important
+  first, and a signature that changes when any of them changes.
+  '''
+  # load_data_paths returns the most important path first.
+  globs2_paths = tuple(reversed(list(load_data_paths(MIME_GLOBS2_FILE, env=env))))
+  aliases_paths = tuple(reversed(list(load_data_paths(MIME_ALIASES_FILE, env=env))))
+  paths = globs2_paths + aliases_paths
+  return globs2_paths, aliases_paths, (paths, tuple(stat_signature(p) for p in paths))
+
+
+
+def name_detector(env=None, snapshot=None):
+  '''
+  Get the NameDetector for the current XDG data directories or those of the
+  given XDGEnvironment. Each is compiled on first use, or loaded from the
+  given Snapshot.
+  '''
+  data_dirs = tuple(xdg.BaseDirectory.xdg_data_dirs) if env is None else env.data_dirs
+  with NAME_DETECTORS_LOCK:
+    try:
+      detector = NAME_DETECTORS[data_dirs][1]
+    except KeyError:
+      pass
+    else:
+      NAME_DETECTORS.move_to_end(data_dirs)
+      return detector
+    globs2_paths, aliases_paths, signature = name_detector_sources(env=env)
+    if snapshot is None:
+      detector = NameDetector.from_paths(globs2_paths, aliases_paths)
+    else:
+      detector = NameDetector.from_data(snapshot.get(
+        SNAPSHOT_NAME_DETECTOR,
+        globs2_paths + aliases_paths,
+        lambda: NameDetector.from_paths(globs2_paths, aliases_paths).to_data()
+      ))
+    NAME_DETECTORS[data_dirs] = (signature, detector)
+    while len(NAME_DETECTORS) > XDG_DATABASE_CACHE_SIZE:
+      NAME_DETECTORS.popitem(last=False)
+  return detector
+
+
+
+def refresh_name_detector(env=None):
+  '''
+  Forget the NameDetector of the data directories if its source files have
+  changed since it was created.
+  '''
+  data_dirs = tuple(xdg.BaseDirectory.xdg_data_dirs) if env is None else env.data_dirs
+  with NAME_DETECTORS_LOCK:
+    try:
+      signature, _ = NAME_DETECTORS[data_dirs]
+    except KeyError:
+      return
+    if name_detector_sources(env=env)[2] != signature:
+      logging.debug('MIME-info database changed')
+      del NAME_DETECTORS[data_dirs]
+
+
+
+def scandir_tree(dpath):
+  '''
+  Iterate over the entries of a directory tree with os.scandir. Only real
+  directories are descended into so that symlink loops cannot occur. The
+  entries are returned as os.DirEntry objects so that callers can use the file
+  type from the directory listing instead of calling stat.
+  '''
+  dpaths = [dpath]
+  while dpaths:
+    dpath = dpaths.pop()
+    try:
+      with os.scandir(dpath) as entries:
+        for entry in entries:
+          yield entry
+          try:
+            if entry.is_dir(follow_symlinks=False):
+              dpaths.append(entry.path)
+          except OSError as e:
+            logging.error('scandir_tree: [{}]'.format(e))
+    except OSError as e:
+      logging.error('scandir_tree: [{}]'.format(e))
+
+
+
+def mimetypes_from_dir_entry(
+  entry,
+  follow_symlinks=True,
+  content_first=True,
+  content_only=False,
+  name_only=False,
+  file_cmd=None,
+  env=None,
+  use_fs_policy=False,
+  sniff_timeout=None,
+  read_xattr=False,
+  write_xattr=False
+):
+  '''
+  Attempt to determine the MIME-type of an os.DirEntry. Regular files and
+  directories are recognized from the directory listing without calling stat
+  unless the sniffing policy of the filesystem is used. Everything else is
+  passed to mimetypes_from_path.
+  '''
+  try:
+    is_file = entry.is_file(follow_symlinks=follow_symlinks)
+    is_dir = not is_file and entry.is_dir(follow_symlinks=follow_symlinks)
+  except OSError:
+    is_file = is_dir = False
+  if is_file and use_fs_policy and not name_only:
+    try:
+      dev = entry.stat(follow_symlinks=follow_symlinks).st_dev
+    except OSError:
+      pass
+    else:
+      content_first, content_only, name_only, sniff_timeout = apply_fs_policy(
+        dev, entry.path, content_first, content_only, name_only, sniff_timeout
+      )
+  if is_file:
+    if name_only:
+      mimetype = file_mimetype_by_name(entry.path, env=env)
+      if mimetype:
+        yield mimetype
+    else:
+      yield from file_mimetype(
+        entry.path,
+        content_first=content_first,
+        content_only=content_only,
+        name_only=name_only,
+        file_cmd=file_cmd,
+        env=env,
+        sniff_timeout=sniff_timeout,
+        read_xattr=read_xattr,
+        write_xattr=write_xattr
+      )
+  elif is_dir:
+    yield MIMETYPE_DIRECTORY
+  else:
+    yield from mimetypes_from_path(
+      entry.path,
+      follow_symlinks=follow_symlinks,
+      content_first=content_first,
+      content_only=content_only,
+      name_only=name_only,
+      file_cmd=file_cmd,
+      env=env,
+      use_fs_policy=use_fs_policy,
+      sniff_timeout=sniff_timeout,
+      read_xattr=read_xattr,
+      write_xattr=write_xattr
+    )
+
+
+
+def has_matcher_prefix(arg):
+  '''
+  Check if the argument is a MIME-type matcher with a pattern prefix.
+  '''
+  return arg.startswith(MATCHER_PREFIX_GLOB) or arg.startswith(MATCHER_PREFIX_REGEX)
+
+
+
+def is_mimetype_matcher(arg):
+  '''
+  Check if the argument is a MIME-type matcher or a string that looks like a
+  MIME-type with a registered top-level type. This does not check if the
+  MIME-type is known.
+  '''
+  if has_matcher_prefix(arg):
+    return True
+  m = MIMETYPE_LITERAL_REGEX.match(arg)
+  return bool(m) and m.group(1).lower() in MIMETYPE_TOP_LEVEL_TYPES
+
+
+
+def load_knownfile_mimetypes(path):
+  '''
+  Iterate over the MIME-types in a mimetypes known file.
+  '''
+  try:
+    with open(path, 'r') as f:
+      logging.debug('loading MIME-types from {}'.format(path))
+      for line in f:
+        m = MIMETYPES_KNOWNFILES_REGEX.search(line)
+        if m:
+          yield m.group(1)
+  except FileNotFoundError:
+    pass
+
+
+
 def mimetype_regex(matcher):
   '''
   Convert a MIME-type matcher to a regular expression. The following are
@@ -634,19 +2247,17 @@ def mimetype_regex(matcher):
 
 ################################ Path Functions ################################
 
-def desktop_mimeapps_filenames():
+def desktop_mimeapps_filenames(env=None):
   '''
   Iterative over names of current desktop as defined in the XDG_CURRENT_DESKTOP
   environment variable.
   '''
-  desktop = os.getenv(XDG_CURRENT_DESKTOP)
-  if desktop:
-    for d in desktop.split(':'):
-      yield '{}-{}'.format(d.lower(), MIMEAPPS_LIST_FILE)
+  for d in current_desktops(env=env):
+    yield '{}-{}'.format(d.lower(), MIMEAPPS_LIST_FILE)
 
 
 
-def mimeapps_directories(user=True, system=True, include_user_app_dir=True):
+def mimeapps_directories(user=True, system=True, include_user_app_dir=True, env=None):
   '''
   Iterate over association file directories. The items are returned as tuples
   or lists so that each set can be iterated over in order of precedence as
@@ -656,7 +2267,9 @@ def mimeapps_directories(user=True, system=True, include_user_app_dir=True):
 
   '''
   my_name = 'mimeapps_directories'
-  config_home = xdg.BaseDirectory.xdg_config_home
+  if env is None:
+    env = xdg_environment()
+  config_home = env.config_home
   if user:
     yield tuple(logging_debug_and_yield(
       my_name,
@@ -666,10 +2279,10 @@ def mimeapps_directories(user=True, system=True, include_user_app_dir=True):
   if system:
     yield tuple(logging_debug_and_yield(
       my_name,
-      (d for d in xdg.BaseDirectory.xdg_config_dirs if d != config_home)
+      (d for d in env.config_dirs if d != config_home)
     ))
 
-  data_home = xdg.BaseDirectory.xdg_data_home
+  data_home = env.data_home
 
   if user and include_user_app_dir:
     yield tuple (logging_debug_and_yield(
@@ -678,23 +2291,18 @@ def mimeapps_directories(user=True, system=True, include_user_app_dir=True):
     ))
 
   if system:
-    dpaths = list(
-      os.path.join(d, APP_DIR)
-      for d in xdg.BaseDirectory.xdg_data_dirs
-      if d != data_home
-    )
     yield tuple(logging_debug_and_yield(
       my_name,
       (
         os.path.join(d, APP_DIR)
-        for d in xdg.BaseDirectory.xdg_data_dirs
+        for d in env.data_dirs
         if d != data_home
       )
     ))
 
 
 
-def desktop_directories(user=True, system=True):
+def desktop_directories(user=True, system=True, env=None):
   '''
   Iterate over desktop entry directories:
 
@@ -702,7 +2310,9 @@ def desktop_directories(user=True, system=True):
 
   '''
   my_name = 'desktop_directories'
-  data_home = xdg.BaseDirectory.xdg_data_home
+  if env is None:
+    env = xdg_environment()
+  data_home = env.data_home
 
   if user:
     yield from logging_debug_and_yield(
@@ -715,7 +2325,7 @@ def desktop_directories(user=True, system=True):
       my_name,
       (
         os.path.join(d, APP_DIR)
-        for d in xdg.BaseDirectory.xdg_data_dirs
+        for d in env.data_dirs
         if d != data_home
       )
     )
@@ -726,6 +2336,7 @@ def mimeapps_list_paths(
   current_desktop=False,
   *args,
   include_user_app_dir=False,
+  env=None,
   **kwargs
 ):
   '''
@@ -734,11 +2345,12 @@ def mimeapps_list_paths(
   to indicate if the file is desktop-specific.
   '''
   # Desktop-specific mimeapps.list files to check.
-  dmals = list(desktop_mimeapps_filenames())
+  dmals = list(desktop_mimeapps_filenames(env=env))
 
   for ds in mimeapps_directories(
     *args,
     include_user_app_dir=include_user_app_dir,
+    env=env,
     **kwargs
   ):
     if current_desktop:
@@ -751,27 +2363,30 @@ def mimeapps_list_paths(
 
 
 
-def user_mimeapps_path(current_desktop=False):
+def user_mimeapps_path(current_desktop=False, env=None):
   '''
   Get the user's association file.
   '''
+  if env is None:
+    env = xdg_environment()
   name = MIMEAPPS_LIST_FILE
   if current_desktop:
     try:
-      name = next(desktop_mimeapps_filenames())
+      name = next(desktop_mimeapps_filenames(env=env))
     except StopIteration:
       pass
-  return os.path.join(xdg.BaseDirectory.xdg_config_home, name)
+  return os.path.join(env.config_home, name)
 
 
 
-def desktop_paths(user=True, system=True, sort_per_dir=False):
+def desktop_paths(user=True, system=True, sort_per_dir=False, env=None):
   '''
   Iterate over all desktop files.
   '''
   for dpath in desktop_directories(
     user=user,
-    system=system
+    system=system,
+    env=env
   ):
     pattern = os.path.join(dpath, '*' + DESKTOP_EXTENSION)
     if sort_per_dir:
@@ -782,53 +2397,689 @@ def desktop_paths(user=True, system=True, sort_per_dir=False):
 
 
 
-############################ mimeapps.list parsing #############################
+################################ Archive Members ###############################
 
-def parse_associations(lines):
+class ArchiveMember(collections.namedtuple(
+  'ArchiveMember',
+  ('kind', 'archive', 'name')
+)):
   '''
-  Parse lines of an association file.
+  A file inside a zip or tar archive. kind is ARCHIVE_ZIP or ARCHIVE_TAR,
+  archive is the path to the archive and name is the normalized name of the
+  member.
   '''
-  section = None
-  associations = collections.OrderedDict()
-  for line in lines:
-    line = line.strip()
-    if not line or line[0] == '#':
-      continue
-    elif line[0] == '[' and line[-1] == ']':
-      section = line[1:-1]
-    else:
-      try:
-        mimetype, desktops = line.split('=',1)
-      except ValueError:
-        logging.warning('failed to parse line [{}]'.format(line))
-      else:
-        mimetype = mimetype.rstrip()
-        # The standard only supports desktop file names. Strip diretory
-        # components from the path to ensure. This ensures that joined paths
-        # point to the "right" directory.
-        desktops = list(os.path.basename(d.strip()) for d in desktops.split(';') if d)
-        if desktops:
-          try:
-            associations[section][mimetype] = desktops
-          except KeyError:
-            associations[section] = {mimetype : desktops}
-  return associations
+  __slots__ = ()
 
 
 
-def remove_empty_associations(assocs):
+def archive_kind(path):
   '''
-  Remove empty entries and sections.
+  Return ARCHIVE_ZIP or ARCHIVE_TAR if the path is a regular file with the
+  respective format, otherwise None.
   '''
-  empty_sections = set()
-  for section, entries in assocs.items():
-    empty_keys = set()
-    for key, values in entries.items():
-      if not values:
-        empty_keys.add(key)
-    for k in empty_keys:
-      del entries[k]
-    if not entries:
+  import tarfile
+  import zipfile
+  if not os.path.isfile(path):
+    return None
+  try:
+    if zipfile.is_zipfile(path):
+      return ARCHIVE_ZIP
+    elif tarfile.is_tarfile(path):
+      return ARCHIVE_TAR
+  except OSError as e:
+    logging.debug('archive_kind: [{}]'.format(e))
+  return None
+
+
+
+def normalize_member_name(name):
+  '''
+  Normalize the name of an archive member for comparison.
+  '''
+  return os.path.normpath(name.lstrip('/')) if name else ''
+
+
+
+def parse_archive_member(arg, parsed_url=None):
+  '''
+  Return an ArchiveMember if the argument refers to a file inside an archive,
+  otherwise None. The following forms are recognized:
+
+    <archive>#<member>
+    file://<archive>#<member>
+    zip://<archive>#<member>
+    zip://<archive>/<member>
+
+  and the same with "tar" instead of "zip". Paths that exist are never
+  members. Without a fragment, the archive is the longest prefix of the URL
+  path that is a regular file.
+  '''
+  if parsed_url is None:
+    parsed_url = urllib.parse.urlparse(arg)
+  scheme = parsed_url.scheme
+  if scheme in ARCHIVE_SCHEMES:
+    if parsed_url.netloc not in ('', 'localhost'):
+      return None
+    path = urllib.parse.unquote(parsed_url.path)
+    if parsed_url.fragment:
+      archive = path
+      name = urllib.parse.unquote(parsed_url.fragment)
+    else:
+      archive = path
+      name = ''
+      while archive and not os.path.isfile(archive):
+        archive, tail = os.path.split(archive)
+        if not tail:
+          return None
+        name = os.path.join(tail, name) if name else tail
+    name = normalize_member_name(name)
+    if archive and name and os.path.isfile(archive):
+      return ArchiveMember(scheme, archive, name)
+    return None
+
+  if not parsed_url.fragment or scheme not in ('', SCHEME_FILE):
+    return None
+  if scheme == SCHEME_FILE:
+    archive = ensure_path(urllib.parse.urlunparse(parsed_url._replace(fragment='')))
+    if not archive:
+      return None
+  else:
+    if os.path.exists(arg):
+      return None
+    archive, _, _ = arg.rpartition(ARCHIVE_MEMBER_SEP)
+  name = normalize_member_name(urllib.parse.unquote(parsed_url.fragment))
+  if not name:
+    return None
+  kind = archive_kind(archive)
+  if kind:
+    return ArchiveMember(kind, archive, name)
+  return None
+
+
+
+@contextlib.contextmanager
+def open_archive_member(member):
+  '''
+  Open a member of an archive for reading without extracting it. The context
+  manager returns a tuple of a binary file object and the size of the member.
+  Tar archives are read as a stream up to the member so that compressed
+  archives are never decompressed past it or seeked in. FileNotFoundError is
+  raised if the member does not exist and IsADirectoryError if it is not a
+  regular file. Errors due to corrupt, encrypted or unsupported data, also
+  while the member is read, are raised as OSError.
+  '''
+  import lzma
+  import tarfile
+  import zipfile
+  import zlib
+  try:
+    if member.kind == ARCHIVE_ZIP:
+      with zipfile.ZipFile(member.archive) as zf:
+        info = None
+        for i in zf.infolist():
+          if normalize_member_name(i.filename) == member.name:
+            info = i
+            break
+        if info is None:
+          raise FileNotFoundError('no such member')
+        if info.is_dir():
+          raise IsADirectoryError('not a regular file')
+        with zf.open(info) as f:
+          yield f, info.file_size
+    else:
+      with tarfile.open(member.archive, 'r|*') as tf:
+        for info in tf:
+          if normalize_member_name(info.name) == member.name:
+            break
+        else:
+          raise FileNotFoundError('no such member')
+        if not info.isfile():
+          raise IsADirectoryError('not a regular file')
+        with tf.extractfile(info) as f:
+          yield f, info.size
+  # zipfile raises RuntimeError for encrypted members and NotImplementedError
+  # for unsupported compression methods.
+  except (
+    zipfile.BadZipFile,
+    zipfile.LargeZipFile,
+    tarfile.TarError,
+    zlib.error,
+    lzma.LZMAError,
+    EOFError,
+    RuntimeError,
+    NotImplementedError
+  ) as e:
+    raise OSError('{}: {}'.format(member.archive, e)) from e
+
+
+
+def archive_member_mimetype_by_content(member):
+  '''
+  Determine the MIME-type of an archive member from the shared MIME-info
+  database. Only the bytes that the magic rules can inspect are read.
+  '''
+  with STAGE_TIMER.stage(STAGE_SNIFF_CONTENT):
+    xdg.Mime.update_cache()
+    with open_archive_member(member) as (f, _):
+      data = f.read(xdg.Mime.magic.maxlen)
+    if not data:
+      return None
+    mt = xdg.Mime.get_type_by_data(data)
+    return '{}/{}'.format(mt.media, mt.subtype) if mt else None
+
+
+
+@unique_items
+def archive_member_mimetypes(member, content_first=True, content_only=False, name_only=False, env=None):
+  '''
+  Attempt to determine the MIME-type of an archive member by name and by the
+  header bytes of its content. See file_mimetype.
+  '''
+  def by_name(member):
+    return file_mimetype_by_name(member.name, env=env)
+  by_content = archive_member_mimetype_by_content
+  if content_only:
+    fs = (by_content,)
+  elif name_only:
+    fs = (by_name,)
+  elif content_first:
+    fs = (by_content, by_name)
+  else:
+    fs = (by_name, by_content)
+  for f in fs:
+    try:
+      mimetype = f(member)
+    except OSError as e:
+      logging.warning('failed to read {}#{}: {}'.format(member.archive, member.name, e))
+    else:
+      if mimetype:
+        yield mimetype
+
+
+
+def default_extract_path(env=None):
+  '''
+  The path to the directory of extracted archive members.
+  '''
+  return os.path.join(
+    xdg.BaseDirectory.xdg_cache_home if env is None else env.cache_home,
+    NAME.lower(),
+    EXTRACT_DIR
+  )
+
+
+
+class ExtractCache(object):
+  '''
+  Archive members extracted on demand so that they can be passed to
+  applications as files. Each member is extracted alone into a directory named
+  after a hash of the archive path, its stat signature and the member name, so
+  changed archives are extracted again. The total size is bounded by evicting
+  the least recently used members, tracked by the modification times of their
+  directories.
+  '''
+  def __init__(self, max_size=DEFAULT_EXTRACT_CACHE_SIZE, path=None, env=None):
+    self.max_size = max_size
+    self.path = path if path else default_extract_path(env=env)
+
+
+
+  def member_directory(self, member):
+    '''
+    The directory of an extracted member.
+    '''
+    import hashlib
+    key = json.dumps((
+      member.kind,
+      os.path.abspath(member.archive),
+      stat_signature(member.archive),
+      member.name,
+    ))
+    return os.path.join(self.path, hashlib.sha1(key.encode()).hexdigest())
+
+
+
+  def get(self, member):
+    '''
+    Return the path to the extracted member, extracting it if necessary. None
+    is returned if it cannot be extracted or is larger than the cache.
+    '''
+    import shutil
+    dpath = self.member_directory(member)
+    fpath = os.path.join(dpath, os.path.basename(member.name))
+    if os.path.isfile(fpath):
+      logging.debug('using extracted {}'.format(fpath))
+      STAGE_TIMER.count(COUNTER_EXTRACT_CACHE_HITS)
+      os.utime(dpath)
+      return fpath
+
+    tmp_dpath = '{}.{:d}.{:d}'.format(dpath, os.getpid(), threading.get_ident())
+    try:
+      with STAGE_TIMER.stage(STAGE_EXTRACT), open_archive_member(member) as (f, size):
+        if size > self.max_size:
+          logging.warning('{}#{} is larger than the extraction cache'.format(member.archive, member.name))
+          return None
+        logging.debug('extracting {}#{} to {}'.format(member.archive, member.name, fpath))
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        os.makedirs(tmp_dpath, exist_ok=True)
+        tmp_fpath = os.path.join(tmp_dpath, os.path.basename(member.name))
+        with open(tmp_fpath, 'wb') as g:
+          shutil.copyfileobj(f, g)
+        # Changes to the copy would be lost.
+        os.chmod(tmp_fpath, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+      try:
+        os.rename(tmp_dpath, dpath)
+      except OSError:
+        # Extracted concurrently.
+        if not os.path.isfile(fpath):
+          raise
+    except OSError as e:
+      logging.warning('failed to extract {}#{}: {}'.format(member.archive, member.name, e))
+      return None
+    finally:
+      if os.path.exists(tmp_dpath):
+        shutil.rmtree(tmp_dpath, ignore_errors=True)
+    self.evict(keep=dpath)
+    return fpath
+
+
+
+  def spool(self, chunks, name):
+    '''
+    Save data from an iterator of bytes to a file with the given name and
+    return its path, or None if it cannot be saved. The directory is named
+    after a hash of the data so identical data is only stored once. The data
+    is stored even if it exceeds the size limit.
+    '''
+    import hashlib
+    import shutil
+    tmp_dpath = os.path.join(
+      self.path,
+      'spool.{:d}.{:d}'.format(os.getpid(), threading.get_ident())
+    )
+    try:
+      with STAGE_TIMER.stage(STAGE_EXTRACT):
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        os.makedirs(tmp_dpath, exist_ok=True)
+        tmp_fpath = os.path.join(tmp_dpath, name)
+        digest = hashlib.sha1()
+        with open(tmp_fpath, 'wb') as f:
+          for chunk in chunks:
+            digest.update(chunk)
+            f.write(chunk)
+        os.chmod(tmp_fpath, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+      dpath = os.path.join(self.path, digest.hexdigest())
+      fpath = os.path.join(dpath, name)
+      if os.path.isfile(fpath):
+        os.utime(dpath)
+      else:
+        logging.debug('saving data to {}'.format(fpath))
+        try:
+          os.rename(tmp_dpath, dpath)
+        except OSError:
+          if not os.path.isfile(fpath):
+            raise
+    except OSError as e:
+      logging.warning('failed to save data to {}: {}'.format(self.path, e))
+      return None
+    finally:
+      if os.path.exists(tmp_dpath):
+        shutil.rmtree(tmp_dpath, ignore_errors=True)
+    self.evict(keep=dpath)
+    return fpath
+
+
+
+  def evict(self, keep=None):
+    '''
+    Remove the least recently used members until the total size is within
+    the limit. The directory to keep is never removed.
+    '''
+    import shutil
+    entries = list()
+    total = 0
+    try:
+      it = os.scandir(self.path)
+    except OSError:
+      return
+    with it:
+      for entry in it:
+        if not entry.is_dir(follow_symlinks=False):
+          continue
+        try:
+          size = sum(e.stat().st_size for e in os.scandir(entry.path))
+          mtime = entry.stat().st_mtime
+        except OSError:
+          continue
+        total += size
+        entries.append((mtime, size, entry.path))
+    entries.sort()
+    for mtime, size, dpath in entries:
+      if total <= self.max_size:
+        break
+      if dpath == keep:
+        continue
+      logging.debug('evicting {}'.format(dpath))
+      shutil.rmtree(dpath, ignore_errors=True)
+      total -= size
+
+
+
+################################ Standard Input ################################
+
+class StdinSource(object):
+  '''
+  Data passed to Mimeo on STDIN with the STDIN_ARG argument. The MIME-type is
+  determined from the header bytes in memory. If STDIN is a regular file then
+  it is read with pread and never consumed. Otherwise the header bytes are
+  kept so that the data can still be passed on in full, either by saving it to
+  the extraction cache or by passing the applications a pipe on their STDIN
+  that is fed from a thread.
+  '''
+  def __init__(self, fd=0):
+    self.fd = fd
+    self.header = None
+    self.detected = False
+    self.mimetype = None
+    self.shared = False
+    self.feeder = None
+    self.read_fd = None
+    self.spooled_path = None
+    try:
+      self.seekable = stat.S_ISREG(os.fstat(fd).st_mode)
+    except OSError:
+      self.seekable = False
+
+
+
+  def read_header(self):
+    '''
+    Read the bytes that the magic rules of the shared MIME-info database can
+    inspect.
+    '''
+    if self.header is None:
+      xdg.Mime.update_cache()
+      size = xdg.Mime.magic.maxlen
+      if self.seekable:
+        self.header = os.pread(self.fd, size, os.lseek(self.fd, 0, os.SEEK_CUR))
+      else:
+        chunks = list()
+        n = 0
+        while n < size:
+          chunk = os.read(self.fd, size - n)
+          if not chunk:
+            break
+          chunks.append(chunk)
+          n += len(chunk)
+        self.header = b''.join(chunks)
+    return self.header
+
+
+
+  def detect_mimetype(self, file_cmd_timeout=None):
+    '''
+    Determine the MIME-type of the data like file_mimetype_by_content: with the
+    shared MIME-info database and then EXE_FILE, which is given the header
+    bytes on its STDIN.
+    '''
+    if not self.detected:
+      with STAGE_TIMER.stage(STAGE_SNIFF_CONTENT):
+        data = self.read_header()
+        mt = xdg.Mime.get_type_by_data(data) if data else None
+        if mt:
+          self.mimetype = '{}/{}'.format(mt.media, mt.subtype)
+        else:
+          try:
+            cp = subprocess.run(
+              file_cmd_args('-'),
+              input=data,
+              stdout=subprocess.PIPE,
+              check=True,
+              timeout=file_cmd_timeout
+            )
+            self.mimetype = parse_file_cmd_output(cp.stdout)
+          except (OSError, subprocess.SubprocessError) as e:
+            logging.warning('failed to determine the MIME-type of STDIN: {}'.format(e))
+      self.detected = True
+    return self.mimetype
+
+
+
+  def chunks(self, size=STDIN_CHUNK_SIZE):
+    '''
+    Iterate over the data in chunks, starting with the header bytes. The data
+    can only be iterated over once.
+    '''
+    header = self.read_header()
+    if self.seekable:
+      offset = os.lseek(self.fd, 0, os.SEEK_CUR)
+      while True:
+        chunk = os.pread(self.fd, size, offset)
+        if not chunk:
+          break
+        offset += len(chunk)
+        yield chunk
+    else:
+      if header:
+        yield header
+      while True:
+        chunk = os.read(self.fd, size)
+        if not chunk:
+          break
+        yield chunk
+
+
+
+  def share(self):
+    '''
+    Make the full data available to applications on their STDIN. A regular
+    file is already available. Otherwise a pipe is created that is fed by a
+    thread. Its read end must be passed to the applications as their STDIN
+    (see child_stdin()) and Mimeo's own STDIN is left untouched so that the
+    feeder stops when the applications close the pipe.
+    '''
+    if self.seekable or self.shared:
+      return
+    r, w = os.pipe()
+    self.read_fd = r
+    self.shared = True
+
+    def feed():
+      try:
+        with open(w, 'wb', buffering=0) as f:
+          for chunk in self.chunks_from(self.fd):
+            f.write(chunk)
+      except BrokenPipeError:
+        logging.debug('STDIN was not read completely')
+
+    self.feeder = threading.Thread(target=feed, name='stdin', daemon=True)
+    self.feeder.start()
+
+
+
+  def child_stdin(self):
+    '''
+    The file descriptor to pass to applications as their STDIN, or None if
+    they should inherit Mimeo's STDIN.
+    '''
+    return self.read_fd
+
+
+
+  def release(self):
+    '''
+    Close Mimeo's copy of the read end of the pipe after the applications
+    have been started.
+    '''
+    if self.read_fd is not None:
+      os.close(self.read_fd)
+      self.read_fd = None
+
+
+
+  def wait(self, procs=()):
+    '''
+    Keep feeding the shared data until it has been read or the given
+    applications (Popen objects) have exited. The feeder is abandoned
+    STDIN_WAIT_GRACE seconds after the applications have exited.
+    '''
+    self.release()
+    if self.feeder is None:
+      return
+    while self.feeder.is_alive() and any(p.poll() is None for p in procs):
+      self.feeder.join(STDIN_WAIT_INTERVAL)
+    self.feeder.join(STDIN_WAIT_GRACE)
+    if self.feeder.is_alive():
+      logging.debug('abandoning STDIN')
+
+
+
+  def chunks_from(self, fd, size=STDIN_CHUNK_SIZE):
+    '''
+    Iterate over the header bytes and then the remaining data of another file
+    descriptor.
+    '''
+    if self.header:
+      yield self.header
+    while True:
+      chunk = os.read(fd, size)
+      if not chunk:
+        break
+      yield chunk
+
+
+
+  def path(self, extract_cache, use_fd=False, env=None):
+    '''
+    Get a path to the data for applications that require files. The path of a
+    regular file is used directly. Otherwise the data is either shared through
+    /dev/fd if use_fd is True or saved to the extraction cache.
+    '''
+    if self.seekable:
+      try:
+        path = os.readlink(STDIN_FD_PATH_FMT.format(self.fd))
+        if os.path.samestat(os.stat(path), os.fstat(self.fd)):
+          return path
+      except OSError:
+        pass
+      return STDIN_DEV_FD_FMT.format(self.fd)
+    if use_fd or self.shared:
+      self.share()
+      # The pipe is the STDIN of the applications.
+      return STDIN_DEV_FD_FMT.format(0)
+    if self.spooled_path is None:
+      self.spooled_path = extract_cache.spool(self.chunks(), self.spool_name(env=env))
+    return self.spooled_path
+
+
+
+  def placeholder(self, extract_cache, use_fd=False, env=None):
+    '''
+    Get the path that path() would return without preparing the data, e.g. for
+    printing commands. The hash directory of data that would be saved to the
+    extraction cache is unknown and replaced with STDIN_SPOOL_PLACEHOLDER.
+    '''
+    if self.seekable:
+      return self.path(extract_cache, env=env)
+    if use_fd or self.shared:
+      return STDIN_DEV_FD_FMT.format(0)
+    if self.spooled_path is not None:
+      return self.spooled_path
+    return os.path.join(
+      extract_cache.path,
+      STDIN_SPOOL_PLACEHOLDER,
+      self.spool_name(env=env)
+    )
+
+
+
+  def spool_name(self, env=None):
+    '''
+    The file name of the data in the extraction cache, with the extension of
+    its MIME-type if there is one.
+    '''
+    ext = guess_extension(self.mimetype, env=env) if self.mimetype else None
+    return STDIN_SPOOL_NAME + (ext if ext else '')
+
+
+
+############################ mimeapps.list parsing #############################
+
+# Association values are tuples of interned desktop names. Identical tuples are
+# shared between all entries, files and Mimeo instances through this store. See
+# clear_shared_desktops().
+SHARED_DESKTOP_TUPLES = dict()
+
+def shared_desktops(desktops):
+  '''
+  Return the shared tuple of interned desktop names equal to the given ones.
+  '''
+  desktops = tuple(sys.intern(d) for d in desktops)
+  return SHARED_DESKTOP_TUPLES.setdefault(desktops, desktops)
+
+
+
+def clear_shared_desktops():
+  '''
+  Clear the store of shared desktop tuples. Long-running processes that reload
+  changed association files may call this so that the store does not grow
+  with every reload. Tuples that are already in use remain valid but are no
+  longer shared with new ones.
+  '''
+  SHARED_DESKTOP_TUPLES.clear()
+
+
+
+def parse_associations(lines):
+  '''
+  Parse lines of an association file.
+
+  The values are shared tuples of desktop names (see shared_desktops()) and
+  must not be modified in place.
+  '''
+  section = None
+  associations = collections.OrderedDict()
+  for line in lines:
+    line = line.strip()
+    if not line or line[0] == '#':
+      continue
+    elif line[0] == '[' and line[-1] == ']':
+      section = sys.intern(line[1:-1])
+    else:
+      try:
+        mimetype, desktops = line.split('=',1)
+      except ValueError:
+        logging.warning('failed to parse line [{}]'.format(line))
+      else:
+        mimetype = sys.intern(mimetype.rstrip())
+        # The standard only supports desktop file names. Strip diretory
+        # components from the path to ensure. This ensures that joined paths
+        # point to the "right" directory.
+        desktops = shared_desktops(
+          os.path.basename(d.strip()) for d in desktops.split(';') if d
+        )
+        if desktops:
+          try:
+            associations[section][mimetype] = desktops
+          except KeyError:
+            associations[section] = {mimetype : desktops}
+  return associations
+
+
+
+def remove_empty_associations(assocs):
+  '''
+  Remove empty entries and sections.
+  '''
+  empty_sections = set()
+  for section, entries in assocs.items():
+    empty_keys = set()
+    for key, values in entries.items():
+      if not values:
+        empty_keys.add(key)
+    for k in empty_keys:
+      del entries[k]
+    if not entries:
       empty_sections.add(section)
   for s in empty_sections:
     del assocs[s]
@@ -898,12 +3149,14 @@ def add_association(assocs, section, key, value):
   if section and key and value:
     try:
       # Move it to the front of the list.
-      assocs[section][key] = [value] + [x for x in assocs[section][key] if x != value]
+      assocs[section][key] = shared_desktops(
+        itertools.chain((value,), (x for x in assocs[section][key] if x != value))
+      )
     except KeyError:
       try:
-        assocs[section][key] = [value]
+        assocs[section][key] = shared_desktops((value,))
       except KeyError:
-        assocs[section] = {key : [value]}
+        assocs[section] = {key : shared_desktops((value,))}
   return assocs
 
 
@@ -917,10 +3170,14 @@ def remove_association(assocs, section, key, value=None):
       if not value:
         del assocs[section][key]
       else:
-        assocs[section][key].remove(value)
-        if not assocs[section][key]:
-          del assocs[section][key]
-    except (KeyError, ValueError):
+        values = assocs[section][key]
+        if value in values:
+          values = shared_desktops(x for x in values if x != value)
+          if values:
+            assocs[section][key] = values
+          else:
+            del assocs[section][key]
+    except KeyError:
       pass
   return assocs
 
@@ -977,22 +3234,23 @@ def desktop_entry(path, none_if_error=False):
   Load a desktop entry. Some minor corrections are applied to the desktop entry
   here so use this function whenever a desktop entry is needed.
   '''
-  de = xdg.DesktopEntry.DesktopEntry()
-  # This is necessary because the filename attribute is only set in the "new"
-  # method for some reason.
-  de.filename = path
-
-  logging.debug('parsing {}'.format(path))
-  if none_if_error:
-    try:
-      # This will raise ParsingError if the file is not found.
+  with STAGE_TIMER.stage(STAGE_DESKTOP_ENTRY):
+    de = xdg.DesktopEntry.DesktopEntry()
+    # This is necessary because the filename attribute is only set in the "new"
+    # method for some reason.
+    de.filename = path
+
+    logging.debug('parsing %s', path)
+    if none_if_error:
+      try:
+        # This will raise ParsingError if the file is not found.
+        de.parse(path)
+      except xdg.DesktopEntry.ParsingError as e:
+        logging.debug('error loading %s: %s', path, e)
+        return None
+    else:
       de.parse(path)
-    except xdg.DesktopEntry.ParsingError as e:
-      logging.debug('error loading {}: {}'.format(path, e))
-      return None
-  else:
-    de.parse(path)
-  return de
+    return de
 
 
 
@@ -1052,77 +3310,16 @@ def exec_quote_word(word):
 
 
 
-def parse_unexpandable_field_codes(word, field_codes):
+def desktop_entry_to_cmds(de, args=None, term_cmd=None):
   '''
-  Interpolate field codes within an unexpandable command word.
+  Interpolate the Exec entry of the desktop file and iterate over the resulting
+  commands.
   '''
-  field_code = False
-  for c in word:
-    if field_code:
-      field_code = False
-      try:
-        yield field_codes[c]
-      except KeyError:
-        pass
-    elif c == '%':
-      field_code = True
-    else:
-      yield c
-
-
-
-def parse_field_codes(word, name, args=None, icon=None, path=None, omit_empty=False):
-  '''
-  Interpolate field codes within a single command word.
-  '''
-  if not args:
-    args = tuple()
-  if word == '%i':
-    if icon:
-      yield '--icon'
-      yield icon
-  elif word == '%F':
-    for a in args:
-      p = ensure_path(a)
-      if p:
-        yield p
-  elif word == '%U':
-    for a in args:
-      yield ensure_url(a)
-  elif word in ('%f', '%u') and not args:
-    pass
-  else:
-    field_codes = {
-      '%' : '%',
-      'c' : name,
-      'k' : path if path else '',
-      'f' : '',
-      'u' : ''
-    }
-    # Use first (and only) value if there is one.
-    for arg in args:
-      p = ensure_path(arg)
-      field_codes['f'] = p if p else ''
-      field_codes['u'] = ensure_url(arg)
-      break
-    interpolated_word = ''.join(parse_unexpandable_field_codes(word, field_codes))
-    if interpolated_word \
-    or not omit_empty \
-    or not word in ('%{}'.format(c) for c in 'kfu'):
-      yield ''.join(parse_unexpandable_field_codes(word, field_codes))
-
-
-
-def desktop_entry_to_cmds(de, args=None, term_cmd=None):
-  '''
-  Interpolate the Exec entry of the desktop file and iterate over the resulting
-  commands.
-  '''
-  exe = de.getExec()
-  icon = de.getIcon()
-  name = de.getName()
-  is_term = de.getTerminal()
-  path = de.filename
+  exe = de.getExec()
+  icon = de.getIcon()
+  name = de.getName()
+  is_term = de.getTerminal()
+  path = de.filename
 
   return exec_field_to_cmds(
     exe, args, name, icon=icon, path=path, is_term=is_term, term_cmd=term_cmd
@@ -1147,688 +3344,3212 @@ def exec_field_to_cmds_without_term(exe, args, name, icon=None, path=None):
   '''
   Interpolate a Desktop Entry Exec field.
   '''
-  test_exe = exe.replace('%%', '')
-  single = False
-  codes = set()
-  for c in 'fuFU':
-    if ('%' + c) in test_exe:
-      codes.add(c)
-      if c in 'fu':
-        single = True
-  if len(codes) > 1:
-    raise xdg.DesktopEntry.ValidationError(
-      'command should only contain at most one of the following: {}'.format(
-        ' '.join(('%'+x) for x in codes)
-      )
-    )
-
-  words = shlex.split(exe)
+  template = exec_template(exe)
   if not args:
     argss = tuple((tuple(),))
-  elif single:
+  elif template.single:
     argss = ((a,) for a in args)
   else:
     argss = (args,)
   for aa in argss:
-    yield list(itertools.chain.from_iterable(
-      parse_field_codes(w, name, icon=icon, path=path, args=aa)
-      for w in words
-    ))
-
+    with STAGE_TIMER.stage(STAGE_EXEC_INTERPOLATION):
+      cmd = template.fill(name, args=aa, icon=icon, path=path)
+    yield cmd
 
 
-################################ MimeappsCache #################################
 
-class MimeappsCache(object):
-  def __init__(self):
-    self.associations = dict()
+################################ Exec Templates ################################
 
+class ExecTemplate(object):
+  '''
+  A Desktop Entry Exec field that has been split into words and scanned for
+  field codes once so that it can be interpolated repeatedly.
+  '''
+  def __init__(self, exe):
+    test_exe = exe.replace('%%', '')
+    self.single = False
+    codes = set()
+    for c in 'fuFU':
+      if ('%' + c) in test_exe:
+        codes.add(c)
+        if c in 'fu':
+          self.single = True
+    self.codes = frozenset(codes)
+    if len(codes) > 1:
+      raise xdg.DesktopEntry.ValidationError(
+        'command should only contain at most one of the following: {}'.format(
+          ' '.join(('%'+x) for x in codes)
+        )
+      )
+    self.words = tuple(self.compile_word(w) for w in shlex.split(exe))
 
 
-  def clear(self):
-    self.associations.clear()
 
+  @staticmethod
+  def compile_word(word):
+    '''
+    Compile a single word to a (kind, data) tuple. The data of EXEC_WORD_PARTS
+    words is a tuple of (literal, field code) pairs in which the field code is
+    one of "ckfu" or None.
+    '''
+    if word == '%i':
+      return EXEC_WORD_ICON, None
+    elif word == '%F':
+      return EXEC_WORD_FILES, None
+    elif word == '%U':
+      return EXEC_WORD_URLS, None
+    elif word == '%f':
+      return EXEC_WORD_FILE, None
+    elif word == '%u':
+      return EXEC_WORD_URL, None
+    parts = list()
+    literal = ''
+    field_code = False
+    for c in word:
+      if field_code:
+        field_code = False
+        if c == '%':
+          literal += c
+        elif c in 'ckfu':
+          parts.append((literal, c))
+          literal = ''
+        # Other field codes are removed.
+      elif c == '%':
+        field_code = True
+      else:
+        literal += c
+    if parts:
+      if literal:
+        parts.append((literal, None))
+      return EXEC_WORD_PARTS, tuple(parts)
+    else:
+      return EXEC_WORD_LITERAL, literal
 
 
-  def __getitem__(self, path):
-    try:
-      return self.associations[path]
-    except KeyError:
-      assocs = load_associations(path)
-      self.associations[path] = assocs
-      return assocs
 
+  def fill(self, name, args=None, icon=None, path=None):
+    '''
+    Interpolate the template with the given arguments and return the command.
+    '''
+    if not args:
+      args = tuple()
+    cmd = list()
+    # The values of %f and %u are only determined when needed.
+    field_codes = None
+    for kind, data in self.words:
+      if kind == EXEC_WORD_LITERAL:
+        cmd.append(data)
+      elif kind == EXEC_WORD_ICON:
+        if icon:
+          cmd.append('--icon')
+          cmd.append(icon)
+      elif kind == EXEC_WORD_FILES:
+        for a in args:
+          p = ensure_path(a)
+          if p:
+            cmd.append(p)
+      elif kind == EXEC_WORD_URLS:
+        cmd.extend(ensure_url(a) for a in args)
+      elif args or kind == EXEC_WORD_PARTS:
+        if field_codes is None:
+          field_codes = {
+            'c' : name,
+            'k' : path if path else '',
+            'f' : '',
+            'u' : ''
+          }
+          # Use first (and only) value if there is one.
+          for arg in args:
+            p = ensure_path(arg)
+            field_codes['f'] = p if p else ''
+            field_codes['u'] = ensure_url(arg)
+            break
+        if kind == EXEC_WORD_FILE:
+          cmd.append(field_codes['f'])
+        elif kind == EXEC_WORD_URL:
+          cmd.append(field_codes['u'])
+        else:
+          cmd.append(''.join(
+            (literal + field_codes[c]) if c else literal for literal, c in data
+          ))
+    return cmd
 
-  def __setitem__(self, path, assocs):
-    self.associations.__setitem__(path, assocs)
 
 
+@functools.lru_cache(maxsize=EXEC_TEMPLATE_CACHE_SIZE)
+def exec_template(exe):
+  '''
+  Get the compiled ExecTemplate of an Exec field.
+  '''
+  return ExecTemplate(exe)
 
-  def __delitem__(self, path):
-    self.associations.__delitem__(path)
 
 
+class TermTemplate(object):
+  '''
+  A terminal command that has been split into words and scanned for
+  placeholders once so that it can be interpolated repeatedly.
+  '''
+  def __init__(self, term_cmd):
+    self.words = tuple(self.compile_word(w) for w in shlex.split(term_cmd))
+    # The application command is appended if there are no placeholders.
+    self.append = all(kind == TERM_WORD_LITERAL for kind, _ in self.words)
 
-#################################### Mimeo #####################################
 
-class Mimeo(object):
-  def __init__(
-    self,
-    user=True,
-    system=True,
-    include_deprecated=False,
-    term_cmd=None,
-    by_content_first=False,
-    by_content_only=False,
-    by_name_only=False,
-    follow=True,
-    current_desktop=False,
-    mimeo_assocs=None,
-    none_on_de_parsing_err=True,
-  ):
-    self.user = user
-    self.system = system
-    self.include_deprecated = include_deprecated
-    self.term_cmd = term_cmd
-    self.by_content_first=by_content_first
-    self.by_content_only=by_content_only
-    self.by_name_only=by_name_only
-    self.follow=follow
-    self.current_desktop=current_desktop
-    self.mimeo_assocs=mimeo_assocs
-    self.none_on_de_parsing_err = none_on_de_parsing_err
 
-    self.associations = dict()
-    self.seen_mimetypes = set()
-    self.reset()
+  @staticmethod
+  def compile_word(word):
+    '''
+    Compile a single word to a (kind, data) tuple. The data of TERM_WORD_PARTS
+    words is a tuple of the literal strings between the placeholders.
+    '''
+    if word == TERM_COMMAND_PLACEHOLDER:
+      return TERM_WORD_CMD, None
+    parts = list()
+    literal = ''
+    escaped = False
+    for c in word:
+      if escaped:
+        if c == TERM_COMMAND_PLACEHOLDER[1]:
+          parts.append(literal)
+          literal = ''
+        else:
+          literal += c
+        escaped = False
+      elif c == TERM_COMMAND_PLACEHOLDER[0]:
+        escaped = True
+      else:
+        literal += c
+    if parts:
+      parts.append(literal)
+      return TERM_WORD_PARTS, tuple(parts)
+    else:
+      return TERM_WORD_LITERAL, literal
 
 
 
-  def reset(self):
+  def fill(self, app_cmd):
     '''
-    Clear cached data.
+    Interpolate the template with the given application command and return
+    the resulting command.
+
+    >>> TermTemplate('xterm -e').fill(['vim', 'a b'])
+    ['xterm', '-e', 'vim', 'a b']
+    >>> TermTemplate('urxvt -e %s --').fill(['vim', 'a b'])
+    ['urxvt', '-e', 'vim', 'a b', '--']
+    >>> TermTemplate("xterm -e bash -c 'exec %s' 100%%").fill(['vim', 'a b'])
+    ['xterm', '-e', 'bash', '-c', "exec vim 'a b'", '100%']
     '''
-    self.mimetypes_knownfiles = [os.path.expanduser('~/.mime.types')] + mimetypes.knownfiles
-    self.associations.clear()
-    self.seen_mimetypes.clear()
-    self.initialize()
+    app_cmd_word = ' '.join(shlex.quote(w) for w in app_cmd)
+    cmd = list()
+    for kind, data in self.words:
+      if kind == TERM_WORD_LITERAL:
+        cmd.append(data)
+      elif kind == TERM_WORD_CMD:
+        cmd.extend(app_cmd)
+      else:
+        cmd.append(app_cmd_word.join(data))
+    if self.append:
+      cmd.extend(app_cmd)
+    return cmd
 
 
 
-  def initialize(self):
-    '''
-    Initialize mimetypes internal data structures etc.
-    '''
-    mimetypes.init(self.mimetypes_knownfiles)
+@functools.lru_cache(maxsize=EXEC_TEMPLATE_CACHE_SIZE)
+def term_template(term_cmd):
+  '''
+  Get the compiled TermTemplate of a terminal command.
+  '''
+  return TermTemplate(term_cmd)
 
 
 
-  def load_mimeo_associations(self, fpath=None):
+################################ Bounded Caches ################################
+
+def approximate_size(obj):
+  '''
+  Approximate the memory used by an object, including the items of contained
+  dicts, lists, tuples and sets. Shared objects are counted every time that
+  they occur so this is an upper bound.
+  '''
+  size = sys.getsizeof(obj)
+  if isinstance(obj, dict):
+    for k, v in obj.items():
+      size += approximate_size(k) + approximate_size(v)
+  elif isinstance(obj, (list, tuple, set, frozenset)):
+    for x in obj:
+      size += approximate_size(x)
+  elif isinstance(obj, xdg.IniFile.IniFile):
+    size += approximate_size(obj.content)
+  return size
+
+
+
+class CacheBudget(object):
+  '''
+  A memory budget shared by several BoundedCache instances. When the total
+  approximate size of the cached values exceeds the budget, the least recently
+  used entries across all registered caches are evicted.
+  '''
+  def __init__(self, max_bytes=DEFAULT_CACHE_BUDGET):
+    self.max_bytes = max_bytes
+    self.used = 0
+    self.tick = 0
+    self.caches = list()
+    self.lock = threading.RLock()
+
+
+
+  def register(self, cache):
+    self.caches.append(cache)
+
+
+
+  def next_tick(self):
     '''
-    Load custom Mimeo association. If fpath is None,
+    Return a counter value for recording the recency of cache accesses.
     '''
-    self.mimeo_assocs = None
-    if fpath is None:
-      for fpath in default_mimeo_associations_paths():
-        try:
-          self.mimeo_assocs = list(parse_mimeo_associations(fpath))
-          break
-        except FileNotFoundError:
-          continue
-    elif fpath:
-      self.mimeo_assocs = list(parse_mimeo_associations(fpath))
+    self.tick += 1
+    return self.tick
 
 
 
-  def get_associations(self, path):
+  def enforce(self):
     '''
-    Get possibly cached associations from the given path.
+    Evict entries until the budget is respected.
     '''
-    try:
-      return self.associations[path]
-    except KeyError:
+    while self.used > self.max_bytes:
+      oldest = None
+      for cache in self.caches:
+        tick = cache.oldest_tick()
+        if tick is not None and (oldest is None or tick < oldest[0]):
+          oldest = (tick, cache)
+      if oldest is None:
+        break
+      oldest[1].evict_oldest()
+
+
+
+class BoundedCache(object):
+  '''
+  A dict-like LRU cache that accounts for the approximate size of its values in
+  a CacheBudget. Hits, misses and evictions are counted. Values larger than the
+  whole budget are not cached.
+  '''
+  def __init__(self, name, budget):
+    self.name = name
+    self.budget = budget
+    # key -> (tick, size, value), ordered from least to most recently used.
+    self.entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.size = 0
+    budget.register(self)
+
+
+
+  def __getitem__(self, key):
+    with self.budget.lock:
       try:
-        assocs = load_associations(path)
-      except FileNotFoundError:
-        return None
-      else:
-        self.associations[path] = assocs
-        return assocs
+        _, size, value = self.entries[key]
+      except KeyError:
+        self.misses += 1
+        raise
+      self.hits += 1
+      self.entries[key] = (self.budget.next_tick(), size, value)
+      self.entries.move_to_end(key)
+      return value
 
 
 
-  def mimeapps_directories(self):
-    '''
-    Iterate over application directory paths.
-    '''
-    yield from itertools.chain.from_iterable(mimeapps_directories(
-      user=self.user,
-      system=self.system
-    ))
+  def __setitem__(self, key, value):
+    size = approximate_size(value)
+    with self.budget.lock:
+      self.discard(key)
+      if size > self.budget.max_bytes:
+        self.evictions += 1
+        return
+      self.entries[key] = (self.budget.next_tick(), size, value)
+      self.size += size
+      self.budget.used += size
+      self.budget.enforce()
 
 
 
-  def mimeapps_list_paths(self):
-    '''
-    Iterate over mimeapps.list paths.
-    '''
-    return mimeapps_list_paths(
-      current_desktop=True,
-      include_user_app_dir=self.include_deprecated
-    )
+  def __delitem__(self, key):
+    with self.budget.lock:
+      _, size, _ = self.entries.pop(key)
+      self.size -= size
+      self.budget.used -= size
 
 
 
-  def desktop_paths(self, sort_per_dir=False):
-    '''
-    Iterate over desktop entry paths.
-    '''
-    return desktop_paths(
-      user=self.user,
-      system=self.system,
-      sort_per_dir=sort_per_dir
-    )
+  def __contains__(self, key):
+    return key in self.entries
 
 
 
-  def mimeinfo_caches(self):
-    '''
-    Update mimeinfo caches.
-    '''
-    return mimeinfo_caches(
-      user=self.user,
-      system=self.system
-    )
+  def __len__(self):
+    return len(self.entries)
 
 
 
-  def search_desktop_paths(self, ds, first_only=False):
-    '''
-    Search for desktop files. The order is arbitrary.
-    '''
-    ds = set(ensure_desktop_names(ds))
-    found = set()
-    for dpath in desktop_directories(user=self.user, system=self.system):
-      for d in ds:
-        path = os.path.join(dpath, d)
-        if os.path.exists(path):
-          yield path
-          if first_only:
-            found.add(d)
-      if first_only:
-        ds -= found
+  def discard(self, key):
+    try:
+      del self[key]
+    except KeyError:
+      pass
 
 
 
-  def update_mimeinfo_caches(self):
-    '''
-    Update mimeinfo caches.
-    '''
-    update_mimeinfo_caches(
-      user=self.user,
-      system=self.system
-    )
+  def clear(self):
+    with self.budget.lock:
+      self.budget.used -= self.size
+      self.size = 0
+      self.entries.clear()
 
 
 
-  def mimeapps_list_paths_and_assocs(self):
+  def items(self):
     '''
-    Iterate over mimeapps.list files and their paths.
+    Return a list of the cached keys and values.
     '''
-    for path in self.mimeapps_list_paths():
-      yield path, self.get_associations(path)
+    with self.budget.lock:
+      return list((k, v) for k, (_, _, v) in self.entries.items())
 
 
 
-  def section_entries(self, paths, sections):
-    '''
-    Iterate over all entries for the given paths and sections.
-    '''
-    for path in paths:
-      assocs = self.get_associations(path)
-      if not assocs:
-        continue
-      for section in sections:
-        try:
-          for e in assocs[section]:
-            yield e
-        except KeyError:
-          pass
+  def oldest_tick(self):
+    for tick, _, _ in self.entries.values():
+      return tick
+    return None
 
 
 
-  def associated_desktop_paths(self, mimetype):
+  def evict_oldest(self):
+    key = next(iter(self.entries))
+    del self[key]
+    self.evictions += 1
+
+
+
+  def stats(self):
     '''
-    Iterate over desktop files associated with a given MIME-type.
+    Return a dict of usage statistics.
     '''
-    # The added associations are given in order of preference so a list must be
-    # used.
-    added = list()
-    blacklist = set()
-    for path, assocs in self.mimeapps_list_paths_and_assocs():
-      blacklist.update(iterate_associations(assocs, REMOVED_ASSOCIATIONS_SECTION, mimetype))
+    return collections.OrderedDict((
+      ('entries', len(self.entries)),
+      ('bytes', self.size),
+      ('hits', self.hits),
+      ('misses', self.misses),
+      ('evictions', self.evictions),
+    ))
 
-      added = list(a for a in added if a not in blacklist)
-      added.extend(
-        a for a in iterate_associations(assocs, ADDED_ASSOCIATIONS_SECTION, mimetype)
-        if a not in blacklist and a not in added
-      )
 
-      dpath = os.path.dirname(path)
-      mimeinfo_cache_path = os.path.join(dpath, MIMEINFO_CACHE_FILE)
 
-      mimeinfo_cache_assocs = self.get_associations(mimeinfo_cache_path)
-      local_associations = added.copy()
-      local_associations.extend(
-        x for x in iterate_associations(mimeinfo_cache_assocs, MIME_CACHE_SECTION, mimetype)
-        if x not in blacklist and x not in added
-      )
+################################## URL Probing #################################
 
-      for d in local_associations:
-        desktop_path = os.path.join(dpath, d)
-        if os.path.exists(desktop_path):
-          yield desktop_path
+class URLProber(object):
+  '''
+  Determine the MIME-type of HTTP(S) URLs from the Content-Type header. HEAD
+  requests are used with a fallback to GET requests for the first byte.
+  Connections are kept alive and reused per host, and every request is subject
+  to a timeout. The oldest idle connections are closed when too many are kept
+  across all hosts. HTTP proxies from the proxy environment variables (e.g.
+  http_proxy, https_proxy and no_proxy) are used. Results are cached for a
+  limited time in the given cache, which may be any dict-like object.
+  '''
+  def __init__(self, cache=None, timeout=URL_PROBE_TIMEOUT, ttl=URL_PROBE_TTL):
+    import urllib.request
+    self.cache = dict() if cache is None else cache
+    self.timeout = timeout
+    self.ttl = ttl
+    self.proxies = urllib.request.getproxies_environment()
+    # [((scheme, netloc), idle connection)], from least to most recently used.
+    self.idle = list()
+    self.lock = threading.Lock()
 
 
 
-  def default_desktop_filenames(self, mimetype):
+  def proxy(self, scheme, netloc):
     '''
-    Iterate over default desktop filenames.
+    Get the address and headers of the proxy for the host, or None if it should
+    be contacted directly. Only HTTP proxies are supported.
     '''
-    for path in self.mimeapps_list_paths():
-      assocs = self.get_associations(path)
-      yield from iterate_associations(assocs, DEFAULT_APPLICATIONS_SECTION, mimetype)
+    import urllib.request
+    proxy_url = self.proxies.get(scheme)
+    if not proxy_url or urllib.request.proxy_bypass_environment(netloc, self.proxies):
+      return None
+    if '://' not in proxy_url:
+      proxy_url = 'http://' + proxy_url
+    parsed_proxy_url = urllib.parse.urlsplit(proxy_url)
+    if parsed_proxy_url.scheme != 'http':
+      logging.warning('ignoring unsupported proxy for {}: {}'.format(scheme, proxy_url))
+      return None
+    headers = dict()
+    if parsed_proxy_url.username is not None:
+      import base64
+      credentials = '{}:{}'.format(
+        urllib.parse.unquote(parsed_proxy_url.username),
+        urllib.parse.unquote(parsed_proxy_url.password or '')
+      )
+      headers['Proxy-Authorization'] = 'Basic {}'.format(
+        base64.b64encode(credentials.encode()).decode()
+      )
+    return parsed_proxy_url.netloc.rpartition('@')[2], headers
 
 
 
-  @unique_items
-  def mimetype_to_desktop_filepaths(
-    self,
-    mimetype,
+  def connection(self, scheme, netloc, proxy=None):
+    '''
+    Get an idle connection to the host or create a new one. HTTPS connections
+    are tunneled through the proxy if one is given.
+    '''
+    import http.client
+    key = (scheme, netloc)
+    with self.lock:
+      for i in range(len(self.idle) - 1, -1, -1):
+        if self.idle[i][0] == key:
+          return self.idle.pop(i)[1]
+    if proxy is None:
+      host = netloc
+    else:
+      host = proxy[0]
+    if scheme == 'https':
+      conn = http.client.HTTPSConnection(host, timeout=self.timeout)
+      if proxy is not None:
+        conn.set_tunnel(netloc, headers=proxy[1])
+      return conn
+    else:
+      return http.client.HTTPConnection(host, timeout=self.timeout)
+
+
+
+  def release(self, scheme, netloc, conn):
+    '''
+    Return a connection to the pool or close it if the pool of the host is full.
+    The oldest idle connection is closed if too many are kept.
+    '''
+    key = (scheme, netloc)
+    with self.lock:
+      if sum(1 for k, _ in self.idle if k == key) >= URL_PROBE_POOL_SIZE:
+        closed = conn
+      else:
+        self.idle.append((key, conn))
+        if len(self.idle) > URL_PROBE_MAX_IDLE:
+          closed = self.idle.pop(0)[1]
+        else:
+          return
+    closed.close()
+
+
+
+  def close(self):
+    '''
+    Close all idle connections.
+    '''
+    with self.lock:
+      for _, conn in self.idle:
+        conn.close()
+      self.idle.clear()
+
+
+
+  def request(self, method, url, headers=None):
+    '''
+    Send a request without reading the body and return the status, the
+    Content-Type and the Location headers. A reused connection that was closed
+    by the server is replaced once.
+    '''
+    import http.client
+    parsed_url = urllib.parse.urlsplit(url)
+    scheme = parsed_url.scheme
+    netloc = parsed_url.netloc
+    proxy = self.proxy(scheme, netloc)
+    if headers is None:
+      headers = dict()
+    if proxy is not None and scheme != 'https':
+      # Plain HTTP proxies receive the absolute URL.
+      target = urllib.parse.urlunsplit((scheme, netloc, parsed_url.path or '/', parsed_url.query, ''))
+      headers = dict(headers, **proxy[1])
+    else:
+      target = urllib.parse.urlunsplit(('', '', parsed_url.path or '/', parsed_url.query, ''))
+    for attempt in (0, 1):
+      conn = self.connection(scheme, netloc, proxy=proxy)
+      reused = conn.sock is not None
+      try:
+        conn.request(method, target, headers=headers)
+        response = conn.getresponse()
+      except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+        conn.close()
+        if reused and not attempt:
+          continue
+        raise
+      except (OSError, http.client.HTTPException, ValueError):
+        conn.close()
+        raise
+      break
+
+    result = (
+      response.status,
+      response.getheader('Content-Type'),
+      response.getheader('Location'),
+    )
+    # Only reuse the connection if the body is small enough to discard. A
+    # server that ignores the Range header may otherwise send the whole file.
+    length = response.getheader('Content-Length')
+    if method == 'HEAD' or (length is not None and length.isdigit() and int(length) <= 1024):
+      response.read()
+      if response.will_close:
+        conn.close()
+      else:
+        self.release(scheme, netloc, conn)
+    else:
+      conn.close()
+    return result
+
+
+
+  def probe(self, url):
+    '''
+    Request the Content-Type of the URL, following redirects.
+    '''
+    for _ in range(URL_PROBE_MAX_REDIRECTS + 1):
+      status, content_type, location = self.request('HEAD', url)
+      if status in URL_PROBE_HEAD_UNSUPPORTED_STATUSES \
+      or (status < 300 and not content_type):
+        status, content_type, location = self.request(
+          'GET', url, headers={'Range' : 'bytes=0-0'}
+        )
+      if status in URL_PROBE_REDIRECT_STATUSES and location:
+        url = urllib.parse.urljoin(url, location)
+        continue
+      if status < 300 and content_type:
+        return content_type.split(';', 1)[0].strip().lower()
+      return None
+    logging.warning('too many redirects: {}'.format(url))
+    return None
+
+
+
+  def content_type(self, url):
+    '''
+    Return the possibly cached MIME-type of the URL or None if it could not be
+    determined.
+    '''
+    import http.client
+    now = time.monotonic()
+    try:
+      expiry, mimetype = self.cache[url]
+    except KeyError:
+      pass
+    else:
+      if now < expiry:
+        return mimetype
+    try:
+      mimetype = self.probe(url)
+    except (OSError, http.client.HTTPException, ValueError) as e:
+      logging.warning('failed to probe {}: {}'.format(url, e))
+      mimetype = None
+    logging.debug('probed {}: {}'.format(url, mimetype))
+    self.cache[url] = (now + self.ttl, mimetype)
+    return mimetype
+
+
+
+################################### Snapshot ###################################
+
+class Snapshot(object):
+  '''
+  Parsed data from configuration files that is saved across invocations. Each
+  entry is stored with the stat signatures of its source files and the data is
+  only parsed again when a signature changes. The snapshot is serialized with
+  marshal so all values must consist of built-in types.
+  '''
+  def __init__(self, path=None):
+    self.path = path if path else default_snapshot_path()
+    # (kind, source paths...) -> (signatures, value)
+    self.entries = dict()
+    self.modified = False
+    self.lock = threading.Lock()
+
+
+
+  def load(self):
+    '''
+    Load the snapshot file if it exists and has the current version.
+    '''
+    try:
+      with open(self.path, 'rb') as f:
+        logging.debug('loading {}'.format(self.path))
+        data = f.read()
+    except FileNotFoundError:
+      return
+    try:
+      version, entries = marshal.loads(data)
+    except (EOFError, ValueError, TypeError) as e:
+      logging.warning('failed to load {}: {}'.format(self.path, e))
+      return
+    if version == SNAPSHOT_VERSION:
+      self.entries = entries
+    else:
+      logging.debug('ignoring snapshot version {}'.format(version))
+
+
+
+  def save(self):
+    '''
+    Save the snapshot file if it has been modified.
+    '''
+    if not self.modified:
+      return
+    with self.lock:
+      data = marshal.dumps((SNAPSHOT_VERSION, self.entries))
+      self.modified = False
+    save_atomically(self.path, data)
+
+
+
+  def get(self, kind, paths, parse):
+    '''
+    Get the value of an entry. If the signatures of the source paths have
+    changed, the value is replaced with the return value of parse().
+    '''
+    key = (kind,) + tuple(paths)
+    signatures = tuple(stat_signature(p) for p in paths)
+    try:
+      cached_signatures, value = self.entries[key]
+    except KeyError:
+      pass
+    else:
+      if cached_signatures == signatures:
+        return value
+    value = parse()
+    with self.lock:
+      self.entries[key] = (signatures, value)
+      self.modified = True
+    return value
+
+
+
+  def put(self, kind, paths, value):
+    '''
+    Set the value of an entry with the current signatures of the source paths.
+    '''
+    key = (kind,) + tuple(paths)
+    signatures = tuple(stat_signature(p) for p in paths)
+    with self.lock:
+      try:
+        if self.entries[key] == (signatures, value):
+          return
+      except KeyError:
+        pass
+      self.entries[key] = (signatures, value)
+      self.modified = True
+
+
+
+############################### Launch Coalescing ##############################
+
+def default_launches_path():
+  '''
+  The path to the file of recent launches in the runtime directory.
+  '''
+  return os.path.join(
+    xdg.BaseDirectory.get_runtime_dir(strict=False),
+    NAME.lower(),
+    LAUNCHES_FILE
+  )
+
+
+
+def launch_key(kind, *values):
+  '''
+  Hash values to a launch record key.
+  '''
+  import hashlib
+  return hashlib.sha1(json.dumps((kind,) + values).encode()).hexdigest()
+
+
+
+class LaunchCoalescer(object):
+  '''
+  Drop launches that repeat a recent launch within a time window, across
+  processes. Recent launches are recorded as hashed keys with timestamps in a
+  small file that is locked with flock while it is checked and updated.
+  '''
+  def __init__(self, window=DEFAULT_COALESCE_WINDOW, path=None):
+    self.window = window
+    self.path = path if path else default_launches_path()
+
+
+
+  def is_duplicate(self, key):
+    '''
+    Check if the key has been recorded within the window. If not, record it.
+    Errors are logged and the launch is never considered a duplicate.
+    '''
+    now = time.time()
+    try:
+      os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+      fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError as e:
+      logging.warning('failed to open {}: {}'.format(self.path, e))
+      return False
+    with open(fd, 'r+') as f:
+      try:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        records = list()
+        for line in f:
+          try:
+            t, k = line.split()
+            t = float(t)
+          except ValueError:
+            continue
+          if 0 <= now - t < self.window:
+            if k == key:
+              logging.debug('coalescing launch {} from {:f}'.format(key, t))
+              STAGE_TIMER.count(COUNTER_COALESCED_LAUNCHES)
+              return True
+            records.append(line)
+        records.append('{:f} {}\n'.format(now, key))
+        f.seek(0)
+        f.truncate()
+        f.writelines(records)
+      except OSError as e:
+        logging.warning('failed to update {}: {}'.format(self.path, e))
+      # Closing the file releases the lock.
+    return False
+
+
+
+############################## Desktop Entry Index #############################
+
+def default_desktop_index_path(env=None):
+  '''
+  The path to the persistent desktop entry index.
+  '''
+  return os.path.join(
+    xdg.BaseDirectory.xdg_cache_home if env is None else env.cache_home,
+    NAME.lower(),
+    DESKTOP_INDEX_FILE
+  )
+
+
+
+def desktop_entry_record(path):
+  '''
+  Extract the indexed fields of a desktop entry as a tuple:
+
+    (name, generic name, keywords, Exec, icon, visible, OnlyShowIn,
+    NotShowIn, TryExec)
+
+  "visible" is False for hidden entries and for entries that should not be
+  displayed. None is returned if the entry cannot be parsed.
+  '''
+  de = desktop_entry(path, none_if_error=True)
+  if de is None:
+    return None
+  visible = not (
+    de.getHidden() or de.getNoDisplay() or de.getType() != 'Application'
+  )
+  return (
+    de.getName(),
+    de.getGenericName(),
+    tuple(de.getKeywords()),
+    de.getExec(),
+    de.getIcon(),
+    visible,
+    tuple(de.getOnlyShowIn()),
+    tuple(de.getNotShowIn()),
+    de.getTryExec(),
+  )
+
+
+
+def desktop_index_tokens(text):
+  '''
+  Iterate over the search tokens in a string.
+  '''
+  return DESKTOP_INDEX_TOKEN_REGEX.findall(text.casefold())
+
+
+
+def exec_tokens(exe):
+  '''
+  Iterate over the search tokens of the command of an Exec field.
+  '''
+  try:
+    words = shlex.split(exe)
+  except ValueError:
+    words = exe.split()
+  if words:
+    yield from desktop_index_tokens(os.path.basename(words[0]))
+
+
+
+class DesktopIndex(object):
+  '''
+  A persistent inverted index over the Name, GenericName, Keywords and Exec
+  fields of all desktop entries. Parsed entries are saved with marshal along
+  with the stat signatures of their files and only changed files are parsed
+  again.
+
+  The index contains one entry per desktop file name in the order of
+  precedence of the desktop directories. Entries that are shadowed by a file
+  with the same name in a more important directory are omitted.
+  '''
+  def __init__(self, dpaths, path=None, env=None):
+    self.dpaths = tuple(dpaths)
+    self.path = path if path else default_desktop_index_path(env=env)
+    self.env = env
+    # Desktop file path -> (signature, record)
+    self.records = dict()
+    # Desktop file paths and records of the indexed entries.
+    self.paths = tuple()
+    self.entries = tuple()
+    # Unique display labels of the indexed entries.
+    self.labels = tuple()
+    # Sorted tokens and their postings, each a tuple of (index, weight) pairs.
+    self.tokens = tuple()
+    self.postings = tuple()
+    self.modified = False
+
+
+
+  def load(self):
+    '''
+    Load the saved index and update it with any changes to the desktop
+    directories.
+    '''
+    saved = None
+    try:
+      with open(self.path, 'rb') as f:
+        logging.debug('loading {}'.format(self.path))
+        saved = marshal.loads(f.read())
+    except FileNotFoundError:
+      pass
+    except (EOFError, ValueError, TypeError) as e:
+      logging.warning('failed to load {}: {}'.format(self.path, e))
+    # Names depend on the locale.
+    langs = tuple(xdg.Locale.langs)
+    if saved and saved[0] == DESKTOP_INDEX_VERSION and saved[1] == langs:
+      _, _, saved_records, saved_paths, self.labels, self.tokens, self.postings = saved
+    else:
+      saved_records = dict()
+      saved_paths = None
+
+    seen = set()
+    paths = list()
+    for dpath in self.dpaths:
+      try:
+        it = os.scandir(dpath)
+      except OSError:
+        continue
+      with it:
+        for entry in sorted(it, key=lambda e: e.name):
+          if not entry.name.endswith(DESKTOP_EXTENSION) \
+          or entry.name in seen:
+            continue
+          try:
+            st = entry.stat()
+          except OSError:
+            continue
+          seen.add(entry.name)
+          signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+          try:
+            saved_signature, record = saved_records[entry.path]
+          except KeyError:
+            saved_signature = None
+          if saved_signature != signature:
+            record = desktop_entry_record(entry.path)
+            self.modified = True
+          self.records[entry.path] = (signature, record)
+          paths.append(entry.path)
+
+    self.paths = tuple(p for p in paths if self.records[p][1] is not None)
+    self.entries = tuple(self.records[p][1] for p in self.paths)
+    if self.modified or saved_paths != self.paths:
+      self.modified = True
+      self.build()
+
+
+
+  def save(self):
+    '''
+    Save the index if it has been modified.
+    '''
+    if self.modified:
+      save_atomically(self.path, marshal.dumps((
+        DESKTOP_INDEX_VERSION,
+        tuple(xdg.Locale.langs),
+        self.records,
+        self.paths,
+        self.labels,
+        self.tokens,
+        self.postings,
+      )))
+      self.modified = False
+
+
+
+  def build(self):
+    '''
+    Build the labels and the inverted index from the entries.
+    '''
+    logging.debug('building desktop entry index')
+    names = collections.Counter(e[0] for e in self.entries)
+    self.labels = tuple(
+      (
+        '{} ({})'.format(e[0], os.path.basename(p)[:-len(DESKTOP_EXTENSION)])
+        if names[e[0]] > 1 or not e[0]
+        else e[0]
+      )
+      for p, e in zip(self.paths, self.entries)
+    )
+    weights = dict()
+    for i, (name, generic_name, keywords, exe, _, _, _, _, _) in enumerate(self.entries):
+      for tokens, weight in (
+        (desktop_index_tokens(name), DESKTOP_INDEX_NAME_WEIGHT),
+        (desktop_index_tokens(generic_name), DESKTOP_INDEX_GENERIC_NAME_WEIGHT),
+        (
+          itertools.chain.from_iterable(desktop_index_tokens(k) for k in keywords),
+          DESKTOP_INDEX_KEYWORDS_WEIGHT
+        ),
+        (exec_tokens(exe), DESKTOP_INDEX_EXEC_WEIGHT),
+      ):
+        for token in tokens:
+          postings = weights.setdefault(token, dict())
+          if postings.get(i, 0) < weight:
+            postings[i] = weight
+    self.tokens = tuple(sorted(weights))
+    self.postings = tuple(
+      tuple(sorted(weights[t].items())) for t in self.tokens
+    )
+
+
+
+  def is_visible(self, i, desktops):
+    '''
+    Check if an entry should be displayed on the given current desktops.
+    '''
+    _, _, _, _, _, visible, only_show_in, not_show_in, try_exec = self.entries[i]
+    if not visible:
+      return False
+    if only_show_in and not any(d in only_show_in for d in desktops):
+      return False
+    if not_show_in and any(d in not_show_in for d in desktops):
+      return False
+    if try_exec and not which(try_exec, env=self.env):
+      return False
+    return True
+
+
+
+  def visible(self):
+    '''
+    Iterate over the indices of the visible entries, sorted by label.
+    '''
+    desktops = current_desktops(env=self.env)
+    for i in sorted(range(len(self.entries)), key=lambda i: self.labels[i].casefold()):
+      if self.is_visible(i, desktops):
+        yield i
+
+
+
+  def search(self, query):
+    '''
+    Return the indices of the visible entries that match every token of the
+    query, either exactly or by prefix, ranked by the weights of the matching
+    fields. All visible entries are returned if the query contains no tokens.
+    '''
+    query_tokens = desktop_index_tokens(query)
+    if not query_tokens:
+      return list(self.visible())
+    scores = None
+    for qt in query_tokens:
+      token_scores = dict()
+      start = bisect.bisect_left(self.tokens, qt)
+      end = bisect.bisect_left(self.tokens, qt + '\U0010ffff', start)
+      for j in range(start, end):
+        factor = 2 if self.tokens[j] == qt else 1
+        for i, weight in self.postings[j]:
+          score = weight * factor
+          if token_scores.get(i, 0) < score:
+            token_scores[i] = score
+      if scores is None:
+        scores = token_scores
+      else:
+        scores = dict(
+          (i, score + token_scores[i])
+          for i, score in scores.items()
+          if i in token_scores
+        )
+      if not scores:
+        return list()
+    desktops = current_desktops(env=self.env)
+    return sorted(
+      (i for i in scores if self.is_visible(i, desktops)),
+      key=lambda i: (-scores[i], self.labels[i].casefold())
+    )
+
+
+
+  def find_label(self, label):
+    '''
+    Return the index of the entry with the given label, or None.
+    '''
+    try:
+      return self.labels.index(label)
+    except ValueError:
+      return None
+
+
+
+################################# Icon Themes ##################################
+
+def default_icon_index_path(env=None):
+  '''
+  The path to the persistent icon theme index.
+  '''
+  return os.path.join(
+    xdg.BaseDirectory.xdg_cache_home if env is None else env.cache_home,
+    NAME.lower(),
+    ICON_INDEX_FILE
+  )
+
+
+
+def icon_base_directories(env=None):
+  '''
+  The base directories of icon themes in the order of the icon theme
+  specification: $HOME/.icons, the "icons" subdirectories of the data
+  directories and ICON_PIXMAPS_DIR.
+  '''
+  if env is None:
+    env = xdg_environment()
+  return (os.path.join(env.home, ICON_HOME_DIR),) \
+    + tuple(os.path.join(d, ICON_DATA_DIR) for d in env.data_dirs) \
+    + (ICON_PIXMAPS_DIR,)
+
+
+
+def default_icon_theme(env=None):
+  '''
+  Get the name of the icon theme from the GTK settings, or ICON_THEME_FALLBACK.
+  '''
+  config_home = xdg.BaseDirectory.xdg_config_home if env is None else env.config_home
+  path = os.path.join(config_home, *ICON_GTK_SETTINGS)
+  try:
+    with open(path, 'r') as f:
+      for line in f:
+        key, sep, value = line.partition('=')
+        if sep and key.strip() == ICON_GTK_THEME_KEY and value.strip():
+          return value.strip()
+  except (OSError, UnicodeDecodeError):
+    pass
+  return ICON_THEME_FALLBACK
+
+
+
+def mtime_signature(path):
+  '''
+  The modification time of a path, or None if it does not exist.
+  '''
+  try:
+    return os.stat(path).st_mtime_ns
+  except OSError:
+    return None
+
+
+
+def scan_icon_directory(dpath):
+  '''
+  Iterate over the names, extensions and paths of the icons in a directory.
+  '''
+  try:
+    it = os.scandir(dpath)
+  except OSError:
+    return
+  with it:
+    for entry in it:
+      name, ext = os.path.splitext(entry.name)
+      if ext in ICON_EXTENSIONS:
+        yield name, ext, entry.path
+
+
+
+def icon_sort_key(item):
+  '''
+  Sort key for (directory index, base directory index, extension, path) tuples
+  that matches the lookup order of the specification.
+  '''
+  d, b, ext, _ = item
+  return d, b, ICON_EXTENSIONS.index(ext)
+
+
+
+def icon_theme_directory(it, subdir):
+  '''
+  Get the directory tuple of a subdirectory of a parsed index.theme file. See
+  index_icon_theme. The defaults of the specification are applied here because
+  the integer getters of xdg.IconTheme return 0 for missing keys.
+  '''
+  def get_int(key, default):
+    value = it.get(key, group=subdir)
+    return int(value) if value else default
+  size = get_int('Size', 0)
+  return (
+    subdir,
+    size,
+    get_int('Scale', 1),
+    it.get('Type', group=subdir) or 'Threshold',
+    get_int('MinSize', size),
+    get_int('MaxSize', size),
+    get_int('Threshold', 2),
+  )
+
+
+
+def index_icon_theme(theme, base_dirs):
+  '''
+  Scan an icon theme once and return a tuple:
+
+    (signature, inherits, directories, icons)
+
+  The signature contains the modification times of the scanned directories and
+  of the index.theme file, with None for those that do not exist so that they
+  are noticed when they are created. Each directory is a tuple:
+
+    (subdirectory, size, scale, type, minimum size, maximum size, threshold)
+
+  icons maps icon names to the paths of the icon files as tuples of
+  (directory index, path), in lookup order. The theme is defined by the
+  index.theme file in the first base directory that contains one.
+  '''
+  import xdg.IconTheme
+  theme_dirs = tuple(os.path.join(b, theme) for b in base_dirs)
+  signature = list((d, mtime_signature(d)) for d in theme_dirs)
+  inherits = tuple()
+  directories = tuple()
+  for d in theme_dirs:
+    path = os.path.join(d, ICON_THEME_INDEX)
+    mtime = mtime_signature(path)
+    signature.append((path, mtime))
+    if mtime is None:
+      continue
+    it = xdg.IconTheme.IconTheme()
+    try:
+      it.parse(path)
+      subdirs = it.getDirectories() + it.getScaledDirectories()
+      inherits = tuple(i for i in it.getInherits() if i)
+      directories = tuple(
+        icon_theme_directory(it, s) for s in subdirs if s and it.hasGroup(s)
+      )
+    except (xdg.IniFile.ParsingError, ValueError) as e:
+      logging.warning('failed to parse {}: {}'.format(path, e))
+    break
+
+  items = dict()
+  for i, (s, *_) in enumerate(directories):
+    for j, d in enumerate(theme_dirs):
+      dpath = os.path.join(d, s)
+      mtime = mtime_signature(dpath)
+      signature.append((dpath, mtime))
+      if mtime is None:
+        continue
+      for name, ext, path in scan_icon_directory(dpath):
+        items.setdefault(name, list()).append((i, j, ext, path))
+  icons = dict(
+    (name, tuple((i, p) for i, _, _, p in sorted(xs, key=icon_sort_key)))
+    for name, xs in items.items()
+  )
+  return tuple(signature), inherits, directories, icons
+
+
+
+def index_unthemed_icons(base_dirs):
+  '''
+  Scan the base directories for icons that are not part of a theme and return
+  a tuple of the signature and a dict that maps icon names to paths.
+  '''
+  signature = list()
+  items = dict()
+  for j, d in enumerate(base_dirs):
+    mtime = mtime_signature(d)
+    signature.append((d, mtime))
+    if mtime is None:
+      continue
+    for name, ext, path in scan_icon_directory(d):
+      items.setdefault(name, list()).append((0, j, ext, path))
+  icons = dict(
+    (name, min(xs, key=icon_sort_key)[3]) for name, xs in items.items()
+  )
+  return tuple(signature), icons
+
+
+
+def icon_directory_size_distance(directory, size, scale):
+  '''
+  The distance between a theme directory and an icon size as defined by the
+  icon theme specification. It is 0 if the directory matches the size.
+  '''
+  _, dsize, dscale, typ, min_size, max_size, threshold = directory
+  if typ == 'Fixed':
+    return abs(dsize * dscale - size * scale)
+  if typ == 'Scalable':
+    if size * scale < min_size * dscale:
+      return min_size * dscale - size * scale
+    if size * scale > max_size * dscale:
+      return size * scale - max_size * dscale
+    return 0
+  # Threshold
+  if size * scale < (dsize - threshold) * dscale:
+    return min_size * dscale - size * scale
+  if size * scale > (dsize + threshold) * dscale:
+    return size * scale - max_size * dscale
+  return 0
+
+
+
+class IconIndex(object):
+  '''
+  A persistent index of icon themes for looking up icon files by name. Each
+  theme in the inheritance chain of the selected theme is scanned once and
+  saved with marshal along with the modification times of its directories.
+  Only themes with changed directories are scanned again. Lookups follow the
+  icon theme specification without probing the filesystem.
+  '''
+  def __init__(self, theme=None, path=None, env=None, cache_budget=None):
+    self.env = env
+    self.theme = theme if theme else default_icon_theme(env=env)
+    self.path = path if path else default_icon_index_path(env=env)
+    self.base_dirs = icon_base_directories(env=env)
+    # Theme name -> (signature, inherits, directories, icons)
+    self.themes = dict()
+    self.unthemed = (tuple(), dict())
+    # The precomputed inheritance chain of the theme.
+    self.chain = tuple()
+    if cache_budget is None:
+      cache_budget = CacheBudget()
+    self.lookups = BoundedCache('icon_lookups', cache_budget)
+    self.modified = False
+
+
+
+  def load(self):
+    '''
+    Load the saved index and scan the themes of the inheritance chain that
+    have changed.
+    '''
+    saved = None
+    try:
+      with open(self.path, 'rb') as f:
+        logging.debug('loading {}'.format(self.path))
+        saved = marshal.loads(f.read())
+    except FileNotFoundError:
+      pass
+    except (EOFError, ValueError, TypeError) as e:
+      logging.warning('failed to load {}: {}'.format(self.path, e))
+    if saved and saved[0] == ICON_INDEX_VERSION and saved[1] == self.base_dirs:
+      _, _, saved_themes, saved_unthemed = saved
+    else:
+      saved_themes = dict()
+      saved_unthemed = None
+
+    # The inherited themes are searched depth-first and the fallback theme is
+    # always searched last.
+    chain = list()
+    pending = [self.theme, ICON_THEME_FALLBACK]
+    while pending:
+      theme = pending.pop(0)
+      if theme in chain:
+        continue
+      chain.append(theme)
+      indexed = saved_themes.get(theme)
+      if indexed is None or not self.is_current(indexed[0]):
+        logging.debug('indexing icon theme {}'.format(theme))
+        indexed = index_icon_theme(theme, self.base_dirs)
+        self.modified = True
+      self.themes[theme] = indexed
+      pending[:0] = (t for t in indexed[1] if t != ICON_THEME_FALLBACK)
+    self.chain = tuple(chain)
+
+    # Keep other saved themes so that switching themes does not rescan.
+    for theme, indexed in saved_themes.items():
+      self.themes.setdefault(theme, indexed)
+
+    if saved_unthemed is None or not self.is_current(saved_unthemed[0]):
+      self.unthemed = index_unthemed_icons(self.base_dirs)
+      self.modified = True
+    else:
+      self.unthemed = saved_unthemed
+
+
+
+  def is_current(self, signature):
+    '''
+    Check if the modification times of a signature are current.
+    '''
+    return all(mtime_signature(p) == mtime for p, mtime in signature)
+
+
+
+  def save(self):
+    '''
+    Save the index if it has been modified.
+    '''
+    if self.modified:
+      save_atomically(self.path, marshal.dumps((
+        ICON_INDEX_VERSION,
+        self.base_dirs,
+        self.themes,
+        self.unthemed,
+      )))
+      self.modified = False
+
+
+
+  def lookup(self, icon, size=DEFAULT_ICON_SIZE, scale=1):
+    '''
+    Return the path to the file of an icon, or None. Absolute paths are
+    returned if they exist. Names with an icon file extension are accepted
+    for compatibility with older desktop entries.
+    '''
+    key = (icon, size, scale)
+    try:
+      return self.lookups[key]
+    except KeyError:
+      pass
+    if os.path.isabs(icon):
+      path = icon if os.path.isfile(icon) else None
+    else:
+      name, ext = os.path.splitext(icon)
+      if ext not in ICON_EXTENSIONS:
+        name = icon
+      path = None
+      for theme in self.chain:
+        _, _, directories, icons = self.themes[theme]
+        try:
+          candidates = icons[name]
+        except KeyError:
+          continue
+        best = None
+        for i, p in candidates:
+          distance = icon_directory_size_distance(directories[i], size, scale)
+          if distance == 0 and directories[i][2] == scale:
+            path = p
+            break
+          elif best is None or distance < best[0]:
+            best = (distance, p)
+        else:
+          path = best[1]
+        break
+      else:
+        path = self.unthemed[1].get(name)
+    self.lookups[key] = path
+    return path
+
+
+
+#################################### Doctor ####################################
+
+class DesktopDirectoryScan(collections.namedtuple(
+  'DesktopDirectoryScan',
+  ('path', 'desktops', 'subdirectories', 'cache_mtime')
+)):
+  '''
+  A snapshot of a desktop directory. desktops maps the names of the desktop
+  files to their modification times, which are None for broken links.
+  subdirectories is a set of the names of the subdirectories and cache_mtime is
+  the modification time of mimeinfo.cache, or None if it does not exist.
+  '''
+  __slots__ = ()
+
+
+
+def scan_desktop_directory(dpath):
+  '''
+  Scan a desktop directory in a single pass. Returns a DesktopDirectoryScan, or
+  None if the directory does not exist.
+  '''
+  desktops = dict()
+  subdirectories = set()
+  cache_mtime = None
+  try:
+    it = os.scandir(dpath)
+  except OSError:
+    return None
+  with it:
+    for entry in it:
+      try:
+        if entry.name.endswith(DESKTOP_EXTENSION):
+          desktops[entry.name] = None
+          desktops[entry.name] = entry.stat().st_mtime_ns
+        elif entry.name == MIMEINFO_CACHE_FILE:
+          cache_mtime = entry.stat().st_mtime_ns
+        elif entry.is_dir():
+          subdirectories.add(entry.name)
+      except OSError:
+        pass
+  return DesktopDirectoryScan(dpath, desktops, subdirectories, cache_mtime)
+
+
+
+def doctor_desktop_record(path):
+  '''
+  Extract the fields that are checked by the doctor from a desktop entry as a
+  tuple:
+
+    (Exec, TryExec, MIME-types, hidden, error)
+
+  error is the message of the exception if the entry could not be parsed. This
+  runs in worker processes so it must remain a module-level function that
+  returns picklable values.
+  '''
+  try:
+    de = desktop_entry(path)
+  except (xdg.DesktopEntry.ParsingError, OSError, UnicodeDecodeError) as e:
+    return (None, None, (), False, str(e))
+  return (
+    de.getExec(),
+    de.getTryExec(),
+    tuple(de.getMimeTypes()),
+    de.getHidden(),
+    None
+  )
+
+
+
+def doctor_desktop_records(paths, max_workers=None):
+  '''
+  Get the doctor_desktop_record of each path, in the same order. Large numbers
+  of desktop entries are parsed in chunks by a process pool because parsing is
+  CPU-bound and pure Python. The pool is skipped for small numbers and on
+  single-CPU systems because it would take longer than parsing the entries.
+  '''
+  if max_workers is None:
+    max_workers = os.cpu_count() or 1
+  if max_workers < 2 or len(paths) < DOCTOR_PARALLEL_THRESHOLD:
+    return list(map(doctor_desktop_record, paths))
+  import concurrent.futures
+  chunksize = max(DOCTOR_MIN_CHUNK_SIZE, len(paths) // (max_workers * 4))
+  try:
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+  except (OSError, NotImplementedError) as e:
+    logging.warning('failed to start worker processes: {}'.format(e))
+    return list(map(doctor_desktop_record, paths))
+  with executor:
+    return list(executor.map(doctor_desktop_record, paths, chunksize=chunksize))
+
+
+
+def doctor_record(check, severity, path, *items):
+  '''
+  Create a doctor record. items are additional (key, value) pairs.
+  '''
+  return collections.OrderedDict((
+    (RECORD_CHECK, check),
+    (RECORD_SEVERITY, severity),
+    (RECORD_PATH, path),
+    *items
+  ))
+
+
+
+################################# System Layer #################################
+
+class SystemLayer(object):
+  '''
+  Parsed system-level data that is shared by Mimeo instances: association
+  files and desktop entries outside of the users' directories. Instances that
+  resolve associations for different users or containers with the same system
+  directories only parse these files once. The caches are bounded by their own
+  CacheBudget. The stat signature of each file is recorded so that refresh()
+  can drop data that is out of date, e.g. in long-running processes.
+  '''
+  def __init__(self, cache_budget=DEFAULT_CACHE_BUDGET):
+    self.cache_budget = CacheBudget(cache_budget)
+    self.associations = BoundedCache('system_associations', self.cache_budget)
+    self.desktop_entries = BoundedCache('system_desktop_entries', self.cache_budget)
+    # Path -> stat signature of the file before it was cached.
+    self.signatures = dict()
+    self.lock = threading.Lock()
+
+
+
+  def get(self, cache, path, load):
+    '''
+    Get the cached value of a path from one of the caches, or cache the return
+    value of load(). None is not cached.
+    '''
+    try:
+      return cache[path]
+    except KeyError:
+      pass
+    signature = stat_signature(path)
+    value = load()
+    if value is not None:
+      with self.lock:
+        self.signatures[path] = signature
+      cache[path] = value
+    return value
+
+
+
+  def refresh(self):
+    '''
+    Drop the cached data of files that have changed since they were cached.
+    '''
+    with self.lock:
+      signatures = list(self.signatures.items())
+    for path, signature in signatures:
+      cached = path in self.associations or path in self.desktop_entries
+      if not cached or stat_signature(path) != signature:
+        if cached:
+          logging.debug('{} changed'.format(path))
+        self.associations.discard(path)
+        self.desktop_entries.discard(path)
+        with self.lock:
+          self.signatures.pop(path, None)
+
+
+
+  def clear(self):
+    '''
+    Clear cached data.
+    '''
+    self.associations.clear()
+    self.desktop_entries.clear()
+    with self.lock:
+      self.signatures.clear()
+
+
+
+SYSTEM_LAYER = None
+
+def shared_system_layer():
+  '''
+  Get the SystemLayer that is shared by default. It is created on first use.
+  '''
+  global SYSTEM_LAYER
+  if SYSTEM_LAYER is None:
+    SYSTEM_LAYER = SystemLayer()
+  return SYSTEM_LAYER
+
+
+
+################################ MimeappsCache #################################
+
+class MimeappsCache(object):
+  def __init__(self):
+    self.associations = dict()
+
+
+
+  def clear(self):
+    self.associations.clear()
+
+
+
+  def __getitem__(self, path):
+    try:
+      return self.associations[path]
+    except KeyError:
+      assocs = load_associations(path)
+      self.associations[path] = assocs
+      return assocs
+
+
+  def __setitem__(self, path, assocs):
+    self.associations.__setitem__(path, assocs)
+
+
+
+  def __delitem__(self, path):
+    self.associations.__delitem__(path)
+
+
+
+#################################### Mimeo #####################################
+
+class Mimeo(object):
+  def __init__(
+    self,
+    user=True,
+    system=True,
+    include_deprecated=False,
+    term_cmd=None,
+    by_content_first=False,
+    by_content_only=False,
+    by_name_only=False,
+    use_fs_policy=True,
+    sniff_timeout=DEFAULT_SNIFF_TIMEOUT,
+    read_xattr=True,
+    write_xattr=False,
+    follow=True,
+    current_desktop=False,
+    mimeo_assocs=None,
+    none_on_de_parsing_err=True,
+    file_cmd=None,
+    cache_budget=DEFAULT_CACHE_BUDGET,
+    probe_urls=False,
+    snapshot=None,
+    env=None,
+    system_layer=None,
+    icon_theme=None,
+    icon_size=DEFAULT_ICON_SIZE,
+    extract_cache_size=DEFAULT_EXTRACT_CACHE_SIZE,
+    stdin_fd=False,
+  ):
+    self.user = user
+    self.system = system
+    self.include_deprecated = include_deprecated
+    self.term_cmd = term_cmd
+    self.by_content_first=by_content_first
+    self.by_content_only=by_content_only
+    self.by_name_only=by_name_only
+    self.use_fs_policy = use_fs_policy
+    self.sniff_timeout = sniff_timeout
+    self.read_xattr = read_xattr
+    self.write_xattr = write_xattr
+    self.follow=follow
+    self.current_desktop=current_desktop
+    self.mimeo_assocs=mimeo_assocs
+    self.none_on_de_parsing_err = none_on_de_parsing_err
+    self.file_cmd = file_cmd
+    # The XDG directories and environment variables are fixed when the
+    # instance is created.
+    self.env = env if env is not None else xdg_environment()
+    self.user_dirs = tuple(
+      os.path.join(d, '') for d in (self.env.config_home, self.env.data_home)
+    )
+    self.system_layer = system_layer if system_layer is not None else shared_system_layer()
+    self.snapshot = snapshot
+
+    # All caches share a single memory budget.
+    self.cache_budget = CacheBudget(cache_budget)
+    self.associations = BoundedCache('associations', self.cache_budget)
+    self.seen_mimetypes = BoundedCache('seen_mimetypes', self.cache_budget)
+    # Negative results. MIME-types without any associated desktop file are
+    # stored with the only_existing flag of the query. Arguments for which no
+    # MIME-type was found are stored with the stat signature of their path.
+    self.unhandled_mimetypes = BoundedCache('unhandled_mimetypes', self.cache_budget)
+    self.unclassified_args = BoundedCache('unclassified_args', self.cache_budget)
+    if probe_urls:
+      self.url_prober = URLProber(
+        cache=BoundedCache('url_content_types', self.cache_budget)
+      )
+    else:
+      self.url_prober = None
+    self.loaded_desktop_index = None
+    self.icon_theme = icon_theme
+    self.icon_size = icon_size
+    self.loaded_icon_index = None
+    self.extract_cache = ExtractCache(max_size=extract_cache_size, env=env)
+    self.stdin_fd = stdin_fd
+    self.stdin = None
+    self.reset()
+
+
+
+  def reset(self):
+    '''
+    Clear cached data. Shared system data is only dropped if its files have
+    changed.
+    '''
+    self.mimetypes_knownfiles = mimetypes_knownfiles(env=self.env)
+    self.associations.clear()
+    self.seen_mimetypes.clear()
+    if self.url_prober is not None:
+      self.url_prober.close()
+    self.system_layer.refresh()
+    refresh_name_detector(env=self.env)
+    refresh_mimetypes_db(env=self.env)
+    self.clear_negative_results()
+    self.load_negative_results()
+    self.initialize()
+
+
+
+  def clear_negative_results(self):
+    '''
+    Forget cached negative results. This must be done whenever the associations
+    change.
+    '''
+    self.unhandled_mimetypes.clear()
+    self.unclassified_args.clear()
+
+
+
+  def negative_result_sources(self):
+    '''
+    Paths to all files and directories that can affect negative results.
+    '''
+    return tuple(itertools.chain(
+      mimeapps_list_paths(
+        current_desktop=True,
+        user=True,
+        system=True,
+        include_user_app_dir=self.include_deprecated,
+        env=self.env
+      ),
+      mimeinfo_caches(user=True, system=True, env=self.env),
+      desktop_directories(user=True, system=True, env=self.env),
+      mime_database_paths(env=self.env),
+      self.mimetypes_knownfiles
+    ))
+
+
+
+  def resolution_options(self):
+    '''
+    The options that affect negative results. Negative results are stored in
+    the snapshot separately for each combination of options.
+    '''
+    file_cmd = self.file_cmd
+    if isinstance(file_cmd, list):
+      file_cmd = tuple(file_cmd)
+    return (
+      self.user,
+      self.system,
+      self.include_deprecated,
+      self.current_desktop,
+      self.by_content_first,
+      self.by_content_only,
+      self.by_name_only,
+      self.use_fs_policy,
+      self.sniff_timeout,
+      self.read_xattr,
+      self.follow,
+      file_cmd,
+      self.url_prober is not None
+    )
+
+
+
+  def load_negative_results(self):
+    '''
+    Load negative results from the snapshot if their sources are unchanged.
+    '''
+    if self.snapshot is None:
+      return
+    sources = self.negative_result_sources()
+    options = self.resolution_options()
+    for key in self.snapshot.get(
+      (SNAPSHOT_UNHANDLED_MIMETYPES, options), sources, tuple
+    ):
+      self.unhandled_mimetypes[key] = True
+    for arg, signature in self.snapshot.get(
+      (SNAPSHOT_UNCLASSIFIED_ARGS, options), sources, tuple
+    ):
+      self.unclassified_args[arg] = signature
+
+
+
+  def save_snapshot(self):
+    '''
+    Store the negative results in the snapshot and save it. Unclassified
+    arguments are only stored if they do not depend on the working directory.
+    '''
+    if self.snapshot is None:
+      return
+    sources = self.negative_result_sources()
+    options = self.resolution_options()
+    self.snapshot.put(
+      (SNAPSHOT_UNHANDLED_MIMETYPES, options),
+      sources,
+      tuple(k for k, _ in self.unhandled_mimetypes.items())
+    )
+    self.snapshot.put(
+      (SNAPSHOT_UNCLASSIFIED_ARGS, options),
+      sources,
+      tuple(
+        (arg, signature) for arg, signature in self.unclassified_args.items()
+        if os.path.isabs(arg) or urllib.parse.urlparse(arg).scheme
+      )
+    )
+    self.snapshot.save()
+
+
+
+  def cache_stats(self):
+    '''
+    Return usage statistics for each cache.
+    '''
+    return collections.OrderedDict(
+      (cache.name, cache.stats()) for cache in self.cache_budget.caches
+    )
+
+
+
+  def initialize(self):
+    '''
+    Initialize mimetypes internal data structures etc. The mimetypes files are
+    read on first use by mimetypes_db.
+    '''
+    pass
+
+
+
+  def load_name_detector(self):
+    '''
+    Load the NameDetector for the data directories from the snapshot if there
+    is one. It is then found by the module-level functions.
+    '''
+    if self.snapshot is not None:
+      name_detector(env=self.env, snapshot=self.snapshot)
+
+
+
+  def load_mimeo_associations(self, fpath=None):
+    '''
+    Load custom Mimeo association. If fpath is None,
+    '''
+    self.mimeo_assocs = None
+    if fpath is None:
+      for fpath in default_mimeo_associations_paths(env=self.env):
+        try:
+          self.mimeo_assocs = self.parse_mimeo_associations(fpath)
+          break
+        except FileNotFoundError:
+          continue
+    elif fpath:
+      self.mimeo_assocs = self.parse_mimeo_associations(fpath)
+
+
+
+  def parse_mimeo_associations(self, fpath):
+    '''
+    Parse custom Mimeo associations, possibly from the snapshot.
+    '''
+    if self.snapshot is None:
+      return list(parse_mimeo_associations(fpath))
+    else:
+      patterns = self.snapshot.get(
+        SNAPSHOT_MIMEO_ASSOCIATIONS,
+        (fpath,),
+        lambda: tuple(
+          (regex.pattern, cmd) for regex, cmd in parse_mimeo_associations(fpath)
+        )
+      )
+      return list((re.compile(p), cmd) for p, cmd in patterns)
+
+
+
+  def is_user_path(self, path):
+    '''
+    Check if a path is in the user's configuration or data directory. Data from
+    all other paths is shared through the system layer.
+    '''
+    return path.startswith(self.user_dirs)
+
+
+
+  def mimetype_handler_accepts_urls(self, mimetype):
+    '''
+    Return True if the preferred desktop entry of the MIME-type accepts URLs,
+    i.e. if its Exec field contains %u or %U.
+    '''
+    dpath = next(self.mimetype_to_desktop_filepaths(
+      mimetype, at_least_one=True, first_only=True, only_existing=True
+    ))
+    if dpath is None:
+      return False
+    de = self.desktop_entry(dpath, none_if_error=True)
+    if de is None:
+      return False
+    try:
+      codes = exec_template(de.getExec()).codes
+    except xdg.DesktopEntry.ValidationError as e:
+      logging.warning('{}: {}'.format(dpath, e))
+      return False
+    return bool(codes & frozenset('uU'))
+
+
+
+  def desktop_entry(self, path, none_if_error=False):
+    '''
+    Load a desktop entry. Desktop entries outside of the user's directories are
+    cached in the system layer.
+    '''
+    if self.is_user_path(path):
+      return desktop_entry(path, none_if_error=none_if_error)
+    return self.system_layer.get(
+      self.system_layer.desktop_entries,
+      path,
+      lambda: desktop_entry(path, none_if_error=none_if_error)
+    )
+
+
+
+  def get_associations(self, path):
+    '''
+    Get possibly cached associations from the given path. Associations outside
+    of the user's directories are cached in the system layer.
+    '''
+    def load():
+      if self.snapshot is None:
+        return load_associations(path)
+      # marshal does not support OrderedDict but dicts preserve order.
+      return self.snapshot.get(
+        SNAPSHOT_ASSOCIATIONS,
+        (path,),
+        lambda: dict(load_associations(path))
+      )
+
+    if not self.is_user_path(path):
+      return self.system_layer.get(self.system_layer.associations, path, load)
+    try:
+      return self.associations[path]
+    except KeyError:
+      assocs = load()
+      self.associations[path] = assocs
+      return assocs
+
+
+
+  def mimeapps_directories(self):
+    '''
+    Iterate over application directory paths.
+    '''
+    yield from itertools.chain.from_iterable(mimeapps_directories(
+      user=self.user,
+      system=self.system,
+      env=self.env
+    ))
+
+
+
+  def mimeapps_list_paths(self):
+    '''
+    Iterate over mimeapps.list paths.
+    '''
+    return mimeapps_list_paths(
+      current_desktop=True,
+      include_user_app_dir=self.include_deprecated,
+      env=self.env
+    )
+
+
+
+  def desktop_paths(self, sort_per_dir=False):
+    '''
+    Iterate over desktop entry paths.
+    '''
+    return desktop_paths(
+      user=self.user,
+      system=self.system,
+      sort_per_dir=sort_per_dir,
+      env=self.env
+    )
+
+
+
+  def mimeinfo_caches(self):
+    '''
+    Update mimeinfo caches.
+    '''
+    return mimeinfo_caches(
+      user=self.user,
+      system=self.system,
+      env=self.env
+    )
+
+
+
+  def search_desktop_paths(self, ds, first_only=False):
+    '''
+    Search for desktop files. The order is arbitrary.
+    '''
+    ds = set(ensure_desktop_names(ds))
+    found = set()
+    for dpath in desktop_directories(user=self.user, system=self.system, env=self.env):
+      for d in ds:
+        path = os.path.join(dpath, d)
+        if os.path.exists(path):
+          yield path
+          if first_only:
+            found.add(d)
+      if first_only:
+        ds -= found
+
+
+
+  def update_mimeinfo_caches(self):
+    '''
+    Update mimeinfo caches.
+    '''
+    update_mimeinfo_caches(
+      user=self.user,
+      system=self.system,
+      env=self.env
+    )
+
+
+
+  def mimeapps_list_paths_and_assocs(self):
+    '''
+    Iterate over mimeapps.list files and their paths.
+    '''
+    for path in self.mimeapps_list_paths():
+      yield path, self.get_associations(path)
+
+
+
+  def section_entries(self, paths, sections):
+    '''
+    Iterate over all entries for the given paths and sections.
+    '''
+    for path in paths:
+      assocs = self.get_associations(path)
+      if not assocs:
+        continue
+      for section in sections:
+        try:
+          for e in assocs[section]:
+            yield e
+        except KeyError:
+          pass
+
+
+
+  def associated_desktop_paths(self, mimetype):
+    '''
+    Iterate over desktop files associated with a given MIME-type.
+    '''
+    # The added associations are given in order of preference so a list must be
+    # used.
+    added = list()
+    blacklist = set()
+    for path, assocs in self.mimeapps_list_paths_and_assocs():
+      with STAGE_TIMER.stage(STAGE_ASSOCIATION_CASCADE):
+        blacklist.update(iterate_associations(assocs, REMOVED_ASSOCIATIONS_SECTION, mimetype))
+
+        added = list(a for a in added if a not in blacklist)
+        added.extend(
+          a for a in iterate_associations(assocs, ADDED_ASSOCIATIONS_SECTION, mimetype)
+          if a not in blacklist and a not in added
+        )
+
+        dpath = os.path.dirname(path)
+        mimeinfo_cache_path = os.path.join(dpath, MIMEINFO_CACHE_FILE)
+
+        mimeinfo_cache_assocs = self.get_associations(mimeinfo_cache_path)
+        local_associations = added.copy()
+        local_associations.extend(
+          x for x in iterate_associations(mimeinfo_cache_assocs, MIME_CACHE_SECTION, mimetype)
+          if x not in blacklist and x not in added
+        )
+
+      for d in local_associations:
+        desktop_path = os.path.join(dpath, d)
+        if os.path.exists(desktop_path):
+          yield desktop_path
+
+
+
+  def default_desktop_filenames(self, mimetype):
+    '''
+    Iterate over default desktop filenames.
+    '''
+    for path in self.mimeapps_list_paths():
+      assocs = self.get_associations(path)
+      yield from iterate_associations(assocs, DEFAULT_APPLICATIONS_SECTION, mimetype)
+
+
+
+  @unique_items
+  def mimetype_to_desktop_filepaths(
+    self,
+    mimetype,
+    at_least_one=False,
+    first_only=False,
+    only_existing=False
+  ):
+    '''
+    Iterate over default desktop paths then over associated desktop paths.
+    '''
+    negative_key = (mimetype, only_existing)
+    try:
+      self.unhandled_mimetypes[negative_key]
+    except KeyError:
+      pass
+    else:
+      logging.debug('no desktop for {} (cached)'.format(mimetype))
+      STAGE_TIMER.count(COUNTER_NEGATIVE_CACHE_HITS)
+      if at_least_one:
+        yield None
+      return
+
+    stripped_mimetype = strip_mimetype(mimetype)
+    if stripped_mimetype != mimetype:
+      mimetypes = (mimetype, stripped_mimetype)
+    else:
+      mimetypes = (mimetype,)
+    found_one = False
+    for mimetype in mimetypes:
+      with STAGE_TIMER.stage(STAGE_ASSOCIATION_CASCADE):
+        defaults = list(self.default_desktop_filenames(mimetype))
+      if defaults:
+        for d in defaults:
+          for dpath in self.mimeapps_directories():
+            fpath = os.path.join(dpath, d)
+            if not only_existing or os.path.exists(fpath):
+              yield fpath
+              if first_only:
+                return
+              found_one = True
+      for fpath in self.associated_desktop_paths(mimetype):
+        if not only_existing or os.path.exists(fpath):
+          yield fpath
+          if first_only:
+            return
+          found_one = True
+    if not found_one:
+      logging.debug('failed to determine at least one desktop for {}'.format(mimetype))
+      self.unhandled_mimetypes[negative_key] = True
+      if at_least_one:
+        yield None
+
+
+  def arg_to_mimetypes(self, arg, at_least_one=False, first_only=False):
+    '''
+    Match argument to MIME-types. This will not return anything if the match
+    fails.
+
+    The argument is parsed once and then passed through the following tiers in
+    order. Each tier only runs if the previous ones did not decide.
+
+    1. STDIN_ARG is checked by the header bytes of the data on STDIN.
+    2. Members of archives (see parse_archive_member) are checked by name and
+       by the header bytes of their content as configured.
+    3. URLs with a scheme other than "file" map to their scheme handler. If URL
+       probing is enabled, the MIME-type of HTTP(S) URLs from the Content-Type
+       header comes first.
+    4. MIME-type matchers map to the matching known MIME-types. Strings that
+       look like MIME-types but are not known fall through to the next tier.
+    5. Local paths, including "file" URLs, are checked with stat and then by
+       name and content as configured. "file" URLs fall back to their scheme
+       handler.
+    '''
+    # STDIN
+    if arg == STDIN_ARG:
+      m = self.stdin_source().detect_mimetype(file_cmd_timeout=self.sniff_timeout)
+      if m:
+        yield m
+      else:
+        logging.warning('failed to determine at least one MIME-type for {}'.format(arg))
+        if at_least_one:
+          yield None
+      return
+
+    with STAGE_TIMER.stage(STAGE_CLASSIFY):
+      parsed_url = urllib.parse.urlparse(arg)
+      scheme = parsed_url.scheme
+      is_matcher = is_mimetype_matcher(arg)
+      member = parse_archive_member(arg, parsed_url=parsed_url)
+
+    # Archive members
+    if member:
+      self.load_name_detector()
+      found_one = False
+      for m in archive_member_mimetypes(
+        member,
+        content_first=self.by_content_first,
+        content_only=self.by_content_only,
+        name_only=self.by_name_only,
+        env=self.env
+      ):
+        yield m
+        if first_only:
+          return
+        found_one = True
+      if not found_one:
+        logging.warning('failed to determine at least one MIME-type for {}'.format(arg))
+        if at_least_one:
+          yield None
+      return
+
+    # Scheme URLs
+    if scheme and scheme != SCHEME_FILE and not is_matcher:
+      if self.url_prober and scheme in URL_PROBE_SCHEMES:
+        m = self.url_prober.content_type(arg)
+        # Only prefer the probed MIME-type if its handler accepts URLs so that
+        # the URL still opens with the scheme handler otherwise.
+        if m and self.mimetype_handler_accepts_urls(m):
+          yield m
+          if first_only:
+            return
+      yield MIMETYPE_SCHEME_FMT.format(scheme)
+      return
+
+    # Negative results are only cached for the remaining tiers.
+    path = None
+    try:
+      cached_signature = self.unclassified_args[arg]
+    except KeyError:
+      pass
+    else:
+      with STAGE_TIMER.stage(STAGE_CLASSIFY):
+        path = ensure_path(arg, parsed_url=parsed_url)
+      signature = stat_signature(path, follow_symlinks=self.follow) if path else None
+      if cached_signature == signature:
+        logging.debug('no MIME-type for {} (cached)'.format(arg))
+        STAGE_TIMER.count(COUNTER_NEGATIVE_CACHE_HITS)
+        if at_least_one:
+          yield None
+        return
+
+    found_one = False
+
+    # MIME-type matchers
+    if is_matcher:
+      for m in self.matching_mimetypes(arg, ensure_known=True):
+        yield m
+        if first_only:
+          return
+        found_one = True
+
+    # Local paths. Matchers with a pattern prefix are never paths.
+    if not found_one and not has_matcher_prefix(arg):
+      if path is None:
+        with STAGE_TIMER.stage(STAGE_CLASSIFY):
+          path = ensure_path(arg, parsed_url=parsed_url)
+      if path:
+        self.load_name_detector()
+        for m in mimetypes_from_path(
+          path,
+          follow_symlinks=self.follow,
+          content_first=self.by_content_first,
+          content_only=self.by_content_only,
+          name_only=self.by_name_only,
+          file_cmd=self.file_cmd,
+          env=self.env,
+          use_fs_policy=self.use_fs_policy,
+          sniff_timeout=self.sniff_timeout,
+          read_xattr=self.read_xattr,
+          write_xattr=self.write_xattr
+        ):
+          yield m
+          if first_only:
+            return
+          found_one = True
+
+      if scheme == SCHEME_FILE:
+        yield MIMETYPE_SCHEME_FMT.format(scheme)
+        if first_only:
+          return
+        found_one = True
+
+    if not found_one:
+      logging.warning('failed to determine at least one MIME-type for {}'.format(arg))
+      self.unclassified_args[arg] = \
+        stat_signature(path, follow_symlinks=self.follow) if path else None
+      if at_least_one:
+        yield None
+
+
+
+  def tree_to_mimetypes(self, root, at_least_one=False, first_only=False):
+    '''
+    Recursively match the paths in a directory tree to MIME-types. Arguments
+    that are not directories are matched directly.
+    '''
+    if not os.path.isdir(root):
+      for m in self.arg_to_mimetypes(root, at_least_one=at_least_one, first_only=first_only):
+        yield root, m
+      return
+
+    self.load_name_detector()
+    for entry in scandir_tree(root):
+      found_one = False
+      for m in mimetypes_from_dir_entry(
+        entry,
+        follow_symlinks=self.follow,
+        content_first=self.by_content_first,
+        content_only=self.by_content_only,
+        name_only=self.by_name_only,
+        file_cmd=self.file_cmd,
+        env=self.env,
+        use_fs_policy=self.use_fs_policy,
+        sniff_timeout=self.sniff_timeout,
+        read_xattr=self.read_xattr,
+        write_xattr=self.write_xattr
+      ):
+        yield entry.path, m
+        if first_only:
+          break
+        found_one = True
+      else:
+        if not found_one and at_least_one:
+          yield entry.path, None
+
+
+
+  def args_to_mimetypes(self, args, at_least_one=False, first_only=False):
+    '''
+    Match arguments to MIME-types.
+    '''
+    for a in args:
+      for m in self.arg_to_mimetypes(a, at_least_one=at_least_one, first_only=first_only):
+        yield a, m
+
+
+
+  def mimetypes_to_desktop_paths(
+    self,
+    ms,
+    at_least_one=False,
+    first_only=False,
+    only_existing=False
+  ):
+    '''
+    Match MIME-types to desktop paths.
+    '''
+    for m in ms:
+      for d in self.mimetype_to_desktop_filepaths(
+        m,
+        at_least_one=at_least_one,
+        first_only=first_only,
+        only_existing=only_existing
+      ):
+        yield m, d
+
+
+
+  @unique_items
+  def args_to_desktop_paths(
+    self,
+    args,
     at_least_one=False,
     first_only=False,
     only_existing=False
   ):
     '''
-    Iterate over default desktop paths then over associated desktop paths.
+    Match arguments to desktop paths.
+    '''
+    for a, m in self.args_to_mimetypes(
+      args,
+      at_least_one=at_least_one,
+      first_only=first_only
+    ):
+      for d in self.mimetype_to_desktop_filepaths(
+        m,
+        at_least_one=at_least_one,
+        first_only=first_only,
+        only_existing=only_existing
+      ):
+        yield a, d
+        if first_only:
+          break
+
+
+
+  def args_to_desktop_entries(
+    self,
+    args=None,
+    at_least_one=False,
+    first_only=False,
+  ):
+    '''
+    Match arguments to desktop entries.
+    '''
+    for a, d in self.args_to_desktop_paths(
+      args,
+      at_least_one=at_least_one,
+      first_only=first_only,
+      only_existing=True
+    ):
+      if d is None:
+        yield a, None
+      else:
+        yield a, self.desktop_entry(d)
+
+
+
+  def args_to_cmd_precursors(
+    self,
+    args,
+    at_least_one=False,
+    first_only=False,
+  ):
+    '''
+    Return tuples of custom commands and desktop paths for the arguments. These
+    can be passed to the collection function and then converted to a command.
+    '''
+    if not isinstance(args, list):
+      args = list(args)
+    yielded = set()
+    if self.mimeo_assocs:
+      with STAGE_TIMER.stage(STAGE_CUSTOM_ASSOCIATIONS):
+        custom_cmds = list(args_to_custom_cmds(
+          self.mimeo_assocs,
+          args,
+          first_only=first_only
+        ))
+      for a, cmd in custom_cmds:
+        yield a, (cmd, None)
+        yielded.add(a)
+
+    if first_only:
+      remaining = (a for a in args if a not in yielded)
+    else:
+      remaining = args
+
+    for a, d in self.args_to_desktop_paths(
+      remaining,
+      first_only=first_only,
+      only_existing=True
+    ):
+      yield a, (None, d)
+      yielded.add(a)
+
+    if at_least_one:
+      for a in args:
+        if a not in yielded:
+          logging.warning('failed to determine command precursor for {}'.format(a))
+          if at_least_one:
+            yield a, None
+
+
+
+  def args_to_cmds(
+    self,
+    args,
+    first_only=False,
+    prepare_stdin=True,
+  ):
+    '''
+    Return commands for the given arguments. If prepare_stdin is False then the
+    data on STDIN is not prepared for the applications and STDIN_ARG is only
+    replaced with the path that would be used, e.g. when the commands are only
+    printed.
+    '''
+    for _, c in self.args_to_cmd_pairs(
+      args,
+      first_only=first_only,
+      prepare_stdin=prepare_stdin
+    ):
+      yield c
+
+
+
+  def args_to_cmd_pairs(
+    self,
+    args,
+    first_only=False,
+    prepare_stdin=True,
+  ):
+    '''
+    Iterate over commands for the given arguments as (args, command) pairs in
+    which args is the tuple of given arguments that the command opens, before
+    archive members are extracted and STDIN_ARG is replaced. See args_to_cmds.
+    '''
+    a_to_b = self.args_to_cmd_precursors(
+      args,
+      first_only=first_only,
+      at_least_one=True
+    )
+    a_by_b = modify_and_collect(a_to_b, swap=True)
+    for pc, aa in a_by_b.items():
+      if pc is None:
+        logging.warning('failed to determine command(s) for {}'.format(quote_cmd(aa)))
+        continue
+      pairs = list(self.extract_archive_members(aa))
+      if not pairs:
+        continue
+      originals = list(o for o, _ in pairs)
+      aa = list(a for _, a in pairs)
+      if pc[0] is not None:
+        exe = pc[0]
+        de = None
+      else:
+        de = self.desktop_entry(pc[1])
+        exe = de.getExec()
+      if STDIN_ARG in aa:
+        aa = self.replace_stdin_arg(aa, exe, prepare=prepare_stdin)
+      # Commands of single-argument Exec fields each open one argument.
+      if exec_template(exe).single:
+        groups = (((o,), [a]) for o, a in zip(originals, aa))
+      else:
+        groups = ((tuple(originals), aa),)
+      for oo, aa in groups:
+        if de is None:
+          cmds = exec_field_to_cmds(exe, aa, 'User Command')
+        else:
+          cmds = desktop_entry_to_cmds(de, args=aa, term_cmd=self.term_cmd)
+        for c in cmds:
+          yield oo, c
+
+
+
+  def stdin_source(self):
+    '''
+    Get the StdinSource for STDIN_ARG. It is created on first use.
+    '''
+    if self.stdin is None:
+      self.stdin = StdinSource()
+    return self.stdin
+
+
+
+  def replace_stdin_arg(self, args, exe, prepare=True):
+    '''
+    Prepare the data on STDIN for an application with the given Exec field. If
+    the field has no file or URL field codes then the application inherits
+    STDIN. Otherwise STDIN_ARG is replaced with a path to the data. See
+    StdinSource.path. If prepare is False then STDIN_ARG is replaced with the
+    path that would be used without preparing the data. See
+    StdinSource.placeholder.
+    '''
+    source = self.stdin_source()
+    if not exec_template(exe).codes:
+      if prepare:
+        source.share()
+      return args
+    if prepare:
+      path = source.path(self.extract_cache, use_fd=self.stdin_fd, env=self.env)
+    else:
+      path = source.placeholder(self.extract_cache, use_fd=self.stdin_fd, env=self.env)
+    if not path:
+      return args
+    return list(path if a == STDIN_ARG else a for a in args)
+
+
+
+  def extract_archive_members(self, args):
+    '''
+    Iterate over (argument, replacement) pairs in which arguments that refer to
+    archive members are replaced with the paths to the extracted files and all
+    other arguments are kept. Arguments that cannot be extracted are dropped
+    because they are not paths that applications could open.
+    '''
+    for a in args:
+      member = parse_archive_member(a)
+      if member:
+        path = self.extract_cache.get(member)
+        if path:
+          yield a, path
+        else:
+          logging.warning('skipping {}'.format(a))
+        continue
+      yield a, a
+
+
+
+  def known_mimetypes(self):
+    '''
+    Return a set of known MIME-types.
+    '''
+    try:
+      return self.seen_mimetypes[self.include_deprecated]
+    except KeyError:
+      with STAGE_TIMER.stage(STAGE_KNOWN_MIMETYPES):
+        known = self.load_known_mimetypes()
+      self.seen_mimetypes[self.include_deprecated] = known
+      return known
+
+
+
+  def load_known_mimetypes(self):
+    '''
+    Collect all MIME-types from association files and mimetypes known files.
+    '''
+    known = set()
+    paths = mimeapps_list_paths(
+      current_desktop=True,
+      user=True,
+      system=True,
+      include_user_app_dir=self.include_deprecated,
+      env=self.env
+    )
+    sections = (ADDED_ASSOCIATIONS_SECTION, DEFAULT_APPLICATIONS_SECTION)
+    known.update(self.section_entries(paths, sections))
+
+    paths = mimeinfo_caches(user=True, system=True, env=self.env)
+    sections = (MIME_CACHE_SECTION,)
+    known.update(self.section_entries(paths, sections))
+
+    for path in self.mimetypes_knownfiles:
+      if self.snapshot is None:
+        known.update(load_knownfile_mimetypes(path))
+      else:
+        known.update(self.snapshot.get(
+          SNAPSHOT_KNOWNFILE,
+          (path,),
+          lambda: tuple(load_knownfile_mimetypes(path))
+        ))
+    return known
+
+
+
+  def matching_mimetypes(self, matcher, ensure_known=False):
+    '''
+    Iterate over all known MIME-types matched by the given matcher.
+    '''
+    regex, is_pattern = mimetype_regex(matcher)
+    if is_pattern or ensure_known:
+      for m in self.known_mimetypes():
+        if regex.match(m):
+          yield m
+    else:
+      yield matcher
+
+
+
+  def modify_associations(self, op, matcher, desktops=None):
+    '''
+    Modify associations.
+    '''
+    path = user_mimeapps_path(current_desktop=self.current_desktop, env=self.env)
+    assocs = self.get_associations(path)
+    self.clear_negative_results()
+
+    if matcher:
+      mimetypes = self.matching_mimetypes(matcher)
+    elif desktops:
+      desktops = set(desktops)
+      mimetypes = set()
+      for d in self.search_desktop_paths(desktops, first_only=True):
+        de = self.desktop_entry(d)
+        mimetypes.update(de.getMimeTypes())
+
+    if op in ASSOCIATION_ADDERS:
+      if desktops:
+        for s, m, d in itertools.product(
+          ASSOCIATION_ADDERS[op],
+          mimetypes,
+          desktops
+        ):
+          assocs = add_association(assocs, s, m, d)
+
+    elif op in ASSOCIATION_REMOVERS:
+      if desktops:
+        for s, m, d in itertools.product(
+          ASSOCIATION_REMOVERS[op],
+          mimetypes,
+          desktops
+        ):
+          assocs = remove_association(assocs, s, m, d)
+      else:
+        for s, m in itertools.product(
+          ASSOCIATION_REMOVERS[op],
+          mimetypes,
+        ):
+          assocs = remove_association(assocs, s, m)
+
+    save_associations(path, assocs)
+    # Update the accounted size of the modified associations.
+    self.associations[path] = assocs
+
+
+
+  def desktop_paths_to_desktop_entries(
+    self, ds=None, first_only=False
+  ):
+    '''
+    Iterate over desktops and their desktop entries.
     '''
-    stripped_mimetype = strip_mimetype(mimetype)
-    if stripped_mimetype != mimetype:
-      mimetypes = (mimetype, stripped_mimetype)
+    if ds:
+      ds = self.search_desktop_paths(ds, first_only=first_only)
     else:
-      mimetypes = (mimetype,)
-    found_one = False
-    for mimetype in mimetypes:
-      defaults = list(self.default_desktop_filenames(mimetype))
-      if defaults:
-        for d in defaults:
-          for dpath in self.mimeapps_directories():
-            fpath = os.path.join(dpath, d)
-            if not only_existing or os.path.exists(fpath):
-              yield fpath
-              if first_only:
-                return
-              found_one = True
-      for fpath in self.associated_desktop_paths(mimetype):
-        if not only_existing or os.path.exists(fpath):
-          yield fpath
-          if first_only:
-            return
-          found_one = True
-    if not found_one:
-      logging.debug('failed to determine at least one desktop for {}'.format(mimetype))
-      if at_least_one:
-        yield None
+      ds = self.desktop_paths()
+    for d in ds:
+      de = self.desktop_entry(d, none_if_error=self.none_on_de_parsing_err)
+      yield d, de
 
 
-  def arg_to_mimetypes(self, arg, at_least_one=False, first_only=False):
+
+  def desktop_paths_to_desktop_fields(
+    self, field, typ='string', ds=None, first_only=False
+  ):
     '''
-    Match argument to MIME-types. This will not return anything if the match
-    fails.
+    Iterate over desktops and the given field of their desktop entries.
     '''
-    found_one = False
+    for d, de in self.desktop_paths_to_desktop_entries(
+      ds=ds, first_only=first_only
+    ):
+      if de:
+        for x in de.get(field, type=typ, list=True):
+          yield d, x
+      else:
+        yield d, None
 
-    path = ensure_path(arg)
-    if path:
-      for m in mimetypes_from_path(
-        path,
-        follow_symlinks=self.follow,
-        content_first=self.by_content_first,
-        content_only=self.by_content_only,
-        name_only=self.by_name_only
-      ):
-        yield m
-        if first_only:
-          return
-        found_one = True
 
-    parsed_url = urllib.parse.urlparse(arg)
-    scheme = parsed_url.scheme
-    if scheme:
-      yield MIMETYPE_SCHEME_FMT.format(scheme)
-      if first_only:
-        return
-      found_one = True
 
-    for m in self.matching_mimetypes(arg, ensure_known=True):
-      yield m
-      if first_only:
-        return
-      found_one = True
+  def executables_to_desktop_paths(self, exes=None):
+    '''
+    Match executables to desktop entries.
+    '''
+    if exes:
+      exes = list((e, which(e, env=self.env)) for e in exes)
+    for d, exec_field in self.desktop_paths_to_desktop_fields('Exec'):
+      if exec_field:
+        ef1 = shlex.split(exec_field)[0]
+        c = which(ef1, env=self.env)
+        if not c:
+          c = which(os.path.basename(ef1), env=self.env)
+        if not c:
+          continue
+        elif exes:
+          for e, p in exes:
+            if p == c:
+              yield e, d
+              break
+        else:
+          yield c, d
 
-    if not found_one:
-      logging.warning('failed to determine at least one MIME-type for {}'.format(arg))
-      if at_least_one:
-        yield None
 
 
+  def desktop_paths_to_cmds(self, ds=None, args=None, first_only=False):
+    '''
+    Iterate over desktops and their associated MIME-types.
+    '''
+    for d, de in self.desktop_paths_to_desktop_entries(ds=ds, first_only=first_only):
+      for c in desktop_entry_to_cmds(de, args=args, term_cmd=self.term_cmd):
+        yield d, c
 
-  def args_to_mimetypes(self, args, at_least_one=False, first_only=False):
+
+
+  def desktop_index(self):
     '''
-    Match arguments to MIME-types.
+    Get the desktop entry index. It is loaded and updated on first use.
     '''
-    for a in args:
-      for m in self.arg_to_mimetypes(a, at_least_one=at_least_one, first_only=first_only):
-        yield a, m
+    if self.loaded_desktop_index is None:
+      index = DesktopIndex(
+        desktop_directories(user=self.user, system=self.system, env=self.env),
+        env=self.env
+      )
+      index.load()
+      index.save()
+      self.loaded_desktop_index = index
+    return self.loaded_desktop_index
 
 
 
-  def mimetypes_to_desktop_paths(
-    self,
-    ms,
-    at_least_one=False,
-    first_only=False,
-    only_existing=False
-  ):
+  def search_desktop_entries(self, query):
     '''
-    Match MIME-types to desktop paths.
+    Search the Name, GenericName, Keywords and Exec fields of visible desktop
+    entries and iterate over the paths of the matches by rank.
     '''
-    for m in ms:
-      for d in self.mimetype_to_desktop_filepaths(
-        m,
-        at_least_one=at_least_one,
-        first_only=first_only,
-        only_existing=only_existing
-      ):
-        yield m, d
+    index = self.desktop_index()
+    for i in index.search(query):
+      yield index.paths[i]
 
 
 
-  @unique_items
-  def args_to_desktop_paths(
-    self,
-    args,
-    at_least_one=False,
-    first_only=False,
-    only_existing=False
-  ):
+  def launcher_entries(self):
     '''
-    Match arguments to desktop paths.
+    Iterate over the labels, icons and paths of visible desktop entries for a
+    launcher menu, sorted by label.
     '''
-    for a, m in self.args_to_mimetypes(
-      args,
-      at_least_one=at_least_one,
-      first_only=first_only
-    ):
-      for d in self.mimetype_to_desktop_filepaths(
-        m,
-        at_least_one=at_least_one,
-        first_only=first_only,
-        only_existing=only_existing
-      ):
-        yield a, d
-        if first_only:
-          break
+    index = self.desktop_index()
+    for i in index.visible():
+      icon = index.entries[i][4]
+      if icon:
+        icon = self.icon_path(icon) or icon
+      yield index.labels[i], icon, index.paths[i]
 
 
 
-  def args_to_desktop_entries(
-    self,
-    args=None,
-    at_least_one=False,
-    first_only=False,
-  ):
+  def icon_index(self):
     '''
-    Match arguments to desktop entries.
+    Get the icon theme index. It is loaded and updated on first use.
     '''
-    for a, d in self.args_to_desktop_paths(
-      args,
-      at_least_one=at_least_one,
-      first_only=first_only,
-      only_existing=True
-    ):
-      if d is None:
-        yield a, None
-      else:
-        yield a, desktop_entry(d)
+    if self.loaded_icon_index is None:
+      index = IconIndex(
+        theme=self.icon_theme,
+        env=self.env,
+        cache_budget=self.cache_budget
+      )
+      index.load()
+      index.save()
+      self.loaded_icon_index = index
+    return self.loaded_icon_index
 
 
 
-  def args_to_cmd_precursors(
-    self,
-    args,
-    at_least_one=False,
-    first_only=False,
-  ):
+  def icon_path(self, icon):
     '''
-    Return tuples of custom commands and desktop paths for the arguments. These
-    can be passed to the collection function and then converted to a command.
+    Get the path to the file of the icon with the given name or path from the
+    icon theme, or None.
     '''
-    if not isinstance(args, list):
-      args = list(args)
-    yielded = set()
-    if self.mimeo_assocs:
-      for a, cmd in args_to_custom_cmds(
-        self.mimeo_assocs,
-        args,
-        first_only=first_only
-      ):
-        yield a, (cmd, None)
-        yielded.add(a)
+    return self.icon_index().lookup(icon, size=self.icon_size)
 
-    if first_only:
-      remaining = (a for a in args if a not in yielded)
-    else:
-      remaining = args
 
-    for a, d in self.args_to_desktop_paths(
-      remaining,
-      first_only=first_only,
-      only_existing=True
+
+  def desktop_paths_to_icon_paths(self, ds=None, first_only=False):
+    '''
+    Iterate over desktops and the paths to the files of their icons. Desktops
+    without an icon or with an icon that is not found are skipped.
+    '''
+    for d, icon in self.desktop_paths_to_desktop_fields(
+      'Icon', ds=ds, first_only=first_only
     ):
-      yield a, (None, d)
-      yielded.add(a)
+      if icon:
+        path = self.icon_path(icon)
+        if path:
+          yield d, path
+        else:
+          logging.debug('icon not found: {}'.format(icon))
 
-    if at_least_one:
-      for a in args:
-        if a not in yielded:
-          logging.warning('failed to determine command precursor for {}'.format(a))
-          if at_least_one:
-            yield a, None
 
 
+  def launcher_selection_to_cmds(self, selection, path=None):
+    '''
+    Iterate over the commands of a desktop entry selected in a launcher menu.
+    The entry is identified by its path if given, otherwise by its label.
+    '''
+    index = self.desktop_index()
+    if path not in index.paths:
+      i = index.find_label(selection)
+      if i is None:
+        logging.warning('no desktop entry for {}'.format(selection))
+        return
+      path = index.paths[i]
+    yield from desktop_entry_to_cmds(self.desktop_entry(path), term_cmd=self.term_cmd)
 
-  def args_to_cmds(
-    self,
-    args,
-    first_only=False,
-  ):
+
+
+  def doctor(self, max_workers=None):
     '''
-    Return commands for the given arguments.
+    Check associations and desktop entries in a single pass and iterate over
+    doctor records of the problems that are found:
+
+    * missing_desktop: mimeapps.list entries of desktops that do not exist.
+    * shadowed_desktop: desktops that are hidden by one with the same name in a
+      directory with higher precedence.
+    * invalid_desktop: desktop entries that cannot be parsed.
+    * unresolvable_tryexec, unresolvable_exec: desktop entries whose TryExec or
+      Exec command is not found.
+    * stale_mimeinfo_cache: mimeinfo.cache files that are missing, older than
+      desktop entries or that do not list the same desktops as the directory.
+
+    Each desktop directory is scanned once and files are read from disk, not
+    from the snapshot. Desktop entries are parsed by doctor_desktop_records.
     '''
-    a_to_b = self.args_to_cmd_precursors(
-      args,
-      first_only=first_only,
-      at_least_one=True
+    scans = list(filter(None, map(scan_desktop_directory, desktop_directories(
+      user=self.user,
+      system=self.system,
+      env=self.env
+    ))))
+    # Paths of each desktop name in order of precedence.
+    desktops = collections.OrderedDict()
+    for scan in scans:
+      for d in sorted(scan.desktops):
+        desktops.setdefault(d, []).append(os.path.join(scan.path, d))
+
+    for path in self.mimeapps_list_paths():
+      assocs = load_associations(path)
+      for section in (DEFAULT_APPLICATIONS_SECTION, ADDED_ASSOCIATIONS_SECTION):
+        for mimetype, ds in assocs.get(section, {}).items():
+          for d in ds:
+            if d not in desktops:
+              yield doctor_record(
+                DOCTOR_MISSING_DESKTOP, SEVERITY_WARNING, path,
+                (RECORD_SECTION, section),
+                (RECORD_MIMETYPE, mimetype),
+                (RECORD_DESKTOP, d)
+              )
+
+    for d, paths in desktops.items():
+      if len(paths) > 1:
+        yield doctor_record(
+          DOCTOR_SHADOWED_DESKTOP, SEVERITY_INFO, paths[0],
+          (RECORD_DESKTOP, d),
+          (RECORD_SHADOWED, paths[1:])
+        )
+
+    paths = [
+      os.path.join(scan.path, d)
+      for scan in scans
+      for d in sorted(scan.desktops)
+    ]
+    records = dict(zip(paths, doctor_desktop_records(paths, max_workers=max_workers)))
+
+    executables = dict()
+    def resolve(cmd):
+      try:
+        return executables[cmd]
+      except KeyError:
+        path = which(cmd, env=self.env)
+        if path and not (os.path.isfile(path) and os.access(path, os.X_OK)):
+          path = None
+        executables[cmd] = path
+        return path
+
+    for path in paths:
+      exe, try_exec, _, hidden, error = records[path]
+      if error:
+        yield doctor_record(
+          DOCTOR_INVALID_DESKTOP, SEVERITY_ERROR, path,
+          (RECORD_REASON, error)
+        )
+        continue
+      # Hidden entries are equivalent to deleted ones.
+      if hidden:
+        continue
+      if try_exec and not resolve(try_exec):
+        yield doctor_record(
+          DOCTOR_UNRESOLVABLE_TRYEXEC, SEVERITY_WARNING, path,
+          (RECORD_EXECUTABLE, try_exec)
+        )
+        # The entry is ignored so its Exec command is irrelevant.
+        continue
+      if exe:
+        try:
+          cmd = shlex.split(exe)[0]
+        except (ValueError, IndexError) as e:
+          yield doctor_record(
+            DOCTOR_UNRESOLVABLE_EXEC, SEVERITY_ERROR, path,
+            (RECORD_EXECUTABLE, exe),
+            (RECORD_REASON, str(e))
+          )
+          continue
+        if not resolve(cmd):
+          yield doctor_record(
+            DOCTOR_UNRESOLVABLE_EXEC, SEVERITY_ERROR, path,
+            (RECORD_EXECUTABLE, cmd)
+          )
+
+    for scan in scans:
+      path = os.path.join(scan.path, MIMEINFO_CACHE_FILE)
+      listed = set()
+      for d in scan.desktops:
+        _, _, mimetypes, hidden, error = records[os.path.join(scan.path, d)]
+        if mimetypes and not (hidden or error):
+          listed.add(d)
+      if scan.cache_mtime is None:
+        if listed:
+          yield doctor_record(
+            DOCTOR_STALE_MIMEINFO_CACHE, SEVERITY_WARNING, path,
+            (RECORD_REASON, 'missing'),
+            (RECORD_DESKTOP, sorted(listed))
+          )
+        continue
+      cached = set(itertools.chain.from_iterable(
+        load_associations(path).get(MIME_CACHE_SECTION, {}).values()
+      ))
+      for reason, ds in (
+        (
+          'modified',
+          (
+            d for d, mtime in scan.desktops.items()
+            if mtime is not None and mtime > scan.cache_mtime
+          )
+        ),
+        ('unlisted', listed - cached),
+        (
+          'removed',
+          # Desktops in subdirectories are listed with prefixed names.
+          (
+            d for d in cached - scan.desktops.keys()
+            if not any(d.startswith(s + '-') for s in scan.subdirectories)
+          )
+        ),
+      ):
+        ds = sorted(ds)
+        if ds:
+          yield doctor_record(
+            DOCTOR_STALE_MIMEINFO_CACHE, SEVERITY_WARNING, path,
+            (RECORD_REASON, reason),
+            (RECORD_DESKTOP, ds)
+          )
+
+
+
+################################## AsyncMimeo ##################################
+
+ASYNC_EXECUTOR = None
+
+def async_executor():
+  '''
+  Get the executor that is shared by all AsyncMimeo instances for blocking
+  calls. It is created on first use.
+  '''
+  import concurrent.futures
+  global ASYNC_EXECUTOR
+  if ASYNC_EXECUTOR is None:
+    ASYNC_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+      max_workers=ASYNC_MAX_WORKERS
     )
-    a_by_b = modify_and_collect(a_to_b, swap=True)
-    for pc, aa in a_by_b.items():
-      if pc is None:
-        logging.warning('failed to determine command(s) for {}'.format(quote_cmd(aa)))
-      elif pc[0] is not None:
-        for c in exec_field_to_cmds(pc[0], aa, 'User Command'):
-          yield c
-      else:
-        de = desktop_entry(pc[1])
-        yield from desktop_entry_to_cmds(de, args=aa, term_cmd=self.term_cmd)
+  return ASYNC_EXECUTOR
+
+
+
+async def async_file_cmd_mimetype(path):
+  '''
+  Asynchronous version of file_cmd_mimetype.
+  '''
+  import asyncio
+  proc = await asyncio.create_subprocess_exec(
+    *file_cmd_args(path),
+    stdout=asyncio.subprocess.PIPE
+  )
+  stdout, _ = await proc.communicate()
+  if proc.returncode:
+    raise subprocess.CalledProcessError(proc.returncode, file_cmd_args(path))
+  return parse_file_cmd_output(stdout)
+
+
+
+class AsyncMimeo(object):
+  '''
+  Awaitable facade for using Mimeo from an asyncio event loop. The blocking
+  parts of the resolution (stat, content sniffing, hostname lookups, file
+  parsing) run in the shared executor. The EXE_FILE fallback and launched
+  commands run as asyncio subprocesses.
 
+  Concurrent requests for the same argument or MIME-type share a single
+  pending result.
 
+  Mimeo instances are not thread-safe so each executor thread uses its own,
+  created on first use with the same arguments. They share the system layer.
+  The instance is bound to the event loop on which it is first used.
 
-  def known_mimetypes(self):
+  All keyword arguments are passed through to Mimeo.
+  '''
+  def __init__(self, executor=None, **kwargs):
+    self.executor = executor
+    self.loop = None
+    self.in_flight = dict()
+    kwargs['file_cmd'] = self.file_cmd_mimetype
+    self.mimeo = Mimeo(**kwargs)
+    kwargs['system_layer'] = self.mimeo.system_layer
+    self.mimeo_kwargs = kwargs
+    self.local = threading.local()
+    # pyxdg loads the shared MIME-info database lazily and the loading is not
+    # thread-safe, so load it here before any worker thread uses it.
+    xdg.Mime.update_cache()
+
+
+
+  def file_cmd_mimetype(self, path):
     '''
-    Return a set of known MIME-types.
+    Run async_file_cmd_mimetype on the event loop from a worker thread and wait
+    for the result.
     '''
-    if not self.seen_mimetypes:
-      paths = mimeapps_list_paths(
-        current_desktop=True,
-        user=True,
-        system=True,
-        include_user_app_dir=self.include_deprecated
-      )
-      sections = (ADDED_ASSOCIATIONS_SECTION, DEFAULT_APPLICATIONS_SECTION)
-      self.seen_mimetypes.update(self.section_entries(paths, sections))
+    import asyncio
+    future = asyncio.run_coroutine_threadsafe(
+      async_file_cmd_mimetype(path),
+      self.loop
+    )
+    return future.result()
 
-      paths = mimeinfo_caches(user=True, system=True)
-      sections = (MIME_CACHE_SECTION,)
-      self.seen_mimetypes.update(self.section_entries(paths, sections))
 
-      for path in self.mimetypes_knownfiles:
-        try:
-          with open(path, 'r') as f:
-            logging.debug('loading MIME-types from {}'.format(path))
-            for line in f:
-              m = MIMETYPES_KNOWNFILES_REGEX.search(line)
-              if m:
-                self.seen_mimetypes.add(m.group(1))
-        except FileNotFoundError:
-          pass
 
-    return self.seen_mimetypes
+  def thread_mimeo(self):
+    '''
+    Get the Mimeo instance of the current thread.
+    '''
+    try:
+      return self.local.mimeo
+    except AttributeError:
+      self.local.mimeo = Mimeo(**self.mimeo_kwargs)
+      return self.local.mimeo
 
 
 
-  def matching_mimetypes(self, matcher, ensure_known=False):
+  async def run_in_executor(self, func, *args):
     '''
-    Iterate over all known MIME-types matched by the given matcher.
+    Run a blocking function in the executor.
     '''
-    regex, is_pattern = mimetype_regex(matcher)
-    if is_pattern or ensure_known:
-      for m in self.known_mimetypes():
-        if regex.match(m):
-          yield m
-    else:
-      yield matcher
+    import asyncio
+    loop = asyncio.get_running_loop()
+    if self.loop is None:
+      self.loop = loop
+    elif loop is not self.loop:
+      raise RuntimeError('AsyncMimeo used from a different event loop')
+    executor = self.executor if self.executor else async_executor()
+    return await loop.run_in_executor(executor, func, *args)
 
 
 
-  def modify_associations(self, op, matcher, desktops=None):
+  async def deduplicated(self, key, func, *args):
     '''
-    Modify associations.
+    Await func(*args) or the pending result of a previous call with the same
+    key. The shared result is shielded so that cancelling one caller does not
+    cancel the others.
     '''
-    path = user_mimeapps_path(current_desktop=self.current_desktop)
-    assocs = self.get_associations(path)
+    import asyncio
+    try:
+      future = self.in_flight[key]
+    except KeyError:
+      future = asyncio.ensure_future(self.run_in_executor(func, *args))
+      self.in_flight[key] = future
+      future.add_done_callback(lambda f: self.in_flight.pop(key, None))
+    return list(await asyncio.shield(future))
 
-    if matcher:
-      mimetypes = self.matching_mimetypes(matcher)
-    elif desktops:
-      desktops = set(desktops)
-      mimetypes = set()
-      for d in self.search_desktop_paths(desktops, first_only=True):
-        de = desktop_entry(d)
-        mimetypes.update(de.getMimeTypes())
 
-    if op in ASSOCIATION_ADDERS:
-      if desktops:
-        for s, m, d in itertools.product(
-          ASSOCIATION_ADDERS[op],
-          mimetypes,
-          desktops
-        ):
-          assocs = add_association(assocs, s, m, d)
 
-    elif op in ASSOCIATION_REMOVERS:
-      if desktops:
-        for s, m, d in itertools.product(
-          ASSOCIATION_REMOVERS[op],
-          mimetypes,
-          desktops
-        ):
-          assocs = remove_association(assocs, s, m, d)
-      else:
-        for s, m in itertools.product(
-          ASSOCIATION_REMOVERS[op],
-          mimetypes,
-        ):
-          assocs = remove_association(assocs, s, m)
+  def _mimetypes(self, arg, first_only):
+    return list(self.thread_mimeo().arg_to_mimetypes(arg, first_only=first_only))
 
-    save_associations(path, assocs)
 
 
+  def _desktop_paths(self, mimetype, first_only):
+    return list(self.thread_mimeo().mimetype_to_desktop_filepaths(
+      mimetype,
+      first_only=first_only,
+      only_existing=True
+    ))
 
-  def desktop_paths_to_desktop_entries(
-    self, ds=None, first_only=False
-  ):
+
+
+  def _resolve(self, arg, first_only):
+    return list(self.thread_mimeo().args_to_cmds((arg,), first_only=first_only))
+
+
+
+  async def mimetypes(self, arg, first_only=False):
     '''
-    Iterate over desktops and their desktop entries.
+    Return the list of MIME-types of the argument.
     '''
-    if ds:
-      ds = self.search_desktop_paths(ds, first_only=first_only)
-    else:
-      ds = self.desktop_paths()
-    for d in ds:
-      de = desktop_entry(d, none_if_error=self.none_on_de_parsing_err)
-      yield d, de
+    key = ('mimetypes', arg, first_only)
+    return await self.deduplicated(key, self._mimetypes, arg, first_only)
 
 
 
-  def desktop_paths_to_desktop_fields(
-    self, field, typ='string', ds=None, first_only=False
-  ):
+  async def desktop_paths(self, mimetype, first_only=False):
     '''
-    Iterate over desktops and the given field of their desktop entries.
+    Return the list of paths to desktop files associated with the MIME-type.
     '''
-    for d, de in self.desktop_paths_to_desktop_entries(
-      ds=ds, first_only=first_only
-    ):
-      if de:
-        for x in de.get(field, type=typ, list=True):
-          yield d, x
-      else:
-        yield d, None
+    key = ('desktop_paths', mimetype, first_only)
+    return await self.deduplicated(key, self._desktop_paths, mimetype, first_only)
 
 
 
-  def executables_to_desktop_paths(self, exes=None):
+  async def resolve(self, arg, first_only=True):
     '''
-    Match executables to desktop entries.
+    Return the list of commands for opening the argument.
     '''
-    if exes:
-      exes = list((e, which(e)) for e in exes)
-    for d, exec_field in self.desktop_paths_to_desktop_fields('Exec'):
-      if exec_field:
-        ef1 = shlex.split(exec_field)[0]
-        c = which(ef1)
-        if not c:
-          c = which(os.path.basename(ef1))
-        if not c:
-          continue
-        elif exes:
-          for e, p in exes:
-            if p == c:
-              yield e, d
-              break
-        else:
-          yield c, d
+    key = ('resolve', arg, first_only)
+    return await self.deduplicated(key, self._resolve, arg, first_only)
 
 
 
-  def desktop_paths_to_cmds(self, ds=None, args=None, first_only=False):
+  async def launch(self, arg, quiet=False):
     '''
-    Iterate over desktops and their associated MIME-types.
+    Launch the commands for opening the argument without waiting for them to
+    finish. The asyncio.subprocess.Process objects are returned.
     '''
-    for d, de in self.desktop_paths_to_desktop_entries(ds=ds, first_only=first_only):
-      for c in desktop_entry_to_cmds(de, args=args, term_cmd=self.term_cmd):
-        yield d, c
+    import asyncio
+    if quiet:
+      kwargs = {
+        'stdout' : asyncio.subprocess.DEVNULL,
+        'stderr' : asyncio.subprocess.DEVNULL,
+      }
+    else:
+      kwargs = dict()
+    procs = list()
+    for cmd in await self.resolve(arg):
+      logging.debug(quote_cmd(cmd))
+      # This is not timed as STAGE_SPAWN because the time across an await
+      # includes that of other coroutines.
+      procs.append(await asyncio.create_subprocess_exec(*cmd, close_fds=True, **kwargs))
+    return procs
 
 
 
@@ -2026,6 +6747,17 @@ DEFAULT ARGUMENTS
 
 
 
+SNAPSHOT
+
+  Parsed configuration files are saved to
+
+    {snapshot}
+
+  Each file is only parsed again when its modification time, size or inode
+  changes. The snapshot can be deleted at any time.
+
+
+
 DEPRECATED FILES
 
   The following path is deprecated:
@@ -2054,6 +6786,7 @@ DEPRECATED FILES
       deflist_name=DEFAULTS_LIST_FILE,
       assocs_paths='\n    '.join(default_mimeo_associations_paths()),
       dapath=default_arguments_path(),
+      snapshot=default_snapshot_path(),
       applist=os.path.join(xdg.BaseDirectory.xdg_config_home, MIMEAPPS_LIST_FILE),
       old_applist=os.path.join(xdg.BaseDirectory.xdg_data_home, APP_DIR, MIMEAPPS_LIST_FILE),
       old_deflist=os.path.join(xdg.BaseDirectory.xdg_data_home, APP_DIR, DEFAULTS_LIST_FILE),
@@ -2126,11 +6859,31 @@ def get_argparser():
     help='List the values of a desktop entry field per desktop, e.g. "Exec" or "MimeType".'
   )
 
+  query_op_group.add_argument(
+    '--desk2icon', action='store_true',
+    help='List the paths to the icon files of the given desktops, or of all desktops if none are given. Icons are looked up in the icon theme selected with --icon-theme.'
+  )
+
   query_op_group.add_argument(
     '--mimeapps-list', action='store_true',
     help='Print the paths to detected mimeapps.list files.'
   )
 
+  query_op_group.add_argument(
+    '--doctor', action='store_true',
+    help='Check for mimeapps.list entries of missing desktop files, desktop entries that cannot be parsed or whose Exec or TryExec command is not found, outdated mimeinfo.cache files and desktop files that are shadowed by others with the same name. The findings are printed as a JSON array of records, or as newline-delimited JSON with --ndjson. Large numbers of desktop entries are parsed in parallel by worker processes.'
+  )
+
+  query_op_group.add_argument(
+    '--search', metavar='<query>',
+    help='Print the desktop files of visible applications whose name, generic name, keywords or executable match every word of the query, either exactly or by prefix, ranked by the matching fields. Use with --full-path to print full paths.'
+  )
+
+  query_op_group.add_argument(
+    '--launcher', action='store_true',
+    help='Application launcher mode for rofi and dmenu. Without arguments, print the names of all visible applications. With arguments, launch the applications with the given names, or print their commands with --command. In rofi script mode the rows include icons and the selected desktop file is identified by ${}. Examples: "rofi -show apps -modi apps:\'%(prog)s --launcher\'" and "%(prog)s --launcher \"$(%(prog)s --launcher | dmenu -i)\"".'.format(ROFI_INFO)
+  )
+
   mod_op_group = parser.add_argument_group(
     'Modification Operations',
     'Operations to change associations and preferences. If no MIME-type matcher is given then the MIME-types in the desktop files will be used.'
@@ -2210,6 +6963,11 @@ def get_argparser():
     help='Omit the default arguments.'
   )
 
+  conf_group.add_argument(
+    '--no-snapshot', dest='use_snapshot', action='store_false',
+    help='Do not load or save the snapshot of parsed configuration files. See --filepath-help for details.'
+  )
+
   conf_group.add_argument(
     '--user', action='store_true',
     help='Restrict operations to user files.'
@@ -2225,9 +6983,19 @@ def get_argparser():
     help='Suppress all output from launched applications.'
   )
 
+  conf_group.add_argument(
+    '--coalesce', action='store_true',
+    help='Do not open arguments or run commands that were already opened or run by another invocation within the window set by --coalesce-window. Repeated identical invocations from the same working directory are dropped before the arguments are resolved. Recent launches are recorded in {}.'.format(os.path.join('$XDG_RUNTIME_DIR', NAME.lower(), LAUNCHES_FILE))
+  )
+
+  conf_group.add_argument(
+    '--coalesce-window', metavar='<seconds>', type=float, default=DEFAULT_COALESCE_WINDOW,
+    help='The time window for --coalesce. Default: %(default)s'
+  )
+
   conf_group.add_argument(
     '--term', metavar='<cmd>', action='store',
-    help='Terminal command to use when launching applications with desktop files that specify "Terminal=true". It will be split into words using shlex.split. A word equal to "%%s" will be replaced by the separate words of the application command. A word equal to "\'%%s\'" will be replaced by a single word containing the joined words of the application command. Any other instance of "%%s" within a word will be replaced by the joined words of the application command. If "%%s" does not appear within the terminal command then the separate words of the application command will be appended to the end of the command. Examples: "urxvt -e", "urxvt -e %%s", "xterm -e bash -c \'%%s\'". A literal "%%" may be escaped with "%%%%". Use the default arguments file or a shell alias to automatically pass this argument.'
+    help='Terminal command to use when launching applications with desktop files that specify "Terminal=true". It will be split into words using shlex.split. A word equal to "%%s" will be replaced by the separate words of the application command. Any other instance of "%%s" within a word will be replaced by the joined words of the application command. If "%%s" does not appear within the terminal command then the separate words of the application command will be appended to the end of the command. Examples: "urxvt -e", "urxvt -e %%s", "xterm -e bash -c \'exec %%s\'". A literal "%%" may be escaped with "%%%%". Use the default arguments file or a shell alias to automatically pass this argument.'
   )
 
   conf_group.add_argument(
@@ -2250,11 +7018,41 @@ def get_argparser():
     help='Determine MIME-type of files from the name only.'
   )
 
+  conf_group.add_argument(
+    '--sniff-timeout', metavar='<seconds>', type=float, default=DEFAULT_SNIFF_TIMEOUT,
+    help='The time limit for determining the MIME-type of a file by content, e.g. on a hung network filesystem. When it expires, the MIME-type is determined by name instead. Unless --no-fs-policy is given, the limit only applies to network and FUSE filesystems. Set it to 0 to disable the limit. Default: %(default)s'
+  )
+
+  conf_group.add_argument(
+    '--no-xattr', dest='read_xattr', action='store_false',
+    help='Ignore MIME-types stored in the "{}" extended attribute of files. By default, the attribute is used instead of determining the MIME-type by content.'.format(XATTR_MIME_TYPE)
+  )
+
+  conf_group.add_argument(
+    '--write-xattr', action='store_true',
+    help='Store MIME-types determined by content in the "{}" extended attribute of files, along with the modification time in "{}" to detect outdated values.'.format(XATTR_MIME_TYPE, XATTR_MIME_TYPE_MTIME)
+  )
+
+  conf_group.add_argument(
+    '--no-fs-policy', dest='use_fs_policy', action='store_false',
+    help='Do not adapt MIME-type detection to the filesystem. By default, files on network filesystems such as NFS, CIFS and SSHFS are only detected by name and files on other FUSE filesystems are detected by name first, regardless of the --by-content-* options.'
+  )
+
+  conf_group.add_argument(
+    '--probe-urls', action='store_true',
+    help='Determine the MIME-type of HTTP(S) URLs from the Content-Type header with a HEAD request so that they can be opened with the associated application instead of the browser, if there is one that accepts URLs.'
+  )
+
   conf_group.add_argument(
     '--no-follow', action='store_true',
     help='Do not follow symlinks.'
   )
 
+  conf_group.add_argument(
+    '--recursive', action='store_true',
+    help='With --mimetype, recursively classify the files in the given directories and print each path and MIME-type separated by a tab as they are found.'
+  )
+
   conf_group.add_argument(
     '--deprecated', action='store_true',
     help='Use deprecated directories. See --filepath-help for details.'
@@ -2270,6 +7068,31 @@ def get_argparser():
     help='Enable debugging messages.'
   )
 
+  conf_group.add_argument(
+    '--profile', nargs='?', const='', metavar='<filepath>',
+    help='Profile the invocation with cProfile. If a path is given then the raw pstats data will be saved to it, otherwise the top entries sorted by cumulative time will be printed to STDERR.'
+  )
+
+  conf_group.add_argument(
+    '--profile-limit', type=int, default=PROFILE_DEFAULT_LIMIT, metavar='<n>',
+    help='The number of entries to print with --profile when no path is given. Default: %(default)s'
+  )
+
+  conf_group.add_argument(
+    '--timings', nargs='?', const='', metavar='<filepath>',
+    help='Time each resolution stage and print the results as a single JSON line to STDERR, or append it to the given file.'
+  )
+
+  conf_group.add_argument(
+    '--json', dest='output_format', action='store_const', const=OUTPUT_JSON,
+    help='Print the output of query operations as a JSON array of records.'
+  )
+
+  conf_group.add_argument(
+    '--ndjson', dest='output_format', action='store_const', const=OUTPUT_NDJSON,
+    help='Print the output of query operations as newline-delimited JSON records. Each record is printed as soon as it is determined.'
+  )
+
   conf_group.add_argument(
     '--full-path', action='store_true',
     help='Return full paths to desktop files for some outputs..'
@@ -2280,6 +7103,26 @@ def get_argparser():
     help='For some output, show all possibilities rather than just the first. This can be used with --command for example.'
   )
 
+  conf_group.add_argument(
+    '--stdin-fd', action='store_true',
+    help='Pass data from STDIN (given as "{0}") to applications that require a file as {1} instead of saving it to the cache. Applications must read the file sequentially. Applications without file arguments always read the data on their STDIN.'.format(STDIN_ARG, STDIN_DEV_FD_FMT.format(0))
+  )
+
+  conf_group.add_argument(
+    '--icon-theme', metavar='<theme>',
+    help='The icon theme for --launcher and --desk2icon. Default: the theme in the GTK 3 settings, or "{}".'.format(ICON_THEME_FALLBACK)
+  )
+
+  conf_group.add_argument(
+    '--icon-size', metavar='<pixels>', type=int, default=DEFAULT_ICON_SIZE,
+    help='The preferred size of icons for --launcher and --desk2icon. Default: %(default)s'
+  )
+
+  conf_group.add_argument(
+    '--stream', action='store_true',
+    help='Print the output of query operations as it is determined instead of collecting and sorting it first. Items are listed in the order in which they are determined, e.g. in the order of the input arguments. This has no effect with --swap.'
+  )
+
   conf_group.add_argument(
     '--swap', action='store_true',
     help='Swap the way displayed information is organized, e.g. display input arguments per MIME-type instead of MIME-types per input argument with --mimetype. This does not work for all query operations.'
@@ -2293,19 +7136,130 @@ def get_argparser():
 
 ##################################### Main #####################################
 
+def xdg_open_configuration(snapshot=None):
+  '''
+  Get the parsed default arguments as a dict for xdg_open_main. The result is
+  stored in the snapshot with the default arguments file and this module as
+  sources so that the argument parser is only used when either changes.
+  '''
+  path = default_arguments_path()
+
+  def parse():
+    return vars(get_argparser().parse_args(load_default_arguments(path) or []))
+
+  if snapshot is None:
+    return parse()
+  else:
+    return snapshot.get(
+      SNAPSHOT_XDG_OPEN_CONFIGURATION,
+      (path, os.path.abspath(__file__)),
+      parse
+    )
+
+
+
+def xdg_open_main(args):
+  '''
+  Open a single file or URL with the xdg-open command-line interface. The
+  arguments are not parsed with argparse. Default arguments are applied from a
+  precomputed configuration.
+  '''
+  if len(args) != 1 or not args[0]:
+    print(XDG_OPEN_USAGE, file=sys.stderr)
+    return XDG_OPEN_SYNTAX_ERROR
+  arg = args[0]
+  if arg in ('--help', '--manual'):
+    print(XDG_OPEN_USAGE)
+    return 0
+  elif arg == '--version':
+    print('{} {}'.format(XDG_OPEN_NAME, NAME))
+    return 0
+  elif arg.startswith('-'):
+    print('xdg-open: unexpected option \'{}\''.format(arg), file=sys.stderr)
+    print(XDG_OPEN_USAGE, file=sys.stderr)
+    return XDG_OPEN_SYNTAX_ERROR
+
+  path = ensure_path(arg)
+  if path and not os.path.lexists(path):
+    print('xdg-open: file \'{}\' does not exist'.format(arg), file=sys.stderr)
+    return XDG_OPEN_FILE_NOT_FOUND
+
+  snapshot = Snapshot()
+  snapshot.load()
+  pargs = argparse.Namespace(**xdg_open_configuration(snapshot=snapshot))
+  pargs.args = [arg]
+  # Only the open operation is supported.
+  pargs.command = False
+  if not pargs.use_snapshot:
+    snapshot = None
+  try:
+    launched = run_instrumented_operations(pargs, snapshot=snapshot)
+  except OSError as e:
+    print('xdg-open: {}'.format(e), file=sys.stderr)
+    return XDG_OPEN_ACTION_FAILED
+  if launched == 0:
+    print('xdg-open: no method available for opening \'{}\''.format(arg), file=sys.stderr)
+    return XDG_OPEN_TOOL_NOT_FOUND
+  return 0
+
+
+
 def main(args=None):
+  '''
+  Run Mimeo with the given command-line arguments, or with those of the
+  process. In the latter case Mimeo acts as xdg-open if it was invoked under
+  that name and the exit status of xdg-open is returned.
+  '''
   if not args:
+    if os.path.basename(sys.argv[0]) == XDG_OPEN_NAME:
+      return xdg_open_main(sys.argv[1:])
     args = sys.argv[1:]
   parser = get_argparser()
   pargs = parser.parse_args(args)
 
+  if pargs.use_snapshot:
+    snapshot = Snapshot()
+    snapshot.load()
+  else:
+    snapshot = None
+
   if pargs.use_default_args:
-    extra_args = default_arguments()
+    extra_args = default_arguments(snapshot=snapshot)
     if extra_args:
       logging.debug('prepending arguments: {}'.format(quote_cmd(extra_args)))
       args = extra_args + args
     pargs = parser.parse_args(args)
+    if not pargs.use_snapshot:
+      snapshot = None
+
+  run_instrumented_operations(pargs, snapshot=snapshot)
+
+
+
+def run_instrumented_operations(pargs, snapshot=None):
+  '''
+  Run run_operations with the timings and profiling requested by the parsed
+  arguments and return its result.
+  '''
+  if pargs.timings is not None:
+    STAGE_TIMER.enable()
+  try:
+    if pargs.profile is None:
+      return run_operations(pargs, snapshot=snapshot)
+    else:
+      with profiled(path=pargs.profile, limit=pargs.profile_limit):
+        return run_operations(pargs, snapshot=snapshot)
+  finally:
+    if pargs.timings is not None:
+      STAGE_TIMER.write(path=pargs.timings)
+
 
+
+def run_operations(pargs, snapshot=None):
+  '''
+  Run the operations requested by the parsed arguments. The result of
+  run_queries is returned.
+  '''
   mimeo = Mimeo(
     user=(not pargs.system),
     system=(not pargs.user),
@@ -2314,12 +7268,34 @@ def main(args=None):
     by_content_first=pargs.by_content_first,
     by_content_only=pargs.by_content_only,
     by_name_only=pargs.by_name_only,
+    use_fs_policy=pargs.use_fs_policy,
+    sniff_timeout=(pargs.sniff_timeout if pargs.sniff_timeout > 0 else None),
+    read_xattr=pargs.read_xattr,
+    write_xattr=pargs.write_xattr,
     follow=(not pargs.no_follow),
     current_desktop=pargs.current_desktop,
+    probe_urls=pargs.probe_urls,
+    snapshot=snapshot,
+    icon_theme=pargs.icon_theme,
+    icon_size=pargs.icon_size,
+    stdin_fd=pargs.stdin_fd,
   )
   if pargs.assoc or pargs.use_default_assoc:
     mimeo.load_mimeo_associations(fpath=pargs.assoc)
+  try:
+    return run_queries(mimeo, pargs)
+  finally:
+    mimeo.save_snapshot()
 
+
+
+def run_queries(mimeo, pargs):
+  '''
+  Run the operations requested by the parsed arguments with the given Mimeo
+  instance. When arguments are opened, the number of commands that were
+  determined for them is returned, or None if the launch was dropped as a
+  duplicate.
+  '''
   if pargs.create:
     appdir = xdg.BaseDirectory.save_data_path(APP_DIR)
     for fname, name, exe, matcher, is_term in pargs.create:
@@ -2370,21 +7346,44 @@ def main(args=None):
 
 
   if pargs.mimetype:
-    if pargs.args:
+    if pargs.recursive:
+      a_to_b = itertools.chain.from_iterable(
+        mimeo.tree_to_mimetypes(
+          root,
+          at_least_one=True,
+          first_only=(not pargs.show_all)
+        )
+        for root in pargs.args
+      )
+      if pargs.output_format:
+        print_records(
+          pairs_to_records(a_to_b, (RECORD_PATH, RECORD_MIMETYPE)),
+          pargs.output_format
+        )
+      else:
+        for path, m in a_to_b:
+          print('{}\t{}'.format(path, m if m else ''))
+    elif pargs.args:
       a_to_b = mimeo.args_to_mimetypes(
         pargs.args,
         at_least_one=True,
         first_only=(not pargs.show_all)
       )
-      b_by_a = modify_and_collect(a_to_b, swap=pargs.swap)
-      print_collection(
-        b_by_a,
+      print_pairs(
+        a_to_b,
+        (RECORD_ARG, RECORD_MIMETYPE),
+        output_format=pargs.output_format,
+        stream=pargs.stream,
+        swap=pargs.swap,
         order=(None if pargs.swap else pargs.args),
         sort_a=True
       )
     else:
-      for x in sorted(mimeo.known_mimetypes()):
-        print(x)
+      print_values(
+        sorted(mimeo.known_mimetypes()),
+        RECORD_MIMETYPE,
+        output_format=pargs.output_format
+      )
 
 
 
@@ -2398,20 +7397,22 @@ def main(args=None):
           only_existing=True
         )
         f = None if pargs.full_path else os.path.basename
-        b_by_a = modify_and_collect(a_to_b, fb=f, swap=pargs.swap)
-        print_collection(
-          b_by_a,
+        print_pairs(
+          a_to_b,
+          (RECORD_ARG, RECORD_DESKTOP),
+          output_format=pargs.output_format,
+          stream=pargs.stream,
+          fb=f,
+          swap=pargs.swap,
           order=(None if pargs.swap else pargs.args),
           sort_a=True
         )
     else:
       if pargs.full_path:
-        for p in mimeo.desktop_paths(sort_per_dir=True):
-          print(p)
+        ps = mimeo.desktop_paths(sort_per_dir=True)
       else:
-        ps = set(os.path.basename(p) for p in mimeo.desktop_paths())
-        for p in sorted(ps):
-          print(p)
+        ps = sorted(set(os.path.basename(p) for p in mimeo.desktop_paths()))
+      print_values(ps, RECORD_DESKTOP, output_format=pargs.output_format)
 
 
 
@@ -2427,7 +7428,8 @@ def main(args=None):
 
 
   elif pargs.mime2desk:
-    ms = pargs.args if pargs.args else mimeo.known_mimetypes()
+    # Sorting the input up front lets the collection be streamed in order.
+    ms = pargs.args if pargs.args else sorted(mimeo.known_mimetypes())
     f = None if pargs.full_path else os.path.basename
     a_to_b = mimeo.mimetypes_to_desktop_paths(
       ms,
@@ -2435,9 +7437,13 @@ def main(args=None):
       first_only=(not pargs.show_all),
       only_existing=True
     )
-    b_by_a = modify_and_collect(a_to_b, fb=f, swap=pargs.swap)
-    print_collection(
-      b_by_a,
+    print_pairs(
+      a_to_b,
+      (RECORD_MIMETYPE, RECORD_DESKTOP),
+      output_format=pargs.output_format,
+      stream=pargs.stream,
+      fb=f,
+      swap=pargs.swap,
       order=(None if pargs.swap else pargs.args),
       sort_a=True,
       sort_b=True
@@ -2448,9 +7454,14 @@ def main(args=None):
   elif pargs.app2desk:
     a_to_b = mimeo.executables_to_desktop_paths(exes=pargs.args)
     f = None if pargs.full_path else os.path.basename
-    b_by_a = modify_and_collect(a_to_b, fa=f, fb=f, swap=pargs.swap)
-    print_collection(
-      b_by_a,
+    print_pairs(
+      a_to_b,
+      (RECORD_EXECUTABLE, RECORD_DESKTOP),
+      output_format=pargs.output_format,
+      stream=pargs.stream,
+      fa=f,
+      fb=f,
+      swap=pargs.swap,
       order=(None if pargs.swap else pargs.args),
       sort_a=True,
       sort_b=True
@@ -2465,9 +7476,13 @@ def main(args=None):
     a_to_b = mimeo.desktop_paths_to_desktop_fields(
       pargs.desk2field, ds=ds, first_only=False
     )
-    b_by_a = modify_and_collect(a_to_b, fa=f, swap=pargs.swap)
-    print_collection(
-      b_by_a,
+    print_pairs(
+      a_to_b,
+      (RECORD_DESKTOP, pargs.desk2field),
+      output_format=pargs.output_format,
+      stream=pargs.stream,
+      fa=f,
+      swap=pargs.swap,
       order=(None if pargs.swap else ds),
       sort_a=True,
       sort_b=True
@@ -2475,6 +7490,23 @@ def main(args=None):
 
 
 
+  elif pargs.desk2icon:
+    ds = list(os.path.basename(d) for d in ensure_desktop_names(pargs.args))
+    f = None if pargs.full_path else os.path.basename
+    a_to_b = mimeo.desktop_paths_to_icon_paths(ds=ds)
+    print_pairs(
+      a_to_b,
+      (RECORD_DESKTOP, RECORD_ICON),
+      output_format=pargs.output_format,
+      stream=pargs.stream,
+      fa=f,
+      swap=pargs.swap,
+      order=(None if pargs.swap else ds),
+      sort_a=True
+    )
+
+
+
   elif pargs.mimeapps_list:
     for path in mimeo.mimeapps_list_paths():
       if os.path.exists(path):
@@ -2482,19 +7514,78 @@ def main(args=None):
 
 
 
+  elif pargs.doctor:
+    print_records(mimeo.doctor(), pargs.output_format)
+
+
+
+  elif pargs.search is not None:
+    ds = mimeo.search_desktop_entries(pargs.search)
+    if not pargs.full_path:
+      ds = map(os.path.basename, ds)
+    print_values(ds, RECORD_DESKTOP, output_format=pargs.output_format)
+
+
+
+  elif pargs.launcher:
+    if pargs.args:
+      path = os.getenv(ROFI_INFO)
+      for selection in pargs.args:
+        for c in mimeo.launcher_selection_to_cmds(selection, path=path):
+          if pargs.command:
+            print(quote_cmd(c))
+          else:
+            # Detach the output from the launcher's pipe.
+            run_cmd(c, quiet=True)
+          break
+    elif ROFI_RETV in os.environ:
+      for label, icon, path in mimeo.launcher_entries():
+        print(ROFI_ROW_FMT.format(label, icon if icon else '', path))
+    else:
+      for label, _, _ in mimeo.launcher_entries():
+        print(label)
+
+
+
   else:
+    if pargs.coalesce and not pargs.command:
+      coalescer = LaunchCoalescer(window=pargs.coalesce_window)
+      # Repeated invocations are dropped before resolving the arguments.
+      if coalescer.is_duplicate(launch_key('args', os.getcwd(), pargs.args)):
+        return None
+    else:
+      coalescer = None
     first_only = not (pargs.command and pargs.show_all)
-    for c in mimeo.args_to_cmds(
+    pairs = mimeo.args_to_cmd_pairs(
       pargs.args,
-      first_only=first_only
-    ):
-      if pargs.cmd_prefix:
-        logging.debug('prepending arguments: {}'.format(extra_args))
-        c = pargs.cmd_prefix + c
-      if pargs.command:
-        print(quote_cmd(c))
-      else:
-        run_cmd(c, quiet=pargs.quiet)
+      first_only=first_only,
+      prepare_stdin=(not pargs.command)
+    )
+    if pargs.cmd_prefix:
+      logging.debug('prepending arguments: {}'.format(quote_cmd(pargs.cmd_prefix)))
+      pairs = ((aa, pargs.cmd_prefix + c) for aa, c in pairs)
+    if pargs.command and pargs.output_format:
+      print_records(
+        (
+          collections.OrderedDict(((RECORD_ARGS, list(aa)), (RECORD_COMMAND, c)))
+          for aa, c in pairs
+        ),
+        pargs.output_format
+      )
+    else:
+      cmds = (c for _, c in pairs)
+      n = 0
+      procs = list()
+      for c in cmds:
+        n += 1
+        if pargs.command:
+          print(quote_cmd(c))
+        elif coalescer is None or not coalescer.is_duplicate(launch_key('cmd', c)):
+          stdin = None if mimeo.stdin is None else mimeo.stdin.child_stdin()
+          procs.append(run_cmd(c, quiet=pargs.quiet, stdin=stdin))
+      if mimeo.stdin is not None:
+        mimeo.stdin.wait(procs)
+      return n
 
 
 if __name__ == '__main__':
@@ -2503,6 +7594,6 @@ if __name__ == '__main__':
     level=logging.DEBUG if ('--debug' in sys.argv[1:]) else logging.WARNING
   )
   try:
-    main()
+    sys.exit(main())
   except (KeyboardInterrupt, BrokenPipeError):
     pass